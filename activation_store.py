@@ -0,0 +1,282 @@
+"""On-disk activation store with one memory-mappable array per layer.
+
+A store is a directory with
+
+    logits.npy    (n x num_labels)
+    labels.npy    (n,) optional
+    L{i}.npy      (n x hidden) pooled activations of hidden layer i
+    attention-*   optional attention statistics (`attention_stats.py`)
+    meta.json     number of samples and layers, written last
+
+so the k0 scripts can read a single layer (or a few rows of it) without
+unpickling and concatenating the whole activation dump. Extraction scripts
+write stores batch by batch with `ActivationStoreWriter`.
+"""
+
+import os
+import sys
+import json
+import pickle
+import shutil
+import numpy as np
+from tqdm import tqdm
+from pathlib import Path
+
+
+def raw_to_npy(raw_path, npy_path, dtype, shape):
+    """Prepend a .npy header to a raw C-ordered binary file."""
+    header = {
+        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        "fortran_order": False,
+        "shape": tuple(int(v) for v in shape),
+    }
+    with open(npy_path, "wb") as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        with open(raw_path, "rb") as raw:
+            shutil.copyfileobj(raw, f)
+    os.remove(raw_path)
+
+
+def write_array(fname, batches, dtype=np.float32):
+    """Write a list of (b x d) batches (tensors or arrays) into a single
+    (n x d) .npy file without concatenating them in memory."""
+    num_rows = sum(len(b) for b in batches)
+    out = np.lib.format.open_memmap(
+        fname, mode="w+", dtype=dtype, shape=(num_rows,) + tuple(batches[0].shape[1:])
+    )
+    start = 0
+    for b in batches:
+        b = b.detach().cpu().numpy() if hasattr(b, "detach") else np.asarray(b)
+        out[start : start + len(b)] = b
+        start += len(b)
+    out.flush()
+    del out
+
+
+def append_rows(fname, rows, chunk_rows=65536):
+    """Append rows to an (n x ...) .npy file. The grown array is written to a
+    temporary file next to it and moved over the original once complete."""
+    fname = Path(fname)
+    old = np.load(fname, mmap_mode="r")
+    rows = np.asarray(rows, dtype=old.dtype)
+    tmp = fname.with_suffix(".tmp.npy")
+    out = np.lib.format.open_memmap(
+        tmp, mode="w+", dtype=old.dtype, shape=(len(old) + len(rows),) + old.shape[1:]
+    )
+    for start in range(0, len(old), chunk_rows):
+        end = min(start + chunk_rows, len(old))
+        out[start:end] = old[start:end]
+    out[len(old) :] = rows
+    out.flush()
+    del out, old
+    os.replace(tmp, fname)
+
+
+class ActivationStoreWriter:
+    """Append-only writer for an activation store. Every batch is written to
+    the end of one raw file per layer as it comes in, so nothing but the
+    current batch is held in memory; `close` turns the raw files into .npy
+    files and marks the store as complete.
+
+    Batches may come in any order (e.g. sorted by length) as long as every
+    one is appended with the original `indices` of its rows, the rows are
+    then put back in place when the store is closed.
+    """
+
+    def __init__(self, store_dir, dtype=np.float32, provenance=None):
+        """
+        :param store_dir: directory of the store, an existing store there is
+            marked incomplete right away and overwritten
+        :param dtype: dtype of the stored layers
+        :param provenance: JSON-serializable description of where the
+            activations come from, recorded in meta.json
+        """
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        clear_meta(self.store_dir)
+        self.provenance = provenance
+        self.dtype = np.dtype(dtype)
+        self.files = {}
+        self.shapes = {}
+        self.num_samples = 0
+        self.num_layers = None
+
+    def _write(self, name, value, dtype):
+        if hasattr(value, "detach"):
+            value = value.detach().float().cpu().numpy()
+        value = np.ascontiguousarray(value, dtype=dtype)
+        if name not in self.files:
+            self.files[name] = open(self.store_dir / f"{name}.raw", "wb")
+            self.shapes[name] = (value.shape[1:], dtype)
+        self.files[name].write(value.tobytes())
+
+    def append(self, logits, layers, labels=None, indices=None, extras=None):
+        """Write one batch.
+        :param logits: (b x num_labels), None when not computed
+        :param layers: list with the (b x hidden) pooled activations of
+            every layer
+        :param labels: (b,) labels, optional
+        :param indices: (b,) position of every row in the store, when the
+            batches are not appended in order
+        :param extras: dict of other (b x ...) per-example arrays, stored as
+            float32 `<name>.npy` (e.g. the attention statistics)
+        """
+        if indices is not None:
+            self._write("indices", indices, np.int64)
+        if logits is not None:
+            self._write("logits", logits, np.float32)
+        for i, layer in enumerate(layers):
+            self._write(f"L{i}", layer, self.dtype)
+        if labels is not None:
+            self._write("labels", labels, np.int64)
+        for name, value in (extras or {}).items():
+            self._write(name, value, np.float32)
+        self.num_layers = len(layers)
+        self.num_samples += len(layers[0])
+
+    def close(self, chunk_rows=65536):
+        for f in self.files.values():
+            f.close()
+        indices = None
+        if "indices" in self.files:
+            raw = self.store_dir / "indices.raw"
+            indices = np.fromfile(raw, dtype=np.int64)
+            os.remove(raw)
+            if not np.array_equal(np.sort(indices), np.arange(self.num_samples)):
+                raise ValueError("indices are not a permutation of the rows")
+        for name in self.files:
+            if name == "indices":
+                continue
+            shape, dtype = self.shapes[name]
+            raw_path = self.store_dir / f"{name}.raw"
+            shape = (self.num_samples,) + shape
+            if indices is None:
+                raw_to_npy(raw_path, self.store_dir / f"{name}.npy", dtype, shape)
+                continue
+            # scatter the rows back to their original positions
+            raw = np.memmap(raw_path, dtype=dtype, mode="r", shape=shape)
+            out = np.lib.format.open_memmap(
+                self.store_dir / f"{name}.npy", mode="w+", dtype=dtype, shape=shape
+            )
+            for start in range(0, self.num_samples, chunk_rows):
+                end = min(start + chunk_rows, self.num_samples)
+                out[indices[start:end]] = raw[start:end]
+            out.flush()
+            del out, raw
+            os.remove(raw_path)
+        write_meta(self.store_dir, self.num_samples, self.num_layers, self.provenance)
+
+
+def write_meta(store_dir, num_samples, num_layers, provenance=None):
+    """Mark the store as complete."""
+    meta = {"num_samples": num_samples, "num_layers": num_layers}
+    if provenance is not None:
+        meta["provenance"] = provenance
+    tmp = Path(store_dir) / "meta.json.tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, Path(store_dir) / "meta.json")
+
+
+def clear_meta(store_dir):
+    """Mark the store as incomplete before overwriting it."""
+    fname = Path(store_dir) / "meta.json"
+    if fname.exists():
+        os.remove(fname)
+
+
+def read_provenance(store_dir):
+    """Provenance recorded by the extraction, None for an incomplete store
+    or one without provenance."""
+    return read_meta(store_dir).get("provenance") if store_exists(store_dir) else None
+
+
+def store_exists(store_dir):
+    return (Path(store_dir) / "meta.json").exists()
+
+
+def read_meta(store_dir):
+    return json.load(open(Path(store_dir) / "meta.json"))
+
+
+def open_layer(store_dir, layer, mmap_mode="r"):
+    """(n x hidden) activations of a layer, memory-mapped."""
+    return np.load(Path(store_dir) / f"L{layer}.npy", mmap_mode=mmap_mode)
+
+
+def open_logits(store_dir, mmap_mode="r"):
+    return np.load(Path(store_dir) / "logits.npy", mmap_mode=mmap_mode)
+
+
+def open_labels(store_dir):
+    """Labels stored alongside the activations, or None."""
+    fname = Path(store_dir) / "labels.npy"
+    return np.load(fname) if fname.exists() else None
+
+
+def export_pickled_activations(activations, store_dir):
+    """Convert a pickled activation dump (list of `(logits, [layer_0, ...])`
+    batches, as read by `k0_dist.py`) into an activation store."""
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    clear_meta(store_dir)
+    write_array(store_dir / "logits.npy", [v[0] for v in activations])
+    num_layers = len(activations[0][1])
+    for i in tqdm(range(num_layers), desc="exporting layers"):
+        write_array(store_dir / f"L{i}.npy", [v[1][i] for v in activations])
+    write_meta(store_dir, sum(len(v[0]) for v in activations), num_layers)
+
+
+def merge_stores(shard_dirs, store_dir, provenance=None, chunk_rows=65536):
+    """Concatenate complete stores (e.g. the shards of a parallel extraction,
+    in dataset order) into a single store. Directories of per-row files
+    (`<dir>/<row>.npy`, e.g. sampled attention maps) are merged with the rows
+    renumbered."""
+    shard_dirs = [Path(d) for d in shard_dirs]
+    for d in shard_dirs:
+        if not store_exists(d):
+            raise ValueError(f"{d} is not a complete activation store")
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    clear_meta(store_dir)
+    num_samples = sum(read_meta(d)["num_samples"] for d in shard_dirs)
+    for fname in tqdm(sorted(shard_dirs[0].glob("*.npy")), desc="merging"):
+        parts = [np.load(d / fname.name, mmap_mode="r") for d in shard_dirs]
+        out = np.lib.format.open_memmap(
+            store_dir / fname.name,
+            mode="w+",
+            dtype=parts[0].dtype,
+            shape=(num_samples,) + parts[0].shape[1:],
+        )
+        offset = 0
+        for part in parts:
+            for start in range(0, len(part), chunk_rows):
+                end = min(start + chunk_rows, len(part))
+                out[offset + start : offset + end] = part[start:end]
+            offset += len(part)
+        out.flush()
+        del out, parts
+    offset = 0
+    for d in shard_dirs:
+        for fname in d.glob("*/*.npy"):
+            row_dir = store_dir / fname.parent.name
+            row_dir.mkdir(exist_ok=True)
+            shutil.copyfile(fname, row_dir / f"{offset + int(fname.stem)}.npy")
+        offset += read_meta(d)["num_samples"]
+    num_layers = read_meta(shard_dirs[0])["num_layers"]
+    write_meta(store_dir, num_samples, num_layers, provenance)
+
+
+def max_row_norm(x, chunk_rows=65536):
+    """Largest euclidean norm of the rows of x, reading `chunk_rows` rows at
+    a time (first pass of the streaming k0 computation)."""
+    largest = 0.0
+    for start in range(0, len(x), chunk_rows):
+        chunk = np.asarray(x[start : start + chunk_rows], dtype=np.float64)
+        largest = max(largest, np.linalg.norm(chunk, axis=1).max())
+    return largest
+
+
+if __name__ == "__main__":
+    # python activation_store.py <model>-k0.pkl <store_dir>
+    export_pickled_activations(pickle.load(open(sys.argv[1], "rb")), sys.argv[2])
@@ -0,0 +1,159 @@
+"""Content-addressed cache for artifacts derived from the activations.
+
+Pairwise distance matrices, label distances and neighbor indexes are stored
+under the hash of everything that determines their content: the activations
+they come from (the provenance recorded in an activation store by the
+extraction, or the size and modification time of a pickled dump), the
+layer, the distance metric and any parameter of the computation. Changing
+the model, the dataset or the layer therefore changes the key instead of
+silently reusing a stale file.
+
+    <root>/ab/abcdef.../    one directory per entry
+        ...                 the artifact files
+        entry.json          the key fields and the size, written last
+    <root>/tmp/             entries being built
+
+Entries are built in a temporary directory and renamed into place once
+complete, so an interrupted run never leaves a half-written entry that
+looks complete. Every hit touches `entry.json`; when the cache grows over
+its quota the least recently used entries are removed.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from pathlib import Path
+from activation_store import store_exists, read_provenance
+
+ENTRY_FILE = "entry.json"
+
+
+def artifact_key(fields):
+    """Hash of a JSON-serializable dict of key fields."""
+    spec = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+
+def file_fingerprint(path):
+    """Identify a file by its location, size and modification time."""
+    stat = os.stat(path)
+    return {
+        "path": str(Path(path).resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def source_fingerprint(store_dir=None, pickle_file=None):
+    """Key fields of the activations an artifact is computed from: the
+    provenance of the activation store if it exists and has one, otherwise
+    the fingerprint of its meta.json (rewritten last by every extraction),
+    otherwise that of the pickled dump."""
+    if store_dir is not None and store_exists(store_dir):
+        provenance = read_provenance(store_dir)
+        if provenance is not None:
+            return provenance
+        return file_fingerprint(Path(store_dir) / "meta.json")
+    return file_fingerprint(pickle_file)
+
+
+def score_fingerprint(layer_dir, layer):
+    """Fingerprints of the k0 score files of a layer (`L{layer}.npz` curves
+    and/or the dense `L{layer}.pth`) written by `gpu_k0_dist.py`."""
+    files = [Path(layer_dir) / f"L{layer}{ext}" for ext in (".npz", ".pth")]
+    return [file_fingerprint(f) for f in files if f.exists()]
+
+
+def _dir_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+
+class ArtifactCache:
+    """Directory of content-addressed entries with an LRU disk quota."""
+
+    def __init__(self, root, quota=None):
+        """
+        :param root: cache directory
+        :param quota: maximum total size in bytes (default unbounded)
+        """
+        self.root = Path(root)
+        self.quota = quota
+
+    def entry_dir(self, fields):
+        key = artifact_key(fields)
+        return self.root / key[:2] / key
+
+    def lookup(self, fields):
+        """Directory of the complete entry for `fields`, or None."""
+        entry = self.entry_dir(fields)
+        if not (entry / ENTRY_FILE).exists():
+            return None
+        os.utime(entry / ENTRY_FILE)  # mark as recently used
+        return entry
+
+    def get_or_build(self, fields, build):
+        """Directory of the entry for `fields`, built first if needed.
+        :param build: called with an empty directory to write the artifact
+            files into
+        """
+        entry = self.lookup(fields)
+        if entry is not None:
+            return entry
+        entry = self.entry_dir(fields)
+        tmp = self.root / "tmp" / f"{entry.name}-{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        try:
+            build(tmp)
+            with open(tmp / ENTRY_FILE, "w") as f:
+                json.dump({"fields": fields, "size": _dir_size(tmp)}, f, default=str)
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # built concurrently by another process, keep theirs
+                if not (entry / ENTRY_FILE).exists():
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=entry)
+        return entry
+
+    def entries(self):
+        """(directory, size, last use) of every complete entry."""
+        out = []
+        for meta in self.root.glob(f"??/*/{ENTRY_FILE}"):
+            try:
+                size = json.load(open(meta))["size"]
+                out.append((meta.parent, size, meta.stat().st_mtime))
+            except (OSError, ValueError):
+                continue  # removed or being removed
+        return out
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits its
+        quota. `keep` (the entry just built) is never removed."""
+        if self.quota is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries:
+            if total <= self.quota:
+                break
+            if keep is not None and entry == Path(keep):
+                continue
+            # unmark first so a concurrent lookup never sees a partial entry
+            try:
+                os.remove(entry / ENTRY_FILE)
+            except FileNotFoundError:
+                continue  # evicted by another process
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def cached_array(cache, fields, compute):
+    """Array returned by `compute()`, computed once per key `fields`."""
+    entry = cache.get_or_build(fields, lambda d: np.save(d / "array.npy", compute()))
+    return np.load(entry / "array.npy")
@@ -0,0 +1,128 @@
+"""Per-head attention summaries computed during the extraction.
+
+The raw attention maps (layers x heads x T x T per example) are by far the
+largest output of a forward pass, and what is looked at downstream are a few
+numbers per head. Instead of storing the maps, every batch is reduced on the
+fly to, per example, layer and head (averaged over the non-padding query
+tokens):
+
+    entropy            entropy of the attention distribution (nats)
+    max_weight         largest attention weight
+    cls_attention      weight on the first token (CLS)
+    special_attention  weight on special tokens (CLS, SEP, ...)
+    mean_distance      attention-weighted distance |i - j| to the keys
+
+These are written to the activation store as one (n x layers x heads) column
+per statistic, `attention-<stat>.npy`. The raw maps of an explicit sample of
+examples are kept in `attention-maps/<row>.npy` (layers x heads x t x t,
+without the padding).
+"""
+
+import torch
+import numpy as np
+from pathlib import Path
+
+ATTENTION_STATS = (
+    "entropy",
+    "max_weight",
+    "cls_attention",
+    "special_attention",
+    "mean_distance",
+)
+MAPS_DIR = "attention-maps"
+
+
+def head_statistics(attention, attention_mask=None, special_mask=None):
+    """Summarize the attention maps of one layer.
+    :param attention: (B x heads x T x T) attention weights, rows are the
+        query tokens
+    :param attention_mask: (B x T) mask of the non-padding tokens, without it
+        every token counts
+    :param special_mask: (B x T) mask of the special tokens, without it only
+        the first token counts as special
+    :return: dict with a (B x heads) tensor per statistic
+    """
+    attention = attention.float()
+    batch_size, _, length, _ = attention.shape
+    if attention_mask is None:
+        attention_mask = attention.new_ones(batch_size, length)
+    query = attention_mask.to(attention.dtype)[:, None, :]
+    if special_mask is None:
+        special_mask = torch.zeros_like(query[:, 0])
+        special_mask[:, 0] = 1
+    special = special_mask.to(attention.dtype)[:, None, None, :]
+    positions = torch.arange(length, device=attention.device, dtype=attention.dtype)
+    distance = (positions[:, None] - positions[None, :]).abs()
+    per_query = {
+        "entropy": -(attention * attention.clamp_min(1e-12).log()).sum(-1),
+        "max_weight": attention.amax(-1),
+        "cls_attention": attention[..., 0],
+        "special_attention": (attention * special).sum(-1),
+        "mean_distance": (attention * distance).sum(-1),
+    }
+    count = query.sum(-1).clamp_min(1)
+    return {k: (v * query).sum(-1) / count for k, v in per_query.items()}
+
+
+def attention_statistics(attentions, attention_mask=None, special_mask=None):
+    """Summarize the attention maps of every layer.
+    :param attentions: `attentions` of a HuggingFace model output, a
+        (B x heads x T x T) tensor per layer
+    :return: dict with a (B x layers x heads) tensor per statistic
+    """
+    layers = [head_statistics(a, attention_mask, special_mask) for a in attentions]
+    return {k: torch.stack([l[k] for l in layers], 1) for k in ATTENTION_STATS}
+
+
+def model_attentions(output):
+    """Attention maps of a model output, the encoder's for encoder-decoders."""
+    attentions = getattr(output, "attentions", None)
+    if attentions is None:
+        attentions = getattr(output, "encoder_attentions", None)
+    if attentions is None:
+        raise ValueError(f"{type(output).__name__} has no attention maps")
+    return attentions
+
+
+def sampled_maps(attentions, attention_mask, rows):
+    """Raw attention maps of some examples of a batch, without the padding.
+    :param rows: positions in the batch
+    :return: list with a (layers x heads x t x t) array per row
+    """
+    maps = []
+    for row in rows:
+        keep = attention_mask[row].bool()
+        layers = [a[row][:, keep][:, :, keep] for a in attentions]
+        maps.append(torch.stack(layers).float().cpu().numpy())
+    return maps
+
+
+def save_maps(store_dir, ids, maps):
+    """Write raw maps to `attention-maps/<id>.npy` of a store."""
+    maps_dir = Path(store_dir) / MAPS_DIR
+    maps_dir.mkdir(exist_ok=True)
+    for i, m in zip(ids, maps):
+        np.save(maps_dir / f"{int(i)}.npy", m)
+
+
+def open_attention(store_dir, stat, mmap_mode="r"):
+    """(n x layers x heads) column of an attention statistic, memory-mapped."""
+    return np.load(Path(store_dir) / f"attention-{stat}.npy", mmap_mode=mmap_mode)
+
+
+def load_map(store_dir, row):
+    """(layers x heads x t x t) raw attention maps of a sampled example."""
+    return np.load(Path(store_dir) / MAPS_DIR / f"{int(row)}.npy")
+
+
+def attention_table(store_dir):
+    """All the attention statistics of a store as flat columns, one row per
+    (example, layer, head), e.g. for `pandas.DataFrame(attention_table(d))`."""
+    columns = {stat: open_attention(store_dir, stat) for stat in ATTENTION_STATS}
+    n, num_layers, num_heads = columns["entropy"].shape
+    example, layer, head = np.meshgrid(
+        np.arange(n), np.arange(num_layers), np.arange(num_heads), indexing="ij"
+    )
+    table = {"example": example.ravel(), "layer": layer.ravel(), "head": head.ravel()}
+    table.update({k: np.asarray(v).ravel() for k, v in columns.items()})
+    return table
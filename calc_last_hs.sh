@@ -1,5 +1,5 @@
-while read p;
-do
-	python3.8 inference_sentiment.py $p
-done < kenneth-hf-repos.txt
+#!/bin/bash
 
+# one process for all of the models, the dataset is tokenized once per
+# tokenizer and models with an existing store are skipped
+python3.8 extract_models.py kenneth-hf-repos.txt /home/weicheng/data_interns/alan/kd
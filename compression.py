@@ -0,0 +1,233 @@
+"""Compressed copies of activation stores for the k0 computations.
+
+The k0 scores only depend on the pairwise distances between the pooled
+activations, so the 768/1024-dimensional layers can be replaced by a few
+hundred dimensions that approximately preserve them: the top principal
+components of every layer (`pca`, fitted on the layer itself) or a Gaussian
+Johnson-Lindenstrauss random projection (`jl`, data independent, distances
+preserved within 1 +- eps with high probability for dim ~ log(n) / eps^2).
+Reading and multiplying the reduced vectors costs dim / hidden of the full
+ones.
+
+    python compression.py <store_dir> <out_dir> -method pca -dim 128
+
+writes a store with the same logits and labels and the reduced layers, and
+`compression.json` with, per layer, the projection, the largest row norm of
+the original activations (the normalization of `k0_dist.py`, which uses it
+instead of the norm of the reduced vectors) and the empirical distortion of
+the pairwise distances on a sample of points. The compressed store is used
+like any other with `-store`, and its provenance (and so the key of every
+cached artifact) includes the compression.
+"""
+
+import json
+import shutil
+import argparse
+import numpy as np
+from tqdm import tqdm
+from pathlib import Path
+from scipy.spatial.distance import pdist
+from artifact_cache import source_fingerprint
+from activation_store import (
+    max_row_norm,
+    open_layer,
+    read_meta,
+    read_provenance,
+    clear_meta,
+    write_meta,
+)
+
+METHODS = ("pca", "jl")
+COMPRESSION_FILE = "compression.json"
+
+
+def fit_pca(x, dim, chunk_rows=65536):
+    """Top principal components of the rows of x, from the covariance
+    accumulated `chunk_rows` rows at a time.
+    :return: (d,) mean, (d x dim) components and the fraction of the
+        variance they explain
+    """
+    n, d = x.shape
+    total = np.zeros(d)
+    second = np.zeros((d, d))
+    for start in range(0, n, chunk_rows):
+        chunk = np.asarray(x[start : start + chunk_rows], dtype=np.float64)
+        total += chunk.sum(0)
+        second += chunk.T @ chunk
+    mean = total / n
+    cov = second / n - np.outer(mean, mean)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    top = np.argsort(eigvals)[::-1][:dim]
+    explained = eigvals[top].sum() / max(eigvals.sum(), 1e-30)
+    return mean, eigvecs[:, top], float(explained)
+
+
+def jl_projection(d, dim, seed=0):
+    """(d x dim) Gaussian random projection, scaled so that squared
+    distances are preserved in expectation."""
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((d, dim)) / np.sqrt(dim)
+
+
+def project(x, mean, components, out, chunk_rows=65536):
+    """Write (x - mean) @ components into `out`, `chunk_rows` rows at a
+    time. Centering does not change the distances."""
+    for start in range(0, len(x), chunk_rows):
+        chunk = np.asarray(x[start : start + chunk_rows], dtype=np.float64)
+        out[start : start + len(chunk)] = (chunk - mean) @ components
+
+
+def distance_distortion(x, y, scale, sample_size=2000, seed=0):
+    """Compare the pairwise distances of a sample of points before (x) and
+    after (y) compression.
+    :param scale: normalizer of the distances (largest row norm of x), the
+        absolute errors are on the scale of the k0 deltas
+    :return: dict with the quantiles of the ratio of the reduced to the
+        original distances, and the max and mean absolute error of the
+        normalized distances
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(x), min(sample_size, len(x)), replace=False))
+    xs = np.asarray(x[sample], dtype=np.float64)
+    ys = np.asarray(y[sample], dtype=np.float64)
+    # distances of the pairs i < j, without materializing the pair differences
+    dx = pdist(xs)
+    dy = pdist(ys)
+    keep = dx > 0
+    ratio = dy[keep] / dx[keep]
+    error = np.abs(dy - dx) / scale
+    quantiles = (0.0, 0.01, 0.5, 0.99, 1.0)
+    return {
+        "pairs": int(len(dx)),
+        "ratio_quantiles": dict(
+            zip(map(str, quantiles), np.quantile(ratio, quantiles).tolist())
+        ),
+        "error_max": float(error.max()),
+        "error_mean": float(error.mean()),
+        "max_distance_ratio": float(dy.max() / max(dx.max(), 1e-30)),
+    }
+
+
+def compress_store(
+    store_dir,
+    out_dir,
+    method="pca",
+    dim=128,
+    layers=None,
+    sample_size=2000,
+    seed=0,
+):
+    """Write a store with the layers of `store_dir` reduced to `dim`
+    dimensions, nothing is done if it already exists with the same
+    provenance.
+    :param method: `pca` or `jl`
+    :param layers: layers to compress (default all)
+    :param sample_size: points on which the distortion is measured
+    :return: the per-layer report written to compression.json
+    """
+    if method not in METHODS:
+        raise ValueError(f"unknown method {method!r}, expected {METHODS}")
+    store_dir, out_dir = Path(store_dir), Path(out_dir)
+    meta = read_meta(store_dir)
+    if layers is None:
+        layers = range(meta["num_layers"])
+    compression = {"method": method, "dim": dim, "seed": seed}
+    compression["layers"] = sorted(layers)
+    provenance = {
+        "source": source_fingerprint(store_dir),
+        "compression": compression,
+    }
+    provenance = json.loads(json.dumps(provenance))
+    if read_provenance(out_dir) == provenance:
+        print(f"{out_dir} is up to date")
+        return json.load(open(out_dir / COMPRESSION_FILE))["layers"]
+    out_dir.mkdir(parents=True, exist_ok=True)
+    clear_meta(out_dir)
+    for name in ("logits.npy", "labels.npy"):
+        if (store_dir / name).exists():
+            shutil.copyfile(store_dir / name, out_dir / name)
+
+    report = {}
+    for layer in tqdm(compression["layers"], desc=f"{method} to {dim} dims"):
+        x = open_layer(store_dir, layer)
+        k = min(dim, x.shape[1])
+        entry = {}
+        if method == "pca":
+            mean, components, explained = fit_pca(x, k)
+            entry["explained_variance"] = explained
+        else:
+            mean = np.zeros(x.shape[1])
+            components = jl_projection(x.shape[1], k, seed + layer)
+        y = np.lib.format.open_memmap(
+            out_dir / f"L{layer}.npy", mode="w+", dtype=np.float32, shape=(len(x), k)
+        )
+        project(x, mean, components, y)
+        y.flush()
+        scale = max_row_norm(x)
+        entry.update(
+            {
+                "dim": k,
+                "original_dim": int(x.shape[1]),
+                "max_row_norm": float(scale),
+                "distortion": distance_distortion(x, y, scale, sample_size, seed),
+            }
+        )
+        report[str(layer)] = entry
+        del y
+    json.dump(
+        {"compression": compression, "layers": report},
+        open(out_dir / COMPRESSION_FILE, "w"),
+        indent=2,
+    )
+    write_meta(out_dir, meta["num_samples"], meta["num_layers"], provenance)
+    return report
+
+
+def layer_scale(store_dir, layer):
+    """Largest row norm of the original activations of a compressed layer,
+    None for a store that is not compressed."""
+    fname = Path(store_dir) / COMPRESSION_FILE
+    if not fname.exists():
+        return None
+    return json.load(open(fname))["layers"][str(layer)]["max_row_norm"]
+
+
+def print_distortion(report):
+    print("layer  dim    ratio p1   ratio p99  error max  error mean")
+    for layer, entry in report.items():
+        q = entry["distortion"]["ratio_quantiles"]
+        print(
+            f"{layer:>5}  {entry['dim']:>5}  {q['0.01']:.4f}     {q['0.99']:.4f}"
+            f"     {entry['distortion']['error_max']:.2e}"
+            f"   {entry['distortion']['error_mean']:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_dir", type=str, help="activation store")
+    parser.add_argument("out_dir", type=str, help="compressed store")
+    parser.add_argument("-method", type=str, default="pca", choices=METHODS)
+    parser.add_argument("-dim", type=int, default=128, help="reduced dimension")
+    parser.add_argument(
+        "-layers", type=int, nargs="+", default=None, help="layers (default all)"
+    )
+    parser.add_argument(
+        "-sample",
+        type=int,
+        default=2000,
+        help="points on which the distance distortion is measured",
+    )
+    parser.add_argument("-seed", type=int, default=0, help="seed")
+    options = parser.parse_args()
+    print_distortion(
+        compress_store(
+            options.store_dir,
+            options.out_dir,
+            options.method,
+            options.dim,
+            options.layers,
+            options.sample,
+            options.seed,
+        )
+    )
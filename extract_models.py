@@ -0,0 +1,184 @@
+"""Extract the activation stores of a list of models in a single process.
+
+    python extract_models.py kenneth-hf-repos.txt <out_dir>
+
+The dataset is loaded once, and tokenized once per tokenizer family (models
+whose tokenizers produce the same ids share the tokenized split). Every model
+gets its store in <out_dir>/<model>-store, named after the last part of its
+repository so `k0_dist.py <out_dir> <model> <layer>` finds it. Models whose
+store already exists with the same provenance (model revision, dataset,
+tokenizer, pooling, layers) are skipped. On the CPU, models run concurrently in
+worker processes with -threads torch threads each, as many at a time as the
+cores allow.
+"""
+
+import os
+import sys
+import hashlib
+import argparse
+import numpy as np
+import multiprocessing
+from pathlib import Path
+from datasets import load_dataset
+from transformers import AutoTokenizer
+from extraction import (
+    try_extract_job,
+    extraction_provenance,
+    is_current,
+    tokenizer_fingerprint,
+)
+
+SPLIT = "test[10000:] shuffled with seed 42"
+
+
+def load_split(dataset):
+    """The held-out part of the test split used by `inference_sentiment.py`."""
+    test_dataset = load_dataset(dataset)["test"]
+    shuffled_test = test_dataset.shuffle(seed=42)
+    return shuffled_test.select(range(10000, len(test_dataset)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", type=str, help="file with one model per line")
+    parser.add_argument("out_dir", type=str, help="directory of the stores")
+    parser.add_argument("-dataset", type=str, default="imdb", help="dataset")
+    parser.add_argument(
+        "-tokenizer",
+        type=str,
+        default=None,
+        help="tokenizer of every model (default: the model's own)",
+    )
+    parser.add_argument(
+        "-layers",
+        type=int,
+        nargs="+",
+        default=None,
+        help="hidden_states indices to store (default all)",
+    )
+    parser.add_argument(
+        "-pooling", type=str, default="mean", choices=["mean", "cls", "last"]
+    )
+    parser.add_argument(
+        "-max_tokens", type=int, default=8192, help="padded tokens per batch"
+    )
+    parser.add_argument(
+        "-dtype", type=str, default="float32", help="dtype of the stored layers"
+    )
+    parser.add_argument("-device", type=str, default="cpu", help="device")
+    parser.add_argument(
+        "-precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "int8", "bf16"],
+        help="run the models with dynamic int8 linear layers or bf16 autocast",
+    )
+    parser.add_argument(
+        "-fidelity_sample",
+        type=int,
+        default=256,
+        help="with -precision int8/bf16, compare against fp32 on this many "
+        "examples first (<out_dir>/<model>-store-fidelity.json, 0 to skip)",
+    )
+    parser.add_argument(
+        "-threads", type=int, default=4, help="torch threads per model on the CPU"
+    )
+    parser.add_argument(
+        "-concurrency",
+        type=int,
+        default=None,
+        help="models extracted at the same time (default: cores // threads "
+        "on the CPU, 1 otherwise)",
+    )
+    options = parser.parse_args()
+    if options.precision == "int8" and options.device != "cpu":
+        parser.error("-precision int8 runs on the CPU, use -device cpu")
+
+    out_dir = Path(options.out_dir)
+    models = [l.strip() for l in open(options.models) if l.strip()]
+    split = load_split(options.dataset)
+    tokenized = {}
+    jobs = []
+    for model_name in models:
+        store_dir = out_dir / f"{model_name.split('/')[-1]}-store"
+        tokenizer_name = options.tokenizer or model_name
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        if tokenizer.pad_token is None:
+            # GPT-2-style tokenizers, padded with eos like in `extract_job`
+            tokenizer.pad_token = tokenizer.eos_token
+        family = tokenizer_fingerprint(tokenizer)
+        # fingerprint the tokenized split gets, known before tokenizing
+        fingerprint = hashlib.sha1(f"{split._fingerprint}-{family}".encode())
+        fingerprint = fingerprint.hexdigest()
+        provenance = extraction_provenance(
+            model_name,
+            tokenizer,
+            fingerprint,
+            options.dataset,
+            SPLIT,
+            options.layers,
+            options.pooling,
+            options.dtype,
+            precision=options.precision,
+        )
+        if is_current(store_dir, provenance):
+            print(f"skipping {model_name}, {store_dir} is up to date")
+            continue
+        if family not in tokenized:
+            print(f"tokenizing {options.dataset} with {tokenizer_name}")
+            tokenized[family] = split.map(
+                lambda batch: tokenizer(batch["text"], truncation=True),
+                batched=True,
+                new_fingerprint=fingerprint,
+            )
+        jobs.append(
+            {
+                "model_name": model_name,
+                "tokenizer_name": tokenizer_name,
+                "encodings": tokenized[family],
+                "store_dir": store_dir,
+                "num_threads": options.threads,
+                "layers": options.layers,
+                "pooling": options.pooling,
+                "max_tokens": options.max_tokens,
+                "device": options.device,
+                "dtype": np.dtype(options.dtype),
+                "stop_early": False,
+                "provenance": provenance,
+                "precision": options.precision,
+                "fidelity_sample": options.fidelity_sample,
+            }
+        )
+    if not jobs:
+        return
+
+    concurrency = options.concurrency
+    if concurrency is None:
+        cpu = options.device == "cpu"
+        concurrency = max(1, os.cpu_count() // options.threads) if cpu else 1
+    concurrency = min(concurrency, len(jobs))
+    if concurrency == 1:
+        results = map(try_extract_job, jobs)
+    else:
+        # fresh interpreters, forked workers would inherit the parent's threads
+        pool = multiprocessing.get_context("spawn").Pool(concurrency)
+        results = pool.imap_unordered(try_extract_job, jobs)
+    # a failing model is reported, the other models still run
+    failed = []
+    for store_dir, error in results:
+        if error is None:
+            print(f"finished {store_dir}")
+        else:
+            print(f"failed {store_dir}\n{error}")
+            failed.append(store_dir)
+    if concurrency > 1:
+        pool.close()
+        pool.join()
+    if failed:
+        sys.exit(
+            f"{len(failed)} of {len(jobs)} models failed: {', '.join(map(str, failed))}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,734 @@
+"""Batching for the hidden-state extraction scripts.
+
+Padding the whole dataset to its longest example and running a fixed number
+of examples per batch spends most of the compute on padding tokens. Instead,
+examples are sorted by length and grouped into batches of at most
+`max_tokens` padded tokens, each padded only to its own longest example.
+Every batch comes with the original indices of its examples so the outputs
+can be put back in dataset order (`ActivationStoreWriter` does this when
+given the indices, `restore_order` for in-memory outputs).
+
+Masked pooling only looks at the real tokens, so the pooled activations are
+the same as with global padding.
+
+On CPU nodes, `sharded_extraction` splits the dataset into contiguous shards
+handled by a pool of worker processes, each with its own copy of the model
+and a fixed number of torch threads. Every shard is written to its own
+activation store, shards that are already complete are skipped when the
+extraction is restarted, and the finished shards are merged into a single
+store in dataset order.
+
+Stores record the provenance of their activations (model revision, dataset
+fingerprint and split, tokenizer, pooling, layers) in their meta.json. An
+extraction is skipped when the store already exists with the same
+provenance and redone otherwise, and the artifacts derived from a store are
+cached under its provenance (`artifact_cache.py`).
+
+For CPU runs the model can be run with dynamic int8 linear layers or under
+bf16 autocast (`precision`). `fidelity_report` runs a sample of the data in
+both fp32 and the reduced precision and compares the pooled activations and
+the k0 scores of `gpu_k0_dist.discontinuity_score_delta`, to decide per
+model whether the speedup is safe.
+
+`extract_to_store` is pipelined: a producer thread builds the padded (and,
+for GPU runs, pinned) batches, the main thread only copies them to the
+device and runs the model, and a writer thread moves the pooled layers to
+the host and appends them to the store. Bounded queues between the stages
+keep at most a few batches in flight, and the busy fraction of every stage
+is reported at the end, so a model stage below ~100% points at the stage
+that starves it.
+
+With `attention=True` the attention maps are reduced on the model thread to
+a few statistics per example, layer and head (`attention_stats.py`), stored
+as columns of the activation store; raw maps are only kept for the examples
+in `attention_sample`.
+"""
+
+import json
+import time
+import queue
+import shutil
+import threading
+import hashlib
+import traceback
+import contextlib
+import torch
+import numpy as np
+import multiprocessing
+from tqdm import tqdm
+from pathlib import Path
+from layer_capture import LayerCapture
+from attention_stats import (
+    MAPS_DIR,
+    attention_statistics,
+    model_attentions,
+    sampled_maps,
+    save_maps,
+)
+from activation_store import (
+    ActivationStoreWriter,
+    store_exists,
+    merge_stores,
+    read_provenance,
+)
+
+MODEL_INPUTS = ("input_ids", "attention_mask", "token_type_ids")
+PRECISIONS = ("fp32", "int8", "bf16")
+
+
+def token_budget_batches(lengths, max_tokens, max_batch_size=None):
+    """Group examples of similar length into batches.
+    :param lengths: (n,) number of tokens of every example
+    :param max_tokens: upper bound on batch size x longest example of the
+        batch (an example longer than that gets a batch of its own)
+    :param max_batch_size: upper bound on the number of examples per batch
+    :return: list of arrays with the indices of the examples of every batch,
+        longest first so running out of memory shows up right away
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(-lengths, kind="stable")
+    batches, start = [], 0
+    while start < len(order):
+        # sorted by decreasing length, the first example is the longest
+        size = max(1, max_tokens // max(int(lengths[order[start]]), 1))
+        if max_batch_size is not None:
+            size = min(size, max_batch_size)
+        batches.append(order[start : start + size])
+        start += size
+    return batches
+
+
+def padded_batches(encodings, tokenizer, max_tokens, max_batch_size=None):
+    """Iterate over unpadded encodings in token-budget batches.
+    :param encodings: tokenized `datasets.Dataset` with `input_ids`
+        and optionally `attention_mask`, `token_type_ids` and `label`
+    :param tokenizer: tokenizer used for padding
+    :return: iterator of (indices, batch), where batch holds the model inputs
+        padded to the longest example of the batch, and the `labels`
+    """
+    lengths = [len(v) for v in encodings["input_ids"]]
+    for indices in token_budget_batches(lengths, max_tokens, max_batch_size):
+        rows = encodings[[int(i) for i in indices]]
+        batch = tokenizer.pad(
+            {k: rows[k] for k in MODEL_INPUTS if k in rows}, return_tensors="pt"
+        )
+        batch = dict(batch)
+        if "label" in rows:
+            batch["labels"] = torch.LongTensor(rows["label"])
+        yield indices, batch
+
+
+def restore_order(indices, batches):
+    """Concatenate per-batch outputs and put them back in dataset order.
+    :param indices: list with the indices of every batch
+    :param batches: list with a tensor (or a list of tensors) per batch
+    :return: tensor (or list of tensors) with the rows in dataset order
+    """
+    order = torch.from_numpy(np.argsort(np.concatenate(indices)))
+    if isinstance(batches[0], (list, tuple)):
+        return [torch.cat(v)[order] for v in zip(*batches)]
+    return torch.cat(batches)[order]
+
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    """Raised in a background stage of `pipelined` once it is told to stop."""
+
+
+class _Stage(threading.Thread):
+    """Background stage of `pipelined`, keeps its busy time and any error."""
+
+    def __init__(self, target):
+        super().__init__(daemon=True)
+        self.target = target
+        self.busy = 0.0
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(self)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self.error = e
+
+
+def _check(stages, stop):
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+    if stop is not None and stop.is_set():
+        raise _Stopped
+
+
+def _put(q, item, stages, stop=None):
+    """Put into a bounded queue without hanging if a stage died or `stop`
+    is set."""
+    while True:
+        _check(stages, stop)
+        try:
+            return q.put(item, timeout=0.1)
+        except queue.Full:
+            continue
+
+
+def _get(q, stages, stop=None):
+    """Get from a queue without hanging if a stage died or `stop` is set."""
+    while True:
+        _check(stages, stop)
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+def pipelined(batches, run, write, queue_size=4, pin_memory=False):
+    """Run `run` on the main thread over batches built by a producer thread,
+    and hand its results over to a writer thread.
+    :param batches: iterable of (indices, batch), iterated on the producer
+        thread, where batch is a dict of CPU tensors
+    :param run: called with every (indices, batch) on the main thread
+    :param write: called with (indices, batch, result of `run`) on the
+        writer thread, in the order of the batches
+    :param queue_size: batches in flight between two stages
+    :param pin_memory: pin the batches so `run` can copy them to the GPU
+        asynchronously
+    :return: dict with the busy fraction of the `producer`, `model` and
+        `writer` stages, and the seconds the model waited for batches
+    :raise: the first error of any stage, after both threads are stopped
+    """
+    inputs, outputs = queue.Queue(queue_size), queue.Queue(queue_size)
+    # set when the pipeline is torn down, the threads then exit at their next
+    # put or get
+    stop = threading.Event()
+
+    def produce(stage):
+        iterator = iter(batches)
+        while True:
+            start = time.perf_counter()
+            item = next(iterator, _DONE)
+            if item is not _DONE and pin_memory:
+                indices, batch = item
+                item = indices, {k: v.pin_memory() for k, v in batch.items()}
+            stage.busy += time.perf_counter() - start
+            _put(inputs, item, [writer], stop)
+            if item is _DONE:
+                return
+
+    def consume(stage):
+        while True:
+            item = _get(outputs, [], stop)
+            if item is _DONE:
+                return
+            start = time.perf_counter()
+            write(*item)
+            stage.busy += time.perf_counter() - start
+
+    producer, writer = _Stage(produce), _Stage(consume)
+    wall = time.perf_counter()
+    producer.start()
+    writer.start()
+    busy = waiting = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            item = _get(inputs, [producer, writer])
+            waiting += time.perf_counter() - start
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            result = run(*item)
+            busy += time.perf_counter() - start
+            _put(outputs, item + (result,), [writer])
+        _put(outputs, _DONE, [writer])
+        writer.join()
+    finally:
+        # on an error the other stages are stopped instead of left blocked
+        stop.set()
+        producer.join()
+        writer.join()
+    for stage in (producer, writer):
+        if stage.error is not None:
+            raise stage.error
+    wall = time.perf_counter() - wall
+    return {
+        "producer": producer.busy / wall,
+        "model": busy / wall,
+        "writer": writer.busy / wall,
+        "model_wait": waiting,
+    }
+
+
+def quantize(model, precision, device="cpu"):
+    """Model to run in `precision`: a copy with dynamically quantized int8
+    linear layers (CPU only) for `int8`, the model itself otherwise (bf16 is
+    applied at run time by `autocast`)."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown precision {precision!r}, expected {PRECISIONS}")
+    if precision == "int8" and torch.device(device).type != "cpu":
+        raise ValueError(f"int8 dynamic quantization runs on the CPU, not {device}")
+    if precision == "int8":
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def autocast(precision, device):
+    """Context the forward passes run in for `precision`."""
+    if precision == "bf16":
+        return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of everything that decides the ids a tokenizer produces."""
+    if getattr(tokenizer, "is_fast", False):
+        spec = tokenizer.backend_tokenizer.to_str()
+    else:
+        spec = json.dumps(sorted(tokenizer.get_vocab().items()))
+    spec += f"{type(tokenizer).__name__}-{tokenizer.model_max_length}"
+    return hashlib.sha1(spec.encode()).hexdigest()
+
+
+def model_revision(model_name):
+    """Commit of the model in the local HuggingFace cache (the name itself
+    for local checkpoints)."""
+    from transformers import AutoConfig
+
+    config = AutoConfig.from_pretrained(model_name)
+    return getattr(config, "_commit_hash", None) or model_name
+
+
+def extraction_provenance(
+    model_name,
+    tokenizer,
+    dataset_fingerprint,
+    dataset,
+    split,
+    layers=None,
+    pooling="mean",
+    dtype=np.float32,
+    stop_early=False,
+    precision="fp32",
+    attention=False,
+    attention_sample=None,
+):
+    """Key fields of an extraction, recorded in the store it writes.
+    :param dataset_fingerprint: `_fingerprint` of the tokenized
+        `datasets.Dataset`, it changes with the data, the selection of the
+        split and the tokenization
+    :param dataset: name of the dataset
+    :param split: description of the split, e.g. `test[10000:]`
+    :param attention: whether attention statistics are stored, with the
+        raw maps of the examples in `attention_sample`
+    """
+    provenance = {
+        "model": model_name,
+        "revision": model_revision(model_name),
+        "dataset": dataset,
+        "split": split,
+        "dataset_fingerprint": dataset_fingerprint,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "pooling": pooling,
+        "layers": None if layers is None else sorted(layers),
+        "dtype": np.dtype(dtype).name,
+        "logits": not stop_early,
+        "precision": precision,
+        # the last layer is taken after the final layer norm, like hidden_states
+        "last_layer": "final_norm",
+    }
+    if attention:
+        # only recorded when set, so stores without attention stay current
+        provenance["attention"] = sorted(int(i) for i in attention_sample or [])
+    # as read back from meta.json
+    return json.loads(json.dumps(provenance))
+
+
+def is_current(store_dir, provenance=None):
+    """Whether the store is complete and, if a provenance is given, was
+    extracted with that provenance."""
+    if provenance is None:
+        return store_exists(store_dir)
+    return read_provenance(store_dir) == provenance
+
+
+def extract_to_store(
+    model,
+    tokenizer,
+    encodings,
+    store_dir,
+    layers=None,
+    pooling="mean",
+    max_tokens=8192,
+    device="cpu",
+    dtype=np.float32,
+    stop_early=False,
+    provenance=None,
+    precision="fp32",
+    attention=False,
+    attention_sample=None,
+):
+    """Run the model over the encodings and write the pooled layers, the
+    logits and the labels to an activation store in dataset order.
+    :param layers: `hidden_states` indices to store (default all)
+    :param stop_early: skip everything after the deepest stored layer, the
+        store then has no logits
+    :param provenance: from `extraction_provenance`, nothing is done if the
+        store already exists with the same provenance
+    :param precision: `fp32`, `int8` or `bf16`, see `quantize`
+    :param attention: also store the per-head attention statistics of
+        `attention_stats.attention_statistics`
+    :param attention_sample: indices of the examples whose raw attention
+        maps are stored
+    :return: stage utilization from `pipelined`, None if the store was
+        up to date
+    """
+    if provenance is not None and is_current(store_dir, provenance):
+        print(f"{store_dir} is up to date")
+        return
+    if attention and stop_early:
+        raise ValueError("attention statistics need the full forward")
+    writer = ActivationStoreWriter(store_dir, dtype, provenance)
+    shutil.rmtree(Path(store_dir) / MAPS_DIR, ignore_errors=True)
+    sample = set(int(i) for i in attention_sample or [])
+    special_ids = torch.LongTensor(sorted(tokenizer.all_special_ids)).to(device)
+    capture = LayerCapture(
+        quantize(model, precision, device), layers, pooling, stop_early
+    )
+    cuda = torch.device(device).type == "cuda"
+    progress = tqdm(desc=f"extracting {Path(store_dir).name}", unit="batch")
+
+    def run(indices, batch):
+        inputs = {k: v.to(device, non_blocking=cuda) for k, v in batch.items()}
+        with autocast(precision, device):
+            output, pooled = capture(**inputs, output_attentions=attention)
+        if not attention:
+            return None if output is None else output.logits, pooled, None
+        # reduced here so the maps are freed before the next batch
+        attentions = model_attentions(output)
+        mask = inputs["attention_mask"]
+        special = torch.isin(inputs["input_ids"], special_ids)
+        stats = attention_statistics(attentions, mask, special)
+        rows = [r for r, i in enumerate(indices) if int(i) in sample]
+        maps = sampled_maps(attentions, mask, rows)
+        stats["maps"] = [indices[r] for r in rows], maps
+        return output.logits, pooled, stats
+
+    def write(indices, batch, result):
+        logits, pooled, stats = result
+        extras = None
+        if stats is not None:
+            save_maps(store_dir, *stats.pop("maps"))
+            extras = {f"attention-{k}": v for k, v in stats.items()}
+        writer.append(logits, pooled, batch.get("labels"), indices, extras)
+        progress.update()
+
+    with torch.no_grad(), capture:
+        stats = pipelined(
+            padded_batches(encodings, tokenizer, max_tokens),
+            run,
+            write,
+            pin_memory=cuda,
+        )
+    progress.close()
+    writer.close()
+    print(
+        "stage utilization: "
+        + ", ".join(f"{k} {v:.0%}" for k, v in stats.items() if k != "model_wait")
+        + f", model waited {stats['model_wait']:.1f}s for batches"
+    )
+    return stats
+
+
+def pooled_activations(
+    model,
+    tokenizer,
+    encodings,
+    layers=None,
+    pooling="mean",
+    max_tokens=8192,
+    device="cpu",
+    precision="fp32",
+):
+    """In-memory version of `extract_to_store` for small samples.
+    :return: (n x num_labels) logits, the captured `hidden_states` indices
+        and the list of (n x hidden) pooled layers, in dataset order
+    """
+    capture = LayerCapture(quantize(model, precision, device), layers, pooling)
+    batch_indices, batch_logits, batch_pooled = [], [], []
+    with torch.no_grad(), capture:
+        for indices, batch in padded_batches(encodings, tokenizer, max_tokens):
+            batch = {k: v.to(device) for k, v in batch.items()}
+            with autocast(precision, device):
+                output, pooled = capture(**batch)
+            batch_indices.append(indices)
+            batch_logits.append(output.logits.float().cpu())
+            batch_pooled.append([v.float().cpu() for v in pooled])
+    return (
+        restore_order(batch_indices, batch_logits),
+        capture.layers,
+        restore_order(batch_indices, batch_pooled),
+    )
+
+
+def fidelity_report(
+    model,
+    tokenizer,
+    encodings,
+    precision,
+    sample_size=256,
+    layers=None,
+    pooling="mean",
+    max_tokens=8192,
+    device="cpu",
+    num_deltas=20,
+    seed=0,
+):
+    """Compare a reduced-precision extraction against fp32 on a sample.
+    :param encodings: tokenized `datasets.Dataset` with labels
+    :param precision: `int8` or `bf16`
+    :param sample_size: number of examples compared
+    :param num_deltas: deltas in (0, 1] on which the k0 scores are compared
+    :return: dict with the run times, and for every layer the max and mean
+        absolute deviation of the pooled activations (and the mean deviation
+        relative to their norm) and of the k0 scores
+    """
+    from gpu_k0_dist import (
+        cdist_l2,
+        discontinuity_score_delta,
+        predicted_probabilities,
+    )
+
+    rng = np.random.default_rng(seed)
+    size = min(sample_size, len(encodings))
+    sample = encodings.select(np.sort(rng.choice(len(encodings), size, False)))
+    labels = torch.LongTensor(sample["label"])
+    deltas = torch.linspace(0, 1, num_deltas + 1)[1:]
+
+    def k0_scores(x, logits):
+        # same normalization as the cached distances of `gpu_k0_dist.py`
+        pdist = cdist_l2(x, x)
+        pdist /= pdist.max()
+        probs = predicted_probabilities([(logits,)], labels).reshape(-1, 1)
+        ldist = torch.cdist(probs, probs, p=1)
+        return torch.stack(
+            [discontinuity_score_delta(pdist, ldist, d, "cpu") for d in deltas], 1
+        )
+
+    runs = {}
+    for p in ("fp32", precision):
+        start = time.perf_counter()
+        runs[p] = pooled_activations(
+            model, tokenizer, sample, layers, pooling, max_tokens, device, p
+        )
+        runs[p] += (time.perf_counter() - start,)
+    ref_logits, layer_ids, ref_pooled, ref_time = runs["fp32"]
+    logits, _, pooled, run_time = runs[precision]
+    report = {
+        "precision": precision,
+        "sample_size": size,
+        "fp32_seconds": ref_time,
+        "seconds": run_time,
+        "speedup": ref_time / run_time,
+        "logits_max": (logits - ref_logits).abs().max().item(),
+        "layers": [],
+    }
+    for layer, ref, x in zip(layer_ids, ref_pooled, pooled):
+        deviation = (x - ref).abs()
+        relative = (x - ref).norm(dim=1) / ref.norm(dim=1).clamp_min(1e-12)
+        k0_deviation = (k0_scores(x, logits) - k0_scores(ref, ref_logits)).abs()
+        report["layers"].append(
+            {
+                "layer": layer,
+                "activation_max": deviation.max().item(),
+                "activation_mean": deviation.mean().item(),
+                "activation_relative": relative.mean().item(),
+                "k0_max": k0_deviation.max().item(),
+                "k0_mean": k0_deviation.mean().item(),
+            }
+        )
+    return report
+
+
+def print_fidelity(report):
+    print(
+        f"{report['precision']} vs fp32 on {report['sample_size']} examples: "
+        f"{report['seconds']:.1f}s vs {report['fp32_seconds']:.1f}s "
+        f"({report['speedup']:.2f}x), max logit deviation {report['logits_max']:.2e}"
+    )
+    print("layer  act max    act mean   act rel    k0 max     k0 mean")
+    for l in report["layers"]:
+        print(
+            f"{l['layer']:>5}  {l['activation_max']:.2e}   {l['activation_mean']:.2e}"
+            f"   {l['activation_relative']:.2e}   {l['k0_max']:.2e}   {l['k0_mean']:.2e}"
+        )
+
+
+def extract_job(job):
+    """Load a model and extract its activations, in a worker process or not.
+    :param job: dict with the `model_name`, `tokenizer_name`, unpadded
+        `encodings`, `store_dir`, `num_threads` and the keyword arguments of
+        `extract_to_store`; with a `fidelity_sample` size, a reduced
+        precision is first compared against fp32 on that many examples
+        (written to `<store_dir>-fidelity.json`)
+    """
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+    torch.set_num_threads(job["num_threads"])
+    tokenizer = AutoTokenizer.from_pretrained(job["tokenizer_name"])
+    model = AutoModelForSequenceClassification.from_pretrained(job["model_name"])
+    if tokenizer.pad_token is None:
+        # GPT-2-style checkpoints have no padding token
+        tokenizer.pad_token = tokenizer.eos_token
+        model.config.pad_token_id = tokenizer.eos_token_id
+    model.eval()
+    model = model.to(job.get("device", "cpu"))
+    precision = job.get("precision", "fp32")
+    provenance = job.get("provenance")
+    # nothing to compare when the store is up to date
+    current = provenance is not None and is_current(job["store_dir"], provenance)
+    if precision != "fp32" and job.get("fidelity_sample") and not current:
+        report = fidelity_report(
+            model,
+            tokenizer,
+            job["encodings"],
+            precision,
+            job["fidelity_sample"],
+            job["layers"],
+            job["pooling"],
+            job["max_tokens"],
+            job.get("device", "cpu"),
+        )
+        print_fidelity(report)
+        store_dir = Path(job["store_dir"])
+        fname = store_dir.parent / f"{store_dir.name}-fidelity.json"
+        json.dump(report, open(fname, "w"), indent=2)
+    extract_to_store(
+        model,
+        tokenizer,
+        job["encodings"],
+        job["store_dir"],
+        job["layers"],
+        job["pooling"],
+        job["max_tokens"],
+        job.get("device", "cpu"),
+        job["dtype"],
+        job["stop_early"],
+        job.get("provenance"),
+        job.get("precision", "fp32"),
+        job.get("attention", False),
+        job.get("attention_sample"),
+    )
+    return job["store_dir"]
+
+
+def try_extract_job(job):
+    """`extract_job` that reports a failure instead of raising it, so one
+    failing job does not bring down the pool running the others.
+    :return: the store dir and the formatted traceback, None on success
+    """
+    try:
+        return extract_job(job), None
+    except Exception:
+        return job["store_dir"], traceback.format_exc()
+
+
+def sharded_extraction(
+    model_name,
+    tokenizer_name,
+    encodings,
+    store_dir,
+    num_workers,
+    num_threads=1,
+    num_shards=None,
+    layers=None,
+    pooling="mean",
+    max_tokens=8192,
+    dtype=np.float32,
+    stop_early=False,
+    keep_shards=False,
+    provenance=None,
+    precision="fp32",
+    attention=False,
+    attention_sample=None,
+):
+    """Extract the activations on the CPU with a pool of worker processes.
+    :param model_name: model every worker loads
+    :param tokenizer_name: tokenizer every worker loads
+    :param encodings: tokenized `datasets.Dataset`, unpadded
+    :param store_dir: store the shards are merged into, the shards are kept
+        in `<store_dir>-shards` until then
+    :param num_workers: number of worker processes
+    :param num_threads: torch threads of every worker
+    :param num_shards: number of shards (default 4 per worker), smaller
+        shards lose less work when the extraction is interrupted
+    :param keep_shards: keep the shard stores after merging
+    :param precision: `fp32`, `int8` or `bf16`, see `quantize`
+    :param attention: also store attention statistics, with the raw maps of
+        the examples in `attention_sample`, see `extract_to_store`
+    :param provenance: from `extraction_provenance`, shards (and the merged
+        store) with another provenance are extracted again
+    """
+    if is_current(store_dir, provenance):
+        return
+    store_dir = Path(store_dir)
+    shard_root = store_dir.parent / f"{store_dir.name}-shards"
+    num_shards = min(num_shards or 4 * num_workers, len(encodings))
+    bounds = np.linspace(0, len(encodings), num_shards + 1).astype(int)
+    shard_dirs = [shard_root / f"shard-{k:05d}" for k in range(num_shards)]
+    shard_provenance = [
+        (
+            None
+            if provenance is None
+            else {**provenance, "shard": [int(bounds[k]), int(bounds[k + 1])]}
+        )
+        for k in range(num_shards)
+    ]
+    jobs = [
+        {
+            "model_name": model_name,
+            "tokenizer_name": tokenizer_name,
+            "encodings": encodings.select(range(bounds[k], bounds[k + 1])),
+            "store_dir": shard_dirs[k],
+            "num_threads": num_threads,
+            "layers": layers,
+            "pooling": pooling,
+            "max_tokens": max_tokens,
+            "dtype": dtype,
+            "stop_early": stop_early,
+            "provenance": shard_provenance[k],
+            "precision": precision,
+            "attention": attention,
+            # shard-local indices, renumbered by `merge_stores`
+            "attention_sample": [
+                int(i) - int(bounds[k])
+                for i in attention_sample or []
+                if bounds[k] <= int(i) < bounds[k + 1]
+            ],
+        }
+        for k in range(num_shards)
+        if not is_current(shard_dirs[k], shard_provenance[k])
+    ]
+    print(f"{num_shards - len(jobs)} of {num_shards} shards already extracted")
+    # fresh interpreters, forked workers would inherit the parent's threads
+    failed = []
+    with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+        for shard_dir, error in pool.imap_unordered(try_extract_job, jobs):
+            if error is None:
+                print(f"finished {shard_dir}")
+            else:
+                print(f"failed {shard_dir}\n{error}")
+                failed.append(shard_dir)
+    if failed:
+        # the extracted shards are kept and skipped by the next run, only the
+        # failed ones are extracted again
+        raise RuntimeError(
+            f"{len(failed)} of {num_shards} shards failed, the others are kept "
+            f"in {shard_root}: {', '.join(str(d) for d in sorted(failed))}"
+        )
+    merge_stores(shard_dirs, store_dir, provenance)
+    if not keep_shards:
+        shutil.rmtree(shard_root)
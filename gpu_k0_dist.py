@@ -2,18 +2,37 @@ import os
 import sys
 import torch
 import pickle
+import argparse
+import functools
 import numpy as np
 from tqdm import tqdm
 from pathlib import Path
 from scipy.spatial.distance import cdist
 from concurrent import futures
+from k0_index import (
+    K0Curves,
+    save_k0_curves,
+    load_k0_curves,
+    curve_scores,
+    streaming_k0_scores,
+    streaming_max_distance,
+)
+from artifact_cache import ArtifactCache, file_fingerprint, source_fingerprint
+from activation_store import (
+    store_exists,
+    export_pickled_activations,
+    open_layer,
+    open_logits,
+    open_labels,
+)
+
+DEFAULT_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 
 @torch.no_grad()
 def cdist_l2(x1, x2):
     x1_norm = x1.pow(2).sum(dim=-1, keepdim=True)
     x2_norm = x2.pow(2).sum(dim=-1, keepdim=True)
-    print(x1_norm.shape, x2_norm.shape, x1.shape, x2.shape)
     res = torch.addmm(
         x2_norm.transpose(-2, -1), x1, x2.transpose(-2, -1), alpha=-2
     ).add_(x1_norm)
@@ -22,28 +41,29 @@ def cdist_l2(x1, x2):
 
 
 @torch.no_grad()
-def compute_cdist_layer(x, fname):
+def compute_cdist_layer(x, fname, device=DEFAULT_DEVICE):
     """For a given layer, compute the pairwise distance between all points
     in that layer, and return this as a matrix.
     :param x: (n x d) vectors from the hidden layer
     :param fname: storage filename
     """
-    x = x.to("cuda")
+    x = x.to(device)
     bcdist = cdist_l2(x, x)
     torch.save((bcdist / torch.max(bcdist)).cpu(), fname)
 
 
-def precompute_pdistance(activations, cache_dir, name):
+def layer_activations(activations, layer):
+    """Concatenate the activations of a single layer across all batches."""
+    return torch.cat([v[layer] for v in activations])
+
+
+def precompute_pdistance(activations, cache_dir, name, device=DEFAULT_DEVICE):
     """Compute the pairwise distance between activations
     for each layer, then store in `fname` (Path obj.)"""
-    acts = []
-    for i in range(len(activations[0])):
-        layer_act = []
-        for v in activations:
-            layer_act.append(v[i])
-        acts.append(torch.cat(layer_act))
-    for i, act in tqdm(enumerate(acts)):
-        compute_cdist_layer(act, cache_dir / f"{name}-{i+1}.pth")
+    for i in tqdm(range(len(activations[0]))):
+        compute_cdist_layer(
+            layer_activations(activations, i), cache_dir / f"{name}-{i+1}.pth", device
+        )
 
 
 @torch.no_grad()
@@ -56,7 +76,7 @@ def precompute_performance(performance, cache_dir, name):
 
 
 @torch.no_grad()
-def discontinuity_score_delta(pdistance, ldistance, delta):
+def discontinuity_score_delta(pdistance, ldistance, delta, device=DEFAULT_DEVICE):
     """Given the pairwise distance between points, the pairwise L1
     distance between the performance, and the delta values find the
     discontinuity score of each point with respect to a delta ball
@@ -64,23 +84,340 @@ def discontinuity_score_delta(pdistance, ldistance, delta):
 
     :return: nx1 vector with the point score.
     """
-    ldistance = ldistance.to("cuda")
-    pdistance = pdistance.to("cuda")
+    ldistance = ldistance.to(device)
+    pdistance = pdistance.to(device)
     in_delta_ball = torch.where(
-        pdistance < delta, ldistance, torch.zeros(ldistance.shape).to("cuda")
+        pdistance < delta, ldistance, torch.zeros(ldistance.shape).to(device)
     )
     point_score = in_delta_ball / (1 + pdistance)
     return torch.mean(point_score, axis=1)
 
 
+def block_rows(n, num_deltas, memory_budget, row_vectors=6):
+    """Number of rows of the n x n distance matrix that fit in
+    `memory_budget` bytes together with the per-row delta histograms.
+    Each row holds ~`row_vectors` n-vectors (distances, loss distances,
+    bucket ids and temporaries of the GEMM) plus two (num_deltas + 1)-vectors."""
+    row_bytes = 4 * (row_vectors * n + 2 * (num_deltas + 1))
+    return int(max(1, min(n, memory_budget // row_bytes)))
+
+
+@torch.no_grad()
+def max_pairwise_distance(x, block_size):
+    """Largest pairwise distance between the rows of x, one row block at a
+    time."""
+    largest = 0.0
+    for start in range(0, len(x), block_size):
+        largest = max(largest, cdist_l2(x[start : start + block_size], x).max().item())
+    return largest
+
+
+@torch.no_grad()
+def blocked_discontinuity_scores(
+    x, performance, deltas, memory_budget=2**30, device=DEFAULT_DEVICE
+):
+    """Compute `discontinuity_score_delta` for every delta in `deltas` at
+    once without materializing the n x n distance matrices. Row blocks of
+    the distance matrix are computed with `cdist_l2`, normalized by the
+    largest pairwise distance, and every pair's |l_i - l_j| / (1 + d_ij) is
+    added to the histogram bin of the smallest delta whose ball contains it.
+    A cumulative sum over the bins then gives the score for every delta.
+
+    :param x: (n x d) vectors from the hidden layer
+    :param performance: (n,) performance of each point
+    :param deltas: sequence of deltas
+    :param memory_budget: bytes available for a single row block
+    :return: (n x len(deltas)) point scores on the cpu
+    """
+    x = x.to(device, torch.float32)
+    performance = performance.reshape(-1).to(device, torch.float32)
+    deltas = torch.as_tensor(deltas, dtype=torch.float32, device=device)
+    sorted_deltas, order = torch.sort(deltas)
+    n, num_deltas = len(x), len(deltas)
+
+    block_size = block_rows(n, num_deltas, memory_budget)
+    normalizer = max_pairwise_distance(x, block_size)
+    scores = torch.empty(n, num_deltas)
+    for start in tqdm(range(0, n, block_size), desc="row blocks"):
+        end = min(start + block_size, n)
+        pdistance = cdist_l2(x[start:end], x).div_(normalizer)
+        point_score = (
+            (performance[start:end, None] - performance[None])
+            .abs_()
+            .div_(1 + pdistance)
+        )
+        # pdistance < sorted_deltas[k] exactly when k >= bucket
+        bucket = torch.bucketize(pdistance, sorted_deltas, right=True)
+        del pdistance
+        hist = torch.zeros(end - start, num_deltas + 1, device=device)
+        hist.scatter_add_(1, bucket, point_score)
+        del bucket, point_score
+        scores[start:end, order] = (hist.cumsum_(1)[:, :num_deltas] / n).cpu()
+    return scores
+
+
 @torch.no_grad()
-def discontinuity_tf_eps(point_scores, eps):
+def exact_discontinuity_curves(
+    x, performance, max_delta, memory_budget=2**30, device=DEFAULT_DEVICE
+):
+    """The score of a point only changes at its own pairwise distances, so
+    instead of evaluating `discontinuity_score_delta` on a grid we store, for
+    every point, its sorted distances below `max_delta` (the breakpoints) and
+    the cumulative sum of |l_i - l_j| / (1 + d_ij) at each of them. Any
+    delta <= `max_delta` can then be evaluated exactly with `curve_scores`.
+
+    :param x: (n x d) vectors from the hidden layer
+    :param performance: (n,) performance of each point
+    :param max_delta: largest delta that can be queried
+    :param memory_budget: bytes available for a single row block
+    :return: `K0Curves`
+    """
+    x = x.to(device, torch.float32)
+    performance = performance.reshape(-1).to(device, torch.float64)
+    n = len(x)
+
+    # sorting keeps values, int64 indices and a float64 running sum per row
+    block_size = block_rows(n, 0, memory_budget, row_vectors=10)
+    normalizer = max_pairwise_distance(x, block_size)
+    counts, breakpoints, cumsums = [], [], []
+    for start in tqdm(range(0, n, block_size), desc="row blocks"):
+        end = min(start + block_size, n)
+        pdistance, order = torch.sort(cdist_l2(x[start:end], x).div_(normalizer), 1)
+        point_score = (performance[start:end, None] - performance[order]).abs_()
+        point_score = point_score.div_(1 + pdistance).cumsum_(1)
+        inside = pdistance < max_delta
+        counts.append(inside.sum(1).cpu())
+        breakpoints.append(pdistance[inside].cpu())
+        cumsums.append(point_score[inside].float().cpu())
+        del pdistance, order, point_score, inside
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = torch.cat(counts).cumsum(0).numpy()
+    return K0Curves(
+        indptr,
+        torch.cat(breakpoints).numpy(),
+        torch.cat(cumsums).numpy(),
+        n,
+        float(max_delta),
+    )
+
+
+@torch.no_grad()
+def select_pivots(x, num_pivots, seed=0):
+    """Farthest-first traversal: start from a random point and repeatedly
+    add the point farthest away from all pivots chosen so far.
+    :return: indices of the pivots
+    """
+    generator = torch.Generator().manual_seed(seed)
+    pivots = [int(torch.randint(len(x), (1,), generator=generator))]
+    closest = cdist_l2(x, x[pivots[-1] :][:1]).squeeze(1)
+    for _ in range(num_pivots - 1):
+        pivots.append(int(torch.argmax(closest)))
+        closest = torch.minimum(closest, cdist_l2(x, x[pivots[-1] :][:1]).squeeze(1))
+    return torch.tensor(pivots, device=x.device)
+
+
+def pivot_tile_size(dim, memory_budget, max_tile=1024):
+    """Side length of the square tiles of `pivot_discontinuity_curves` so
+    that the two (t x dim) blocks of activations gathered for a tile, its
+    (t x t) distances and the int64 indices of the pairs inside the ball fit
+    in `memory_budget` bytes. Tiles are capped at `max_tile` points, smaller
+    tiles have tighter bounds."""
+    # solve 32 t^2 + 8 dim t <= memory_budget
+    b = 8 * dim
+    t = (-b + np.sqrt(b * b + 128 * memory_budget)) / 64
+    return int(max(1, min(t, max_tile)))
+
+
+@torch.no_grad()
+def pivot_tiles(x, num_pivots, tile_size):
+    """Sort the points by their closest pivot, then by their distance to it,
+    and cut this order into tiles of `tile_size` consecutive points, so that
+    the points of a tile are close to each other.
+    :return: (n,) order of the points, and the (tiles x pivots) smallest and
+        largest distance between the points of every tile and every pivot
+    """
+    pivot_dist = cdist_l2(x, x[select_pivots(x, num_pivots)])
+    closest, assign = pivot_dist.min(1)
+    order = torch.argsort(closest, stable=True)
+    order = order[torch.argsort(assign[order], stable=True)]
+    low, high = [], []
+    for start in range(0, len(x), tile_size):
+        tile_dist = pivot_dist[order[start : start + tile_size]]
+        low.append(tile_dist.amin(0))
+        high.append(tile_dist.amax(0))
+    return order, torch.stack(low), torch.stack(high)
+
+
+@torch.no_grad()
+def pivot_max_distance(x, order, low, high, tile_size):
+    """Largest pairwise distance, only computing the pairs of tiles whose
+    triangle inequality upper bound min_p (max_i d_ip + max_j d_jp) exceeds
+    the largest distance found so far (which starts at the largest
+    point-to-pivot distance)."""
+    largest = high.max().item()
+    for a in range(len(low)):
+        rows = x[order[a * tile_size : (a + 1) * tile_size]]
+        # the distances are symmetric, only the tiles from a onwards are needed
+        upper = (high[a] + high[a:]).amin(-1)
+        for b in torch.argsort(upper, descending=True).tolist():
+            if upper[b] <= largest:
+                break
+            cols = x[order[(a + b) * tile_size : (a + b + 1) * tile_size]]
+            largest = max(largest, cdist_l2(rows, cols).max().item())
+    return largest
+
+
+@torch.no_grad()
+def pivot_discontinuity_curves(
+    x,
+    performance,
+    max_delta,
+    num_pivots=16,
+    memory_budget=2**30,
+    device=DEFAULT_DEVICE,
+    tolerance=1e-5,
+    deltas=None,
+):
+    """`exact_discontinuity_curves` with triangle inequality pruning. The
+    points are cut into compact tiles (`pivot_tiles`). For two tiles, the
+    largest gap over the pivots between the ranges of their distances to
+    the pivot is a lower bound on the distance of every pair they form, so a
+    pair of tiles whose bound is at least `max_delta` holds no breakpoint
+    and is never computed. The other pairs of tiles are computed with
+    `cdist_l2`, like the dense and blocked paths.
+
+    :param x: (n x d) vectors from the hidden layer
+    :param performance: (n,) performance of each point
+    :param max_delta: largest delta that can be queried, the smaller it is
+        the more tiles are pruned
+    :param num_pivots: number of pivot activations
+    :param memory_budget: bytes available for a single tile, the curves
+        themselves are not included
+    :param tolerance: relative slack on the bounds against rounding
+    :param deltas: deltas of the grid, the pairs the bounds exclude are also
+        counted for each of them up to `max_delta`
+    :return: `K0Curves`, and a dict with the number of `pairs`, of the
+        pairwise distances `evaluated`, and of the pairs `pruned` at every
+        delta of `deltas` <= `max_delta`
+    """
+    x = x.to(device, torch.float32)
+    performance = performance.reshape(-1).to(device, torch.float64)
+    n = len(x)
+    deltas = [] if deltas is None else [float(d) for d in deltas]
+    deltas = [d for d in deltas if d <= max_delta]
+    stats = {"pairs": n * n, "evaluated": 0, "max_delta": max_delta}
+    stats["deltas"] = deltas
+    if max_delta <= 0:
+        # no pair is closer than 0, the curves are empty
+        stats["pruned"] = [n * n] * len(deltas)
+        curves = K0Curves(
+            np.zeros(n + 1, dtype=np.int64),
+            np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=np.float32),
+            n,
+            float(max_delta),
+        )
+        return curves, stats
+
+    tile_size = pivot_tile_size(x.shape[1], memory_budget)
+    order, low, high = pivot_tiles(x, num_pivots, tile_size)
+    normalizer = pivot_max_distance(x, order, low, high, tile_size)
+    radius = max_delta * normalizer * (1 + tolerance)
+    delta_radii = torch.tensor(deltas, device=device) * normalizer * (1 + tolerance)
+    tile_sizes = torch.bincount(
+        torch.arange(n, device=device) // tile_size, minlength=len(low)
+    )
+    pruned = torch.zeros(len(deltas), dtype=torch.int64, device=device)
+    points, breakpoints, cumsums = [], [], []
+    for a in tqdm(range(len(low)), desc="row tiles"):
+        rows = order[a * tile_size : (a + 1) * tile_size]
+        x_rows = x[rows]
+        lower = torch.maximum(low[a] - high, low - high[a]).clamp_min_(0).amax(-1)
+        # pairs of tiles excluded by the bound at every delta of the grid
+        excluded = lower[None] >= delta_radii[:, None]
+        pruned += len(rows) * (excluded * tile_sizes).sum(1)
+        tile_rows, tile_cols, tile_dists = [], [], []
+        for b in torch.nonzero(lower < radius).flatten().tolist():
+            cols = order[b * tile_size : (b + 1) * tile_size]
+            pdistance = cdist_l2(x_rows, x[cols]).div_(normalizer)
+            stats["evaluated"] += pdistance.numel()
+            r, c = torch.nonzero(pdistance < max_delta, as_tuple=True)
+            tile_rows.append(r)
+            tile_cols.append(cols[c])
+            tile_dists.append(pdistance[r, c])
+            del pdistance
+        r, c, pdistance = map(torch.cat, (tile_rows, tile_cols, tile_dists))
+        # sorted by row, then by distance
+        sort = torch.argsort(pdistance, stable=True)
+        sort = sort[torch.argsort(r[sort], stable=True)]
+        r, c, pdistance = r[sort], c[sort], pdistance[sort]
+        point_score = (performance[rows[r]] - performance[c]).abs_()
+        point_score = point_score.div_(1 + pdistance).cumsum_(0)
+        # restart the running sum at the first neighbor of every row
+        counts = torch.bincount(r, minlength=len(rows))
+        starts = counts.cumsum(0) - counts
+        before = torch.cat([point_score.new_zeros(1), point_score])[starts]
+        point_score -= before.repeat_interleave(counts)
+        points.append(rows[r])
+        breakpoints.append(pdistance)
+        cumsums.append(point_score.float())
+    points, breakpoints, cumsums = map(torch.cat, (points, breakpoints, cumsums))
+    # back to the original order of the points, stable so rows stay sorted
+    sort = torch.argsort(points, stable=True)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = torch.bincount(points, minlength=n).cumsum(0).cpu().numpy()
+    curves = K0Curves(
+        indptr,
+        breakpoints[sort].cpu().numpy(),
+        cumsums[sort].cpu().numpy(),
+        n,
+        float(max_delta),
+    )
+    stats["pruned"] = pruned.tolist()
+    return curves, stats
+
+
+def stored_layers(store_dir):
+    """Sorted indices of the layers with scores in `store_dir`, a layer
+    stored both as exact curves and as a dense grid counts once."""
+    return sorted(
+        {int(f.stem[1:]) for f in Path(store_dir).glob("L*") if f.stem[1:].isdigit()}
+    )
+
+
+def load_layer_scores(store_dir, layer, deltas, grid_columns=None):
+    """Point scores of a layer for each of `deltas`, read from either the
+    exact curves (`L{layer}.npz`) or the dense 1000-delta grid (`L{layer}.pth`).
+    Deltas beyond the truncation of the exact curves are returned as None.
+    :param grid_columns: columns of the dense grid read for the deltas, by
+        default the grid point closest to each delta
+    :return: list with an (n,) tensor (or None) per delta
+    """
+    curves_file = Path(store_dir) / f"L{layer}.npz"
+    if curves_file.exists():
+        curves = load_k0_curves(curves_file)
+        deltas = np.asarray(deltas)
+        valid = deltas <= curves.max_delta
+        scores = curve_scores(curves, deltas[valid])
+        out, j = [], 0
+        for v in valid:
+            out.append(torch.from_numpy(scores[:, j]) if v else None)
+            j += v
+        return out
+    disconts = torch.load(Path(store_dir) / f"L{layer}.pth")
+    if grid_columns is None:
+        grid_columns = [int(round(float(d) * (len(disconts) - 1))) for d in deltas]
+    return [disconts[i].cpu() for i in grid_columns]
+
+
+@torch.no_grad()
+def discontinuity_tf_eps(point_scores, eps, device=DEFAULT_DEVICE):
     return (
         torch.nonzero(
             torch.where(
                 point_scores >= eps,
-                torch.ones(point_scores.shape).to("cuda"),
-                torch.zeros(point_scores.shape).to("cuda"),
+                torch.ones(point_scores.shape).to(device),
+                torch.zeros(point_scores.shape).to(device),
             )
         )
         .cpu()
@@ -88,52 +425,236 @@ def discontinuity_tf_eps(point_scores, eps):
     )
 
 
+def predicted_probabilities(activations, labels):
+    """Probability the model assigns to the correct label of every point."""
+    logits = torch.cat([v[0] for v in activations])  # load all of the logits
+
+    # apply softmax to the logits to get raw probabilities
+    def softmax(x):
+        return torch.exp(x) / torch.sum(torch.exp(x), axis=1).reshape(-1, 1)
+
+    # we only care about the probabilites that correspond to the correct label
+    return softmax(logits)[torch.arange(len(logits)), labels]
+
+
+def store_layer(store_dir, layer, labels_file):
+    """Activations of a layer and the predicted probability of the correct
+    label of every point, read from an activation store.
+    :param labels_file: pickled labels, used when the store holds none
+    """
+    labels = open_labels(store_dir)
+    if labels is None:
+        labels = pickle.load(open(labels_file, "rb"))
+    labels = torch.as_tensor(np.asarray(labels, dtype=np.int64))
+    logits = torch.from_numpy(np.array(open_logits(store_dir)))
+    # copy-on-write mapping, torch does not wrap read-only buffers
+    x = torch.from_numpy(open_layer(store_dir, layer, mmap_mode="c"))
+    return x, predicted_probabilities([(logits,)], labels)
+
+
 def main():
-    DATA_DIR = Path(sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", type=str, help="directory with the data")
+    parser.add_argument("model_name", type=str, help="name of the model")
+    parser.add_argument("layer_index", type=int, nargs="?", help="hidden layer")
+    parser.add_argument(
+        "-device", type=str, default=DEFAULT_DEVICE, help="device to compute on"
+    )
+    parser.add_argument(
+        "-memory_budget",
+        type=float,
+        default=None,
+        help="compute the scores block by block with at most this many MB "
+        "per block instead of caching the full distance matrices",
+    )
+    parser.add_argument(
+        "-exact_max_delta",
+        type=float,
+        default=None,
+        help="with -memory_budget or -pivots, store the exact piecewise-constant "
+        "curves up to this delta (L{layer}.npz) instead of the 1000-delta grid",
+    )
+    parser.add_argument(
+        "-stream",
+        action="store_true",
+        help="read the layer from a memory-mapped activation store tile by "
+        "tile, with peak memory bounded by -memory_budget (default 1024 MB)",
+    )
+    parser.add_argument(
+        "-store",
+        type=str,
+        default=None,
+        help="activation store directory, e.g. a compressed store written by "
+        "compression.py (default: <data_dir>/sentiment-analysis/<model_name>-store)",
+    )
+    parser.add_argument(
+        "-pivots",
+        type=int,
+        default=None,
+        help="compute the exact curves up to -exact_max_delta (required) with "
+        "this many pivots, skipping the pairs of tiles that triangle inequality "
+        "bounds place beyond it, and report the pruned distance evaluations",
+    )
+    parser.add_argument(
+        "-cache",
+        type=str,
+        default=None,
+        help="artifact cache of the distance matrices (default: "
+        "<data_dir>/artifact-cache)",
+    )
+    parser.add_argument(
+        "-cache_quota",
+        type=float,
+        default=None,
+        help="evict the least recently used artifacts beyond this many GB",
+    )
+    options = parser.parse_args()
+    if options.pivots is not None and options.exact_max_delta is None:
+        # with the 1000-delta grid up to 1 every pair is inside a ball
+        parser.error("-pivots prunes against -exact_max_delta, which is required")
+
+    DATA_DIR = Path(options.data_dir)
     SENT_DIR = DATA_DIR / "sentiment-analysis"
-    MODEL_NAME = sys.argv[2]
-    CACHE_DIR = DATA_DIR / "dist-cache" / f"{MODEL_NAME}-cdist"
+    MODEL_NAME = options.model_name
     DIST_DIR = DATA_DIR / "discontinuities"
 
-    LAYER_INDEX = None if len(sys.argv) < 4 else int(sys.argv[3])
+    LAYER_INDEX = options.layer_index
     DIST_LAYER_STORE = DIST_DIR / MODEL_NAME
+    deltas = torch.linspace(0, 1, 1000)
 
     print(f"Model: {MODEL_NAME}; Layer: {LAYER_INDEX + 1}")
-    if not os.path.isdir(CACHE_DIR):  # if no cache then pre-compute distances
-        os.mkdir(CACHE_DIR)
-        print(f"{CACHE_DIR} created.")
+    store_dir = (
+        Path(options.store) if options.store else SENT_DIR / f"{MODEL_NAME}-store"
+    )
+    if options.stream and not store_exists(store_dir):
+        print(f"exporting activations to {store_dir}")
+        export_pickled_activations(
+            pickle.load(open(SENT_DIR / f"{MODEL_NAME}-k0.pkl", "rb")), store_dir
+        )
 
-        # load all activations
+    @functools.lru_cache(maxsize=None)
+    def load_inputs():
+        """Activations of the layer and predicted probabilities."""
+        if store_exists(store_dir):
+            # the layer stays memory-mapped, only the logits are read
+            return store_layer(store_dir, LAYER_INDEX, SENT_DIR / "labels.pkl")
         activations = pickle.load(open(SENT_DIR / f"{MODEL_NAME}-k0.pkl", "rb"))
+        labels = pickle.load(open(SENT_DIR / "labels.pkl", "rb"))
+        x = layer_activations(activations, LAYER_INDEX)
+        return x, predicted_probabilities(activations, labels)
 
-        print(len(activations))
-        print(len(activations[0]))
-
-        precompute_pdistance(activations, CACHE_DIR, f"{MODEL_NAME}-cdist")
+    blocked = options.memory_budget is not None or options.pivots is not None
+    if options.stream or blocked:
+        x, predicted_probs = load_inputs()
 
-        # load the labels
-        labels = pickle.load(open(SENT_DIR / "labels.pkl", "rb"))
-        logits = torch.cat([v[0] for v in activations])  # load all of the logits
+    if options.stream:
+        memory_budget = int((options.memory_budget or 1024) * 2**20)
+        x = x.numpy()
+        # first pass finds the largest pairwise distance, second the scores
+        scores = streaming_k0_scores(
+            x,
+            predicted_probs.numpy(),
+            deltas.numpy(),
+            memory_budget,
+            scale=streaming_max_distance(x, memory_budget),
+            mean_over_ball=False,
+        )
+        os.makedirs(DIST_LAYER_STORE, exist_ok=True)
+        torch.save(
+            list(torch.from_numpy(scores).float().T),
+            DIST_LAYER_STORE / f"L{LAYER_INDEX}.pth",
+        )
+        return
 
-        # apply softmax to the logits to get raw probabilities
-        def softmax(x):
-            return torch.exp(x) / torch.sum(torch.exp(x), axis=1).reshape(-1, 1)
+    if options.pivots is not None:
+        curves, stats = pivot_discontinuity_curves(
+            x,
+            predicted_probs,
+            options.exact_max_delta,
+            options.pivots,
+            int((options.memory_budget or 1024) * 2**20),
+            options.device,
+            deltas=deltas.tolist(),
+        )
+        print(
+            f"evaluated {stats['evaluated']} of {stats['pairs']} pairwise distances "
+            f"({1 - stats['evaluated'] / stats['pairs']:.2%} pruned)"
+        )
+        for delta, pruned in list(zip(stats["deltas"], stats["pruned"]))[::100]:
+            print(
+                f"delta {delta:.3f}: {pruned / stats['pairs']:.2%} of the pairs pruned"
+            )
+        os.makedirs(DIST_LAYER_STORE, exist_ok=True)
+        save_k0_curves(curves, DIST_LAYER_STORE / f"L{LAYER_INDEX}.npz")
+        # totals and pairs pruned per delta, kept outside of DIST_LAYER_STORE,
+        # which must only hold one file per layer
+        pruning_dir = DIST_DIR / "pruning" / MODEL_NAME
+        os.makedirs(pruning_dir, exist_ok=True)
+        torch.save(stats, pruning_dir / f"L{LAYER_INDEX}.pth")
+        return
 
-        # we only care about the probabilites that correspond to the correct label
-        predicted_probs = softmax(logits)[torch.arange(len(logits)), labels]
-        precompute_performance(predicted_probs.reshape(-1, 1), CACHE_DIR, MODEL_NAME)
-        sys.exit(0)
+    if options.memory_budget is not None:
+        # blocked computation straight from the activations, no cache needed
+        memory_budget = int(options.memory_budget * 2**20)
+        os.makedirs(DIST_LAYER_STORE, exist_ok=True)
+        if options.exact_max_delta is not None:
+            curves = exact_discontinuity_curves(
+                x,
+                predicted_probs,
+                options.exact_max_delta,
+                memory_budget,
+                options.device,
+            )
+            save_k0_curves(curves, DIST_LAYER_STORE / f"L{LAYER_INDEX}.npz")
+            return
+        scores = blocked_discontinuity_scores(
+            x, predicted_probs, deltas, memory_budget, options.device
+        )
+        torch.save(list(scores.T), DIST_LAYER_STORE / f"L{LAYER_INDEX}.pth")
+        return
 
-    # load all euclidean distances from the cached file
-    if not os.path.isdir(DIST_LAYER_STORE):
-        os.mkdir(DIST_LAYER_STORE)
+    # distance matrices are cached under the provenance of the activations,
+    # built atomically and evicted least recently used first
+    cache = ArtifactCache(
+        Path(options.cache) if options.cache else DATA_DIR / "artifact-cache",
+        None if options.cache_quota is None else int(options.cache_quota * 2**30),
+    )
+    source = source_fingerprint(store_dir, SENT_DIR / f"{MODEL_NAME}-k0.pkl")
+    cdist_entry = cache.get_or_build(
+        {
+            "artifact": "cdist",
+            "source": source,
+            "layer": LAYER_INDEX,
+            "metric": "l2",
+            "normalization": "max",
+        },
+        lambda d: compute_cdist_layer(
+            load_inputs()[0], d / "cdist.pth", options.device
+        ),
+    )
+    if (store_dir / "labels.npy").exists() and store_exists(store_dir):
+        labels_source = "store"
+    else:
+        labels_source = file_fingerprint(SENT_DIR / "labels.pkl")
+    label_entry = cache.get_or_build(
+        {
+            "artifact": "label-dist",
+            "source": source,
+            "labels": labels_source,
+            "metric": "l1",
+        },
+        lambda d: precompute_performance(
+            load_inputs()[1].reshape(-1, 1), d, "performance"
+        ),
+    )
+    os.makedirs(DIST_LAYER_STORE, exist_ok=True)
 
-    pdist = torch.load(CACHE_DIR / f"{MODEL_NAME}-cdist-{LAYER_INDEX+1}.pth")
-    ldist = torch.load(CACHE_DIR / f"{MODEL_NAME}-label-dist.pth")
+    pdist = torch.load(cdist_entry / "cdist.pth")
+    ldist = torch.load(label_entry / "performance-label-dist.pth")
 
     l = list(range(1000))
-    for i, d in tqdm(enumerate(torch.linspace(0, 1, 1000)), total=1000):
-        l[i] = discontinuity_score_delta(pdist, ldist, d)
+    for i, d in tqdm(enumerate(deltas), total=1000):
+        l[i] = discontinuity_score_delta(pdist, ldist, d, options.device)
         # a = list(range(1000))
         # for j, e in enumerate(torch.linspace(0,1,1000)):
         #     disconts = discontinuity_tf_eps(scores, e)
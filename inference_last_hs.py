@@ -1,60 +1,108 @@
 import os
-import tqdm
 import torch
 import pickle
+import numpy as np
 from datasets import load_dataset
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
-
+from extraction import extract_to_store, extraction_provenance, sharded_extraction
+from activation_store import open_layer, read_meta
 
 DATASET = "imdb"
 MODEL_NAME = "google/flan-t5-base"
 BASE_MODEL_NAME = "google/flan-t5-base"
+# hidden_states indices to keep (None for all) and how tokens are pooled
+LAYERS = None
+POOLING = "mean"
+# padded tokens per batch, examples are batched by length under this budget
+MAX_TOKENS = 8192
+# > 0 to extract on the CPU with this many worker processes, each with its
+# own copy of the model and THREADS_PER_WORKER torch threads
+NUM_WORKERS = 0
+THREADS_PER_WORKER = 1
+# "int8" (dynamic int8 linear layers) or "bf16" (autocast) for faster CPU
+# extraction, see the fidelity report of `inference_sentiment.py`
+PRECISION = "fp32"
+# dynamic int8 quantization only runs on the CPU
+DEVICE = "cuda" if torch.cuda.is_available() and PRECISION != "int8" else "cpu"
+
+
+if __name__ == "__main__":
+    dataset = load_dataset(DATASET)
+
+    test_dataset = dataset["test"]
+    labels = [v["label"] for v in test_dataset]
+    pickle.dump(labels, open("train_labels.pkl", "wb"))
+    shuffled_test = test_dataset.shuffle(seed=42)
+    test_dataset = shuffled_test.select(range(10000, len(test_dataset)))
+
+    model_name = MODEL_NAME
+    tokenizer_name = BASE_MODEL_NAME
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    # prepare the dataset, padded batch by batch in `padded_batches`
+    def tokenize(batch):
+        return tokenizer(batch["text"], truncation=True)
+
+    tokenized_test = test_dataset.map(tokenize, batched=True)
+
+    # run prediction on the test dataset and write the pooled hidden states
+    # to an activation store, which is then read back
+    store_dir = f"{BASE_MODEL_NAME}-{DATASET}-train_hs-store"
+    provenance = extraction_provenance(
+        model_name,
+        tokenizer,
+        tokenized_test._fingerprint,
+        DATASET,
+        "test[10000:] shuffled with seed 42",
+        LAYERS,
+        POOLING,
+        stop_early=True,
+        precision=PRECISION,
+    )
+    if NUM_WORKERS > 0:
+        # resumable shard by shard
+        sharded_extraction(
+            model_name,
+            tokenizer_name,
+            tokenized_test,
+            store_dir,
+            NUM_WORKERS,
+            THREADS_PER_WORKER,
+            layers=LAYERS,
+            pooling=POOLING,
+            max_tokens=MAX_TOKENS,
+            stop_early=True,
+            provenance=provenance,
+            precision=PRECISION,
+        )
+    else:
+        model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        model.eval()
+        model = model.to(DEVICE)
+        # batches are built on a producer thread and written on a writer
+        # thread, the logits are not needed so the forward stops after the
+        # deepest layer
+        extract_to_store(
+            model,
+            tokenizer,
+            tokenized_test,
+            store_dir,
+            LAYERS,
+            POOLING,
+            MAX_TOKENS,
+            DEVICE,
+            stop_early=True,
+            provenance=provenance,
+            precision=PRECISION,
+        )
+    num_layers = read_meta(store_dir)["num_layers"]
+    outputs = [
+        [
+            torch.from_numpy(np.array(open_layer(store_dir, i)))
+            for i in range(num_layers)
+        ]
+    ]
 
-dataset = load_dataset(DATASET)
-
-test_dataset = dataset["test"]
-labels = [v["label"] for v in test_dataset]
-pickle.dump(labels, open("train_labels.pkl", "wb"))
-shuffled_test = test_dataset.shuffle(seed=42)
-test_dataset = shuffled_test.select(range(10000, len(test_dataset)))
-
-model_name = MODEL_NAME
-tokenizer_name = BASE_MODEL_NAME
-
-tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
-model = AutoModelForSequenceClassification.from_pretrained(model_name)
-
-
-# prepare the dataset
-def tokenize(batch):
-    return tokenizer(batch["text"], padding=True, truncation=True, return_tensors="pt")
-
-
-tokenized_test = test_dataset.map(tokenize, batched=True)
-
-# run prediction on the test dataset, get raw prediction, label, and hidden states
-outputs = []
-model.eval()
-model = model.to("cuda")
-with torch.no_grad():
-    for i in tqdm.tqdm(range(0, len(tokenized_test), 2), desc="Model inference"):
-        batch = tokenized_test[i : i + 2]
-        input_ids = torch.LongTensor(batch["input_ids"]).to("cuda")
-        labels = torch.LongTensor(batch["label"]).to("cuda")
-        attention_mask = torch.LongTensor(batch["attention_mask"]).to("cuda")
-        lhs = model(
-            input_ids=input_ids,
-            labels=labels,
-            attention_mask=attention_mask,
-            output_hidden_states=True,
-            # output_attentions=True
-        ).hidden_states
-        # append the average across the sequence dimension
-        outputs.append([torch.mean(v, axis=1) for v in lhs])
-    # concat all of the last hidden states together
-    # outputs = torch.cat(outputs)
-    # then average across the sequence dimension
-    # outputs = torch.mean(outputs, axis=1)
-
-# save the output file
-pickle.dump(outputs, open(f"{BASE_MODEL_NAME}-{DATASET}-train_hs.pkl", "wb+"))
+    # save the output file
+    pickle.dump(outputs, open(f"{BASE_MODEL_NAME}-{DATASET}-train_hs.pkl", "wb+"))
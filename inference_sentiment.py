@@ -1,56 +1,150 @@
 import os
-import tqdm
+import json
+import argparse
 import torch
-import pickle
+import numpy as np
 from datasets import load_dataset
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
-
+from extraction import (
+    extract_to_store,
+    extraction_provenance,
+    is_current,
+    sharded_extraction,
+    fidelity_report,
+    print_fidelity,
+)
 
 DATASET = "imdb"
 MODEL_NAME = "asun17904/imdb-bert-base-uncased"
 BASE_MODEL_NAME = "bert-base-uncased"
+SPLIT = "test[10000:] shuffled with seed 42"
+STORE_DIR = f"/home/weicheng/data_interns/alan/kd/{BASE_MODEL_NAME}-{DATASET}-store"
+# hidden_states indices to store (None for all) and how tokens are pooled
+LAYERS = None
+POOLING = "mean"
+# padded tokens per batch, examples are batched by length under this budget
+MAX_TOKENS = 8192
+# float16 halves the size of the store, the k0 scripts upcast tile by tile
+STORE_DTYPE = np.float32
+# > 0 to extract on the CPU with this many worker processes, each with its
+# own copy of the model and THREADS_PER_WORKER torch threads
+NUM_WORKERS = 0
+THREADS_PER_WORKER = 1
+# "int8" (dynamic int8 linear layers) or "bf16" (autocast) for faster CPU
+# extraction, checked against fp32 on FIDELITY_SAMPLE examples first
+PRECISION = "fp32"
+# dynamic int8 quantization only runs on the CPU
+DEVICE = "cuda" if torch.cuda.is_available() and PRECISION != "int8" else "cpu"
+FIDELITY_SAMPLE = 256
+# per-head attention statistics (entropy, max weight, weight on CLS and on
+# special tokens, attention distance) are stored for every example, the raw
+# attention maps only for these examples; they need the full forward with
+# the attention maps, so they are off unless enabled here or with -attention
+ATTENTION = False
+ATTENTION_SAMPLE = list(range(16))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-attention",
+        action="store_true",
+        help="also store the attention statistics, see ATTENTION",
+    )
+    options = parser.parse_args()
+    attention = ATTENTION or options.attention
+
+    dataset = load_dataset(DATASET)
+
+    test_dataset = dataset["test"]
+    shuffled_test = test_dataset.shuffle(seed=42)
+    test_dataset = shuffled_test.select(range(10000, len(test_dataset)))
 
-dataset = load_dataset(DATASET)
-
-test_dataset = dataset["test"]
-shuffled_test = test_dataset.shuffle(seed=42)
-test_dataset = shuffled_test.select(range(10000, len(test_dataset)))
-
-tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_NAME)
-model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
-
-
-# prepare the dataset
-def tokenize(batch):
-    return tokenizer(batch["text"], padding=True, truncation=True, return_tensors="pt")
-
-
-tokenized_test = test_dataset.map(tokenize, batched=True)
-
-# run prediction on the test dataset, get raw prediction, label, and hidden states
-outputs = []
-model.eval()
-model = model.to("cuda")
-with torch.no_grad():
-    for i in tqdm.tqdm(range(0, len(tokenized_test), 2)):
-        batch = tokenized_test[i : i + 2]
-        input_ids = torch.LongTensor(batch["input_ids"]).to("cuda")
-        labels = torch.LongTensor(batch["label"]).to("cuda")
-        attention_mask = torch.LongTensor(batch["attention_mask"]).to("cuda")
-        outputs.append(
-            model(
-                input_ids=input_ids,
-                labels=labels,
-                attention_mask=attention_mask,
-                output_hidden_states=True,
-                output_attentions=True,
-            )
+    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_NAME)
+
+    # prepare the dataset, padded batch by batch in `padded_batches`
+    def tokenize(batch):
+        return tokenizer(batch["text"], truncation=True)
+
+    tokenized_test = test_dataset.map(tokenize, batched=True)
+    # an existing store is only reused if it was extracted the same way
+    provenance = extraction_provenance(
+        MODEL_NAME,
+        tokenizer,
+        tokenized_test._fingerprint,
+        DATASET,
+        SPLIT,
+        LAYERS,
+        POOLING,
+        STORE_DTYPE,
+        precision=PRECISION,
+        attention=attention,
+        attention_sample=ATTENTION_SAMPLE,
+    )
+    model = None
+    # the fidelity check is skipped when the store is already up to date
+    if (
+        PRECISION != "fp32"
+        and FIDELITY_SAMPLE > 0
+        and not is_current(STORE_DIR, provenance)
+    ):
+        model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
+        model.eval()
+        model = model.to(DEVICE)
+        report = fidelity_report(
+            model,
+            tokenizer,
+            tokenized_test,
+            PRECISION,
+            FIDELITY_SAMPLE,
+            LAYERS,
+            POOLING,
+            MAX_TOKENS,
+            DEVICE,
         )
+        print_fidelity(report)
+        json.dump(report, open(f"{STORE_DIR}-fidelity.json", "w"), indent=2)
 
-# save the output file
-pickle.dump(
-    outputs,
-    open(
-        f"/home/weicheng/data_interns/alan/kd/{BASE_MODEL_NAME}-{DATASET}-k0.pkl", "wb+"
-    ),
-)
+    # run prediction on the test dataset and write the raw prediction, label,
+    # and pooled hidden states of every layer to the activation store
+    if NUM_WORKERS > 0:
+        # every shard is a store of its own, rerunning resumes after the
+        # last complete shard
+        sharded_extraction(
+            MODEL_NAME,
+            BASE_MODEL_NAME,
+            tokenized_test,
+            STORE_DIR,
+            NUM_WORKERS,
+            THREADS_PER_WORKER,
+            layers=LAYERS,
+            pooling=POOLING,
+            max_tokens=MAX_TOKENS,
+            dtype=STORE_DTYPE,
+            provenance=provenance,
+            precision=PRECISION,
+            attention=attention,
+            attention_sample=ATTENTION_SAMPLE,
+        )
+    else:
+        if model is None:
+            model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
+            model.eval()
+            model = model.to(DEVICE)
+        # the layers are pooled by forward hooks as they are computed, so the
+        # full (B x T x H) hidden states of every layer are never kept around
+        extract_to_store(
+            model,
+            tokenizer,
+            tokenized_test,
+            STORE_DIR,
+            LAYERS,
+            POOLING,
+            MAX_TOKENS,
+            DEVICE,
+            STORE_DTYPE,
+            provenance=provenance,
+            precision=PRECISION,
+            attention=attention,
+            attention_sample=ATTENTION_SAMPLE,
+        )
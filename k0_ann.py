@@ -0,0 +1,161 @@
+"""Approximate delta-ball queries with an inverted-file (IVF) index.
+
+The normalized activations are clustered with k-means into `num_lists`
+inverted lists. Every point is only compared against the members of its
+`nprobe` closest lists, so the cost of a k0 sweep drops from n^2 to roughly
+n * nprobe * n / num_lists distance evaluations. `nprobe` is the
+recall/speed knob: `nprobe == num_lists` gives the exact scores back.
+"""
+
+import numpy as np
+from tqdm import tqdm
+
+
+def _sq_dists(a, b):
+    """Squared euclidean distances between the rows of a and b."""
+    dist = (a**2).sum(1)[:, None] + (b**2).sum(1)[None] - 2 * a @ b.T
+    return np.maximum(dist, 0, out=dist)
+
+
+def _nearest(x, centroids, k=1, chunk_rows=8192):
+    """Indices of the k nearest centroids of every row of x."""
+    out = np.empty((len(x), k), dtype=np.int64)
+    for start in range(0, len(x), chunk_rows):
+        dist = _sq_dists(x[start : start + chunk_rows], centroids)
+        if k == 1:
+            out[start : start + chunk_rows, 0] = dist.argmin(1)
+        else:
+            nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            order = np.take_along_axis(dist, nearest, 1).argsort(1)
+            out[start : start + chunk_rows] = np.take_along_axis(nearest, order, 1)
+    return out
+
+
+def _inverted_lists(assign, num_lists):
+    """Positions in `assign` of every list, in ascending order.
+    :return: list with an array of positions per list
+    """
+    order = np.argsort(assign, kind="stable")
+    bounds = np.cumsum(np.bincount(assign, minlength=num_lists))[:-1]
+    return np.split(order, bounds)
+
+
+def build_ivf(x, num_lists, iters=10, train_size=None, seed=0):
+    """Cluster x with k-means and assign every point to its closest centroid.
+    :param x: (n x d) normalized activations
+    :param num_lists: number of inverted lists (clusters)
+    :param iters: Lloyd iterations
+    :param train_size: number of points k-means is fitted on
+        (default 64 per list)
+    :return: (num_lists x d) centroids, (n,) list of every point
+    """
+    rng = np.random.default_rng(seed)
+    train_size = min(len(x), train_size or 64 * num_lists)
+    train = x[rng.choice(len(x), train_size, replace=False)]
+    centroids = train[rng.choice(train_size, num_lists, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest(train, centroids)[:, 0]
+        counts = np.bincount(assign, minlength=num_lists)
+        for k in range(x.shape[1]):
+            centroids[:, k] = np.bincount(assign, train[:, k], num_lists)
+        empty = counts == 0
+        centroids[~empty] /= counts[~empty, None]
+        # re-seed empty lists with random training points
+        centroids[empty] = train[rng.choice(train_size, empty.sum())]
+    return centroids, _nearest(x, centroids)[:, 0]
+
+
+def ivf_k0_scores(
+    x,
+    loss,
+    deltas,
+    num_lists=None,
+    nprobe=8,
+    mean_over_ball=True,
+    ivf=None,
+    chunk_rows=4096,
+    seed=0,
+):
+    """Approximate k0 scores for every delta, only pairing every point with
+    the members of its `nprobe` closest inverted lists. Pairs that are
+    missed make the estimate of a delta ball smaller than the true one.
+    :param x: (n x d) normalized activations
+    :param loss: (n,) loss (or predicted probability) of each point
+    :param deltas: sequence of deltas
+    :param num_lists: number of inverted lists (default ~sqrt(n))
+    :param nprobe: lists searched per point
+    :param mean_over_ball: average over the points in the delta ball
+        (`k0_dist.py`) instead of over all n points (`gpu_k0_dist.py`)
+    :param ivf: (centroids, assignment) from `build_ivf` to reuse
+    :return: (n x len(deltas)) scores
+    """
+    x = np.asarray(x, dtype=np.float64)
+    loss = np.asarray(loss, dtype=np.float64)
+    deltas = np.asarray(deltas, dtype=np.float64)
+    order = np.argsort(deltas)
+    sorted_deltas = deltas[order]
+    n, num_deltas = len(x), len(deltas)
+    if ivf is None:
+        num_lists = num_lists or max(1, int(np.sqrt(n)))
+        ivf = build_ivf(x, num_lists, seed=seed)
+    centroids, assign = ivf
+    nprobe = min(nprobe, len(centroids))
+    probes = _nearest(x, centroids, nprobe)
+
+    list_members = _inverted_lists(assign, len(centroids))
+    # the points probing every list, each point probes a list at most once
+    list_queries = [
+        p // nprobe for p in _inverted_lists(probes.ravel(), len(centroids))
+    ]
+
+    sums = np.zeros((n, num_deltas + 1))
+    counts = np.zeros((n, num_deltas + 1))
+    for l in tqdm(range(len(centroids)), desc="inverted lists"):
+        members, queries = list_members[l], list_queries[l]
+        if len(members) == 0 or len(queries) == 0:
+            continue
+        for start in range(0, len(queries), chunk_rows):
+            q = queries[start : start + chunk_rows]
+            dist = np.sqrt(_sq_dists(x[q], x[members]))
+            # dist < sorted_deltas[k] exactly when k >= bucket
+            bucket = np.searchsorted(sorted_deltas, dist, side="right")
+            point_score = np.abs(loss[q, None] - loss[None, members]) / (1 + dist)
+            flat = (np.arange(len(q))[:, None] * (num_deltas + 1) + bucket).ravel()
+            size = len(q) * (num_deltas + 1)
+            sums[q] += np.bincount(flat, point_score.ravel(), size).reshape(len(q), -1)
+            counts[q] += np.bincount(flat, minlength=size).reshape(len(q), -1)
+    sums = sums.cumsum(1)[:, :num_deltas]
+    counts = counts.cumsum(1)[:, :num_deltas]
+    if mean_over_ball:
+        scores = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    else:
+        scores = sums / n
+    out = np.empty_like(scores)
+    out[:, order] = scores
+    return out
+
+
+def ivf_recall(x, deltas, ivf, nprobe, sample_size=1000, seed=0):
+    """Fraction of the true delta-ball neighbors that the IVF search finds,
+    measured against the exact search on a random sample of query points.
+    :param x: (n x d) normalized activations
+    :param deltas: sequence of deltas
+    :param ivf: (centroids, assignment) from `build_ivf`
+    :param nprobe: lists searched per point
+    :return: (len(deltas),) recall for every delta
+    """
+    x = np.asarray(x, dtype=np.float64)
+    deltas = np.asarray(deltas, dtype=np.float64)
+    centroids, assign = ivf
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(x), min(sample_size, len(x)), replace=False)
+    probes = _nearest(x[sample], centroids, min(nprobe, len(centroids)))
+    found = np.zeros(len(deltas))
+    total = np.zeros(len(deltas))
+    for q, probe in zip(sample, probes):
+        dist = np.sqrt(_sq_dists(x[q : q + 1], x))[0]
+        searched = np.isin(assign, probe)
+        inside = dist[None] < deltas[:, None]
+        total += inside.sum(1)
+        found += (inside & searched[None]).sum(1)
+    return np.divide(found, total, out=np.ones_like(found), where=total > 0)
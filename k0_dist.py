@@ -2,47 +2,143 @@ import os
 import sys
 import torch
 import pickle
+import argparse
 import numpy as np
 from tqdm import tqdm
 from pathlib import Path
-from concurrent import futures
-from numba import jit
-from numba import prange
-from numba_progress import ProgressBar
+from k0_index import (
+    build_neighbor_index,
+    load_neighbor_index,
+    k0_scores,
+    streaming_k0_scores,
+)
+from k0_ann import build_ivf, ivf_k0_scores, ivf_recall
+from k0_numba import numba_k0_scores
+from artifact_cache import ArtifactCache, source_fingerprint
+from compression import layer_scale
+from activation_store import (
+    store_exists,
+    export_pickled_activations,
+    open_layer,
+    open_logits,
+    open_labels,
+)
 
 print("start")
 
 
-class ConstantIterator:
-    def __init__(self, value):
-        self.value = value
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        return self.value
+parser = argparse.ArgumentParser()
+parser.add_argument("data_dir", type=str, help="directory with the activations")
+parser.add_argument("model_name", type=str, help="name of the model")
+parser.add_argument("layer_index", type=int, help="index of the hidden layer")
+parser.add_argument(
+    "-num_deltas",
+    type=int,
+    default=25,
+    help="number of deltas in the sweep between 0.001 and 0.999",
+)
+parser.add_argument(
+    "-max_delta",
+    type=float,
+    default=0.999,
+    help="truncate the neighbor index at this distance (<= 0 keeps all)",
+)
+parser.add_argument(
+    "-stream",
+    action="store_true",
+    help="read the layer from the memory-mapped activation store tile by tile "
+    "instead of loading it into memory and building the neighbor index",
+)
+parser.add_argument(
+    "-store",
+    type=str,
+    default=None,
+    help="activation store directory, used instead of the pickled activations "
+    "when it exists, or a compressed store written by compression.py "
+    "(default: <data_dir>/<model_name>-store)",
+)
+parser.add_argument(
+    "-memory_budget",
+    type=float,
+    default=1024,
+    help="peak memory in MB used by the tiles in -stream mode",
+)
+parser.add_argument(
+    "-backend",
+    type=str,
+    default="exact",
+    choices=["exact", "numba", "ivf"],
+    help="exact neighbor index (prefix sums or the parallel numba kernel) "
+    "or approximate inverted-file search",
+)
+parser.add_argument(
+    "-nprobe", type=int, default=8, help="lists searched per point (ivf backend)"
+)
+parser.add_argument(
+    "-num_lists",
+    type=int,
+    default=None,
+    help="number of k-means lists (ivf backend, default ~sqrt(n))",
+)
+parser.add_argument(
+    "-recall_sample",
+    type=int,
+    default=1000,
+    help="points on which the ivf recall is measured against the exact search",
+)
+parser.add_argument(
+    "-cache",
+    type=str,
+    default=None,
+    help="artifact cache of the neighbor indexes (default: <data_dir>/artifact-cache)",
+)
+parser.add_argument(
+    "-cache_quota",
+    type=float,
+    default=None,
+    help="evict the least recently used artifacts beyond this many GB",
+)
+options = parser.parse_args()
 
+DATA_DIR = Path(options.data_dir)
+MODEL_NAME = options.model_name
+LAYER_INDEX = options.layer_index
 
-DATA_DIR = Path(sys.argv[1])
-MODEL_NAME = sys.argv[2]
-LAYER_INDEX = int(sys.argv[3])
+store_dir = Path(options.store) if options.store else DATA_DIR / f"{MODEL_NAME}-store"
+if options.stream and not store_exists(store_dir):
+    print(f"exporting activations to {store_dir}")
+    export_pickled_activations(
+        pickle.load(open(DATA_DIR / f"{MODEL_NAME}-k0.pkl", "rb")), store_dir
+    )
 
-labels = pickle.load(open(DATA_DIR / "labels.pkl", "rb"))
+if store_exists(store_dir):
+    # the layer is memory-mapped, only the logits are read into memory
+    layer = open_layer(store_dir, LAYER_INDEX)
+    logits = torch.from_numpy(np.array(open_logits(store_dir)))
+    labels = open_labels(store_dir)
+    # the reduced vectors of a compressed store are normalized by the largest
+    # norm of the original ones
+    scale = layer_scale(store_dir, LAYER_INDEX)
+else:
+    # load the activation data and the predictions
+    activations = pickle.load(open(DATA_DIR / f"{MODEL_NAME}-k0.pkl", "rb"))
+    logits = torch.cat([v[0] for v in activations])  # load all of the logits
+    acts = []
+    for i in range(len(activations[0][1])):  # organize activations by layer
+        layer_act = []
+        for v in activations:
+            layer_act.append(v[1][i])
+        acts.append(torch.cat(layer_act))
+    layer = acts[LAYER_INDEX].cpu().detach().numpy()
+    labels = None
+    scale = None
+
+if labels is None:
+    labels = pickle.load(open(DATA_DIR / "labels.pkl", "rb"))
 
 # convert all of the labels to ints
 labels = [int(v) for v in labels]
 
-# load the activation data and the predictions
-activations = pickle.load(open(DATA_DIR / f"{MODEL_NAME}-k0.pkl", "rb"))
-logits = torch.cat([v[0] for v in activations])  # load all of the logits
-acts = []
-for i in range(len(activations[0][1])):  # load activations and organize them by layer
-    layer_act = []
-    for v in activations:
-        layer_act.append(v[1][i])
-    acts.append(torch.cat(layer_act))
-
 
 # apply softmax to the logits to get raw probabilities
 def softmax(x):
@@ -55,151 +151,87 @@ print("stuff 2")
 predicted_probs = softmax(logits)[torch.arange(len(logits)), labels]
 predicted_probs = predicted_probs.cpu().detach().numpy()
 
-# norm the activations
-normed_acts = acts[LAYER_INDEX] / np.max(
-    np.linalg.norm(acts[LAYER_INDEX], axis=1).reshape(-1, 1)
-)
-normed_acts = normed_acts.cpu().detach().numpy()
-
-
-# Decorate the function with @jit to enable Just-In-Time compilation
-# @jit(nopython=True)
-def calculate_mags(normed_acts):
-    num_samples = len(normed_acts)
-    mags = []
-
-    for i in tqdm(range(num_samples)):
-        stuff = np.linalg.norm(normed_acts - normed_acts[i], axis=1)
-        to_append = [(stuff[j], j) for j in range(len(stuff))]
-        to_append.sort()
-        mags.append(to_append)
-
-    return mags
-
-
-# Call the optimized function
-mags = calculate_mags(normed_acts)
-
-# create our cache
-# cache[0] -- all of the distances within delta
-# cache[1] -- all of the points greater than delta
-# cache[2] -- indices of things in cache[0]
-# cache[3] -- loss of all of the indices
-# cache[4] -- count
-# cache[5] -- sum
-# cache[6] -- index in cache[1]
-cache = [[[], mags[i], [], [], 0, 0, 0] for i in range(len(normed_acts))]
-
-
-# @jit(nopython=True, cache=True)
-def check_k0(x, x_loss, cache_idx, mags, normed_acts, loss, delta=0.1, i=0):
-    global cache
-
-    if cache[cache_idx][6] < len(cache[cache_idx][1]):
-        for idx in range(cache[cache_idx][6], len(cache[cache_idx][1])):
-            item = cache[cache_idx][1][idx][0]
-            if item < delta:
-                # cache[cache_idx][0].append(item)
-                # cache[cache_idx][3].append(loss[idx])
-                # cache[cache_idx][2].append(idx)
-                cache[cache_idx][4] += 1
-                cache[cache_idx][5] += np.abs(
-                    x_loss - loss[cache[cache_idx][1][idx][1]]
-                ) / (1 + item)
-                if idx == len(cache[cache_idx][1]) - 1:
-                    cache[cache_idx][6] = idx + 1
-            else:
-                # new_cache_1.append(item)
-                cache[cache_idx][6] = idx
-                break
-    # cache[cache_idx][1] = new_cache_1
-    if cache[cache_idx][4] == 0:  # len(cache[cache_idx][0]) == 0:
-        # is this safe and intended?
-        return 0
-    scored_mean = cache[cache_idx][5] / cache[cache_idx][4]  # np.mean(
-    #    (np.abs(x_loss - np.array(cache[cache_idx][3])) / (1 + np.array(cache[cache_idx][0]))).numpy()
-    # )
-    return scored_mean
+
+def calculate_mags(normed_acts, cache, fields, max_delta=None):
+    """Sort the distances from every point to all other points, or reopen
+    the neighbor index if a previous run already cached it for the same
+    activations.
+    :param cache: `ArtifactCache` holding the index
+    :param fields: key fields of the activations and the layer
+    :return: memory-mapped `NeighborIndex`
+    """
+    fields = {**fields, "artifact": "neighbor-index", "max_delta": max_delta}
+    index_dir = cache.get_or_build(
+        fields, lambda d: build_neighbor_index(normed_acts, d, max_delta)
+    )
+    print(f"loading neighbor index from {index_dir}")
+    return load_neighbor_index(index_dir)
+
+
+def normalize(layer, scale=None):
+    """Load the layer into memory divided by `scale`, by default the largest
+    norm of its rows."""
+    normed_acts = np.asarray(layer, dtype=np.float32)
+    return normed_acts / (scale or np.max(np.linalg.norm(normed_acts, axis=1)))
 
 
 print("start calculating k0")
 
 # get the number of discontinuities as a function of delta
-deltas = np.linspace(0.001, 0.999, 25)
+deltas = np.linspace(0.001, 0.999, options.num_deltas)
 
 model_dir = DATA_DIR / f"{MODEL_NAME}-k0-l{LAYER_INDEX + 1}-ep"
 if not os.path.exists(model_dir):
     os.mkdir(model_dir)
 
-
-def parallel_check_k0(enumerated, delta):
-    global predicted_probs
-    global mags
-    global normed_acts
-    i, row = enumerated
-    value = check_k0(
-        row, predicted_probs[i], i, mags[i], normed_acts, predicted_probs, delta, i
+if options.stream:
+    # first pass finds the max-norm normalizer, second pass the pairwise scores
+    discontinuities = streaming_k0_scores(
+        layer,
+        predicted_probs,
+        deltas,
+        memory_budget=int(options.memory_budget * 2**20),
+        scale=scale,
     )
-
-    return i, value
-
-
-enumerated = []
-enumerated_vals = []
-enumerated_idx = []
-
-for i, k in enumerate(normed_acts):
-    enumerated_vals.append(k)
-    enumerated_idx.append(i)
-    enumerated.append((i, k))
-
-discontinuity = np.zeros(len(predicted_probs))
-
-
-# @jit(nopython=True, cache=True)
-def check_k0_numba(delta, progress_proxy):
-    global predicted_probs
-    global mags
-    global normed_acts
-    global enumerated_vals
-    global enumerated_idx
-
-    for i in range(len(enumerated_idx)):
-        i = enumerated_idx[i]
-        row = enumerated_vals[i]
-        value = check_k0(
-            row, predicted_probs[i], i, mags[i], normed_acts, predicted_probs, delta, i
-        )
-        discontinuity[i] = value
-        progress_proxy.update(1)
-
-
-count = 1
-for delta in tqdm(deltas):
-    # do parallel processing if delta < 0.3 -- this is faster parallel, whereas later on it's faster sequential due to overhead
-
-    if delta <= 0.85:
-        with futures.ProcessPoolExecutor() as pool:
-            for i, value in tqdm(
-                pool.map(parallel_check_k0, enumerated, ConstantIterator(delta)),
-                desc=f"delta={delta:.2f}",
-            ):
-                discontinuity[i] = value
-    # with ProgressBar(total=15000) as progress:
-    #    check_k0_numba(delta, progress)
+elif options.backend == "ivf":
+    normed_acts = normalize(layer, scale)
+    num_lists = options.num_lists or max(1, int(np.sqrt(len(normed_acts))))
+    ivf = build_ivf(normed_acts, num_lists)
+    discontinuities = ivf_k0_scores(
+        normed_acts, predicted_probs, deltas, nprobe=options.nprobe, ivf=ivf
+    )
+    recall = ivf_recall(normed_acts, deltas, ivf, options.nprobe, options.recall_sample)
+    for delta, r in zip(deltas, recall):
+        print(f"ivf recall at delta={delta:.3f}: {r:.4f}")
+    pickle.dump(
+        {"deltas": deltas, "recall": recall, "nprobe": options.nprobe},
+        open(model_dir / f"{MODEL_NAME}-ivf-recall.pkl", "wb+"),
+    )
+else:
+    normed_acts = normalize(layer, scale)
+    max_delta = options.max_delta if options.max_delta > 0 else None
+    cache = ArtifactCache(
+        Path(options.cache) if options.cache else DATA_DIR / "artifact-cache",
+        None if options.cache_quota is None else int(options.cache_quota * 2**30),
+    )
+    source = source_fingerprint(store_dir, DATA_DIR / f"{MODEL_NAME}-k0.pkl")
+    fields = {
+        "source": source,
+        "layer": LAYER_INDEX,
+        "metric": "l2",
+        "normalization": "max-norm",
+    }
+    mags = calculate_mags(normed_acts, cache, fields, max_delta)
+
+    # a single pass over the sorted neighbors gives the score for every delta
+    if options.backend == "numba":
+        discontinuities = numba_k0_scores(mags, predicted_probs, deltas)
     else:
-        for i in tqdm(range(len(enumerated))):
-            i, value = parallel_check_k0(enumerated[i], delta)
-            discontinuity[i] = value
+        discontinuities = k0_scores(mags, predicted_probs, deltas)
+
+for j, delta in enumerate(tqdm(deltas)):
+    discontinuity = discontinuities[:, j]
     pickle.dump(
         discontinuity, open(model_dir / f"{MODEL_NAME}-k0-delta-{delta}.pkl", "wb+")
     )
     print(f"finished {delta}")
-    count += 1
-    # witih ThreadPoolExecutor(max_workers=1) as executor:
-    #     futures = [executor.submit(check_k0, x, normed_acts, predicted_probs, delta) for i, x in enumerate(normed_acts)]
-    #     for future in as_completed(futures):
-    #         i, result = future.result()
-    #         discontinuity[i] = result
-    #         pbar.update(1)
-    # discontinuities.append(discontinuity)
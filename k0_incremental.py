@@ -0,0 +1,222 @@
+"""Incremental k0 scores for a set of examples that keeps growing.
+
+The state of an analyzed set is kept on disk: the activations and losses of
+every point and, for every point, the running count and sum of
+|loss_i - loss_j| / (1 + d_ij) in each bin of a fixed delta grid. Appending m
+examples only evaluates the m x (n + m) new pairs: the new rows get their
+histograms and the pairs with the new examples are added to the old rows'
+histograms, so the cost is proportional to m * n instead of (n + m)^2.
+
+    python k0_incremental.py init <store_dir> <labels.pkl> <layer> <state_dir>
+    python k0_incremental.py append <store_dir> <labels.pkl> <layer> <state_dir>
+
+`init` analyzes a set, `append` adds the examples of another activation store
+(e.g. new adversarial examples), and both write the per-delta pickles of
+`k0_dist.py` to <state_dir>/scores.
+"""
+
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+from tqdm import tqdm
+from pathlib import Path
+from k0_index import tile_rows, tile_histograms, histogram_scores
+from activation_store import (
+    max_row_norm,
+    open_layer,
+    open_logits,
+    write_array,
+)
+
+STATE_FILES = ("acts.npy", "loss.npy", "sums.npy", "counts.npy", "meta.json")
+COMMIT_FILE = "commit.json"
+
+
+def build_k0_state(state_dir, x, loss, deltas, memory_budget=2**30):
+    """Analyze a set of examples from scratch and store the state.
+    :param x: (n x d) activations (not normalized), possibly memory-mapped
+    :param loss: (n,) loss (or predicted probability) of each point
+    :param deltas: the delta grid the state is kept for
+    """
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    deltas = np.sort(np.asarray(deltas, dtype=np.float64))
+    loss = np.asarray(loss, dtype=np.float64)
+    scale = max_row_norm(x)
+    n, t = len(x), tile_rows(x.shape[1], len(deltas), memory_budget)
+
+    write_array(state_dir / "acts.npy", [x[i : i + t] for i in range(0, n, t)])
+    np.save(state_dir / "loss.npy", loss)
+    np.save(state_dir / "deltas.npy", deltas)
+    sums = np.lib.format.open_memmap(
+        state_dir / "sums.npy", mode="w+", shape=(n, len(deltas) + 1)
+    )
+    counts = np.lib.format.open_memmap(
+        state_dir / "counts.npy", mode="w+", shape=(n, len(deltas) + 1)
+    )
+    for r0 in tqdm(range(0, n, t), desc="row tiles"):
+        rows = np.asarray(x[r0 : r0 + t], dtype=np.float64) / scale
+        sums[r0 : r0 + t], counts[r0 : r0 + t] = 0, 0
+        for c0 in range(0, n, t):
+            cols = np.asarray(x[c0 : c0 + t], dtype=np.float64) / scale
+            tile_sums, tile_counts = tile_histograms(
+                rows, loss[r0 : r0 + t], cols, loss[c0 : c0 + t], deltas
+            )
+            sums[r0 : r0 + t] += tile_sums
+            counts[r0 : r0 + t] += tile_counts
+    sums.flush()
+    counts.flush()
+    with open(state_dir / "meta.json", "w") as f:
+        json.dump({"num_samples": n, "scale": scale}, f)
+
+
+def _recover(state_dir):
+    """Finish the renames of an append that was committed (its `commit.json`
+    written) but interrupted, or drop the temporary files of one that was
+    interrupted before, leaving the previous state untouched."""
+    commit = state_dir / COMMIT_FILE
+    if commit.exists():
+        for name in json.load(open(commit)):
+            tmp = state_dir / f"{name}.tmp"
+            if tmp.exists():
+                os.replace(tmp, state_dir / name)
+        commit.unlink()
+    for tmp in state_dir.glob("*.tmp"):
+        tmp.unlink()
+
+
+def append_k0_state(state_dir, new_x, new_loss, memory_budget=2**30):
+    """Add examples to a stored state, evaluating only the new pairs.
+    Distances keep the normalizer of the original set so that the stored
+    histograms stay valid. The grown state is written to temporary files
+    that replace the stored ones once `commit.json` marks them complete, so
+    an interrupted append leaves either the old or the new state.
+    :param new_x: (m x d) activations of the new examples, possibly
+        memory-mapped
+    :param new_loss: (m,) loss of the new examples
+    """
+    state_dir = Path(state_dir)
+    _recover(state_dir)
+    meta = json.load(open(state_dir / "meta.json"))
+    scale = meta["scale"]
+    deltas = np.load(state_dir / "deltas.npy")
+    acts = np.load(state_dir / "acts.npy", mmap_mode="r")
+    loss = np.load(state_dir / "loss.npy")
+    new_loss = np.asarray(new_loss, dtype=np.float64)
+    if max_row_norm(new_x) > scale:
+        print("warning: new examples exceed the normalizer of the original set")
+    n, m = len(acts), len(new_x)
+    t = tile_rows(acts.shape[1], len(deltas), memory_budget)
+
+    def tile(x, start):
+        return np.asarray(x[start : start + t], dtype=np.float64) / scale
+
+    old_sums = np.load(state_dir / "sums.npy", mmap_mode="r")
+    old_counts = np.load(state_dir / "counts.npy", mmap_mode="r")
+    shape = (n + m, len(deltas) + 1)
+    sums = np.lib.format.open_memmap(state_dir / "sums.npy.tmp", "w+", shape=shape)
+    counts = np.lib.format.open_memmap(state_dir / "counts.npy.tmp", "w+", shape=shape)
+    # old rows: the stored histograms plus the pairs with the new examples
+    for r0 in tqdm(range(0, n, t), desc="old rows"):
+        end = min(r0 + t, n)
+        rows = tile(acts, r0)
+        sums[r0:end] = old_sums[r0:end]
+        counts[r0:end] = old_counts[r0:end]
+        for c0 in range(0, m, t):
+            tile_sums, tile_counts = tile_histograms(
+                rows, loss[r0 : r0 + t], tile(new_x, c0), new_loss[c0 : c0 + t], deltas
+            )
+            sums[r0:end] += tile_sums
+            counts[r0:end] += tile_counts
+    del old_sums, old_counts
+
+    # new rows: pairs with the old and the new examples
+    for r0 in tqdm(range(0, m, t), desc="new rows"):
+        rows, rows_loss = tile(new_x, r0), new_loss[r0 : r0 + t]
+        sums[n + r0 : n + r0 + t], counts[n + r0 : n + r0 + t] = 0, 0
+        for c0 in range(0, n, t):
+            tile_sums, tile_counts = tile_histograms(
+                rows, rows_loss, tile(acts, c0), loss[c0 : c0 + t], deltas
+            )
+            sums[n + r0 : n + r0 + t] += tile_sums
+            counts[n + r0 : n + r0 + t] += tile_counts
+        for c0 in range(0, m, t):
+            tile_sums, tile_counts = tile_histograms(
+                rows, rows_loss, tile(new_x, c0), new_loss[c0 : c0 + t], deltas
+            )
+            sums[n + r0 : n + r0 + t] += tile_sums
+            counts[n + r0 : n + r0 + t] += tile_counts
+    sums.flush()
+    counts.flush()
+    del sums, counts
+
+    write_array(
+        state_dir / "acts.npy.tmp",
+        [acts[i : i + t] for i in range(0, n, t)]
+        + [new_x[i : i + t] for i in range(0, m, t)],
+    )
+    del acts
+    with open(state_dir / "loss.npy.tmp", "wb") as f:
+        np.save(f, np.concatenate([loss, new_loss]))
+    meta["num_samples"] = n + m
+    with open(state_dir / "meta.json.tmp", "w") as f:
+        json.dump(meta, f)
+    # every temporary file is complete, the marker commits the append
+    with open(state_dir / "commit.tmp", "w") as f:
+        json.dump(STATE_FILES, f)
+    os.replace(state_dir / "commit.tmp", state_dir / COMMIT_FILE)
+    _recover(state_dir)
+
+
+def state_scores(state_dir, mean_over_ball=True):
+    """k0 scores of every stored point for every delta of the state.
+    :return: deltas, (n x len(deltas)) scores
+    """
+    state_dir = Path(state_dir)
+    _recover(state_dir)
+    sums = np.load(state_dir / "sums.npy", mmap_mode="r")
+    counts = np.load(state_dir / "counts.npy", mmap_mode="r")
+    scores = histogram_scores(
+        np.asarray(sums), np.asarray(counts), len(sums), mean_over_ball
+    )
+    return np.load(state_dir / "deltas.npy"), scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", type=str, choices=["init", "append"])
+    parser.add_argument("store_dir", type=str, help="activation store directory")
+    parser.add_argument("labels", type=str, help="pickled labels of the store")
+    parser.add_argument("layer_index", type=int, help="index of the hidden layer")
+    parser.add_argument("state_dir", type=str, help="incremental state directory")
+    parser.add_argument(
+        "-num_deltas",
+        type=int,
+        default=25,
+        help="number of deltas in the sweep between 0.001 and 0.999 (init)",
+    )
+    parser.add_argument(
+        "-memory_budget", type=float, default=1024, help="MB used by the tiles"
+    )
+    options = parser.parse_args()
+
+    logits = np.array(open_logits(options.store_dir), dtype=np.float64)
+    labels = np.array([int(v) for v in pickle.load(open(options.labels, "rb"))])
+    probs = np.exp(logits - logits.max(1, keepdims=True))
+    probs /= probs.sum(1, keepdims=True)
+    predicted_probs = probs[np.arange(len(probs)), labels]
+    x = open_layer(options.store_dir, options.layer_index)
+    memory_budget = int(options.memory_budget * 2**20)
+    if options.command == "init":
+        deltas = np.linspace(0.001, 0.999, options.num_deltas)
+        build_k0_state(options.state_dir, x, predicted_probs, deltas, memory_budget)
+    else:
+        append_k0_state(options.state_dir, x, predicted_probs, memory_budget)
+
+    score_dir = Path(options.state_dir) / "scores"
+    score_dir.mkdir(exist_ok=True)
+    deltas, scores = state_scores(options.state_dir)
+    for j, delta in enumerate(deltas):
+        pickle.dump(scores[:, j], open(score_dir / f"k0-delta-{delta}.pkl", "wb+"))
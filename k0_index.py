@@ -0,0 +1,329 @@
+"""Sorted neighbor index used to sweep the k0 score over many deltas at once.
+
+Every point's distances to all other points are sorted a single time. Along
+that ordering we keep the running sum of |loss_i - loss_j| / (1 + d_ij), so the
+k0 score of a point for any delta is one `searchsorted` (the number of
+neighbors strictly inside the delta ball) and one lookup into the running sum.
+
+The index is stored in CSR form: row i of the index is
+`dists[indptr[i]:indptr[i + 1]]` (float32, ascending) together with the
+matching `neighbors` (int32). Rows can be truncated at `max_delta`, in which
+case only deltas up to `max_delta` can be queried. The arrays are written to a
+directory with one `.npy` file each so later runs can memory-map them instead
+of rebuilding the index.
+"""
+
+import json
+import tempfile
+import numpy as np
+from tqdm import tqdm
+from pathlib import Path
+from collections import namedtuple
+from activation_store import max_row_norm, raw_to_npy
+
+NeighborIndex = namedtuple(
+    "NeighborIndex", ["indptr", "dists", "neighbors", "max_delta"]
+)
+
+INDEX_FILES = ("indptr.npy", "dists.npy", "neighbors.npy", "meta.json")
+
+
+def build_neighbor_index(normed_acts, index_dir, max_delta=None):
+    """For every point sort the euclidean distance to all other points
+    (including itself) and write the result to `index_dir`. Rows are
+    streamed to disk so only one row is held in memory at a time.
+    :param normed_acts: (n x d) normalized activations
+    :param index_dir: directory to store the index in
+    :param max_delta: only keep neighbors with distance < max_delta
+        (None keeps every neighbor)
+    :return: memory-mapped `NeighborIndex`
+    """
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    normed_acts = np.asarray(normed_acts, dtype=np.float32)
+    num_samples = len(normed_acts)
+    indptr = np.zeros(num_samples + 1, dtype=np.int64)
+
+    with open(index_dir / "dists.raw", "wb") as fd, open(
+        index_dir / "neighbors.raw", "wb"
+    ) as fn:
+        for i in tqdm(range(num_samples), desc="sorting neighbors"):
+            row = np.linalg.norm(normed_acts - normed_acts[i], axis=1)
+            order = np.argsort(row, kind="stable")
+            row = row[order]
+            if max_delta is not None:
+                keep = np.searchsorted(row, max_delta, side="left")
+                row, order = row[:keep], order[:keep]
+            fd.write(row.astype(np.float32).tobytes())
+            fn.write(order.astype(np.int32).tobytes())
+            indptr[i + 1] = indptr[i] + len(row)
+
+    raw_to_npy(
+        index_dir / "dists.raw", index_dir / "dists.npy", np.float32, indptr[-1:]
+    )
+    raw_to_npy(
+        index_dir / "neighbors.raw", index_dir / "neighbors.npy", np.int32, indptr[-1:]
+    )
+    np.save(index_dir / "indptr.npy", indptr)
+    # the metadata is written last and marks the index as complete
+    with open(index_dir / "meta.json", "w") as f:
+        json.dump(
+            {
+                "num_samples": num_samples,
+                "max_delta": None if max_delta is None else float(max_delta),
+            },
+            f,
+        )
+    return load_neighbor_index(index_dir)
+
+
+def load_neighbor_index(index_dir, mmap_mode="r"):
+    """Open an index written by `build_neighbor_index` without reading it
+    into memory."""
+    index_dir = Path(index_dir)
+    meta = json.load(open(index_dir / "meta.json"))
+    return NeighborIndex(
+        np.load(index_dir / "indptr.npy"),
+        np.load(index_dir / "dists.npy", mmap_mode=mmap_mode),
+        np.load(index_dir / "neighbors.npy", mmap_mode=mmap_mode),
+        meta["max_delta"],
+    )
+
+
+def index_exists(index_dir, max_delta=None):
+    """Whether a complete index covering deltas up to `max_delta` exists."""
+    index_dir = Path(index_dir)
+    if not all((index_dir / f).exists() for f in INDEX_FILES):
+        return False
+    stored = json.load(open(index_dir / "meta.json"))["max_delta"]
+    return stored is None or (max_delta is not None and max_delta <= stored)
+
+
+def index_row(index, i):
+    """Sorted distances and neighbor indices of point i."""
+    start, end = index.indptr[i], index.indptr[i + 1]
+    return index.dists[start:end], index.neighbors[start:end]
+
+
+def loss_prefix_sums(index, loss, start=0, stop=None):
+    """Cumulative sum of |loss_i - loss_j| / (1 + d_ij) along the sorted
+    neighbors of the points start:stop.
+    :param index: `NeighborIndex`
+    :param loss: (n,) loss (or predicted probability) of each point
+    :return: float64 prefix sums aligned with
+        `index.dists[index.indptr[start]:index.indptr[stop]]`
+    """
+    if stop is None:
+        stop = len(index.indptr) - 1
+    loss = np.asarray(loss, dtype=np.float64)
+    offset = index.indptr[start]
+    sums = np.empty(index.indptr[stop] - offset, dtype=np.float64)
+    for i in range(start, stop):
+        dists, neighbors = index_row(index, i)
+        begin, end = index.indptr[i] - offset, index.indptr[i + 1] - offset
+        np.cumsum(np.abs(loss[i] - loss[neighbors]) / (1 + dists), out=sums[begin:end])
+    return sums
+
+
+def k0_scores(index, loss, deltas, block_size=2**24):
+    """k0 score of every point for every delta. The score is the mean of
+    |loss_i - loss_j| / (1 + d_ij) over all j with d_ij < delta, and 0 when
+    the delta ball is empty. The prefix sums are computed for blocks of rows
+    holding about `block_size` neighbors, so a memory-mapped index is never
+    mirrored in memory.
+    :param index: `NeighborIndex`
+    :param loss: (n,) loss (or predicted probability) of each point
+    :param deltas: sequence of deltas
+    :return: (n x len(deltas)) scores
+    """
+    deltas = np.asarray(deltas)
+    if index.max_delta is not None and np.any(deltas > index.max_delta):
+        raise ValueError(
+            f"index is truncated at delta={index.max_delta}, "
+            f"cannot query delta={deltas.max()}"
+        )
+    num_samples = len(index.indptr) - 1
+    scores = np.zeros((num_samples, len(deltas)))
+    start = 0
+    while start < num_samples:
+        # at least one row per block, however long it is
+        stop = np.searchsorted(index.indptr, index.indptr[start] + block_size, "right")
+        stop = min(max(stop - 1, start + 1), num_samples)
+        sums = loss_prefix_sums(index, loss, start, stop)
+        for i in range(start, stop):
+            offset = index.indptr[i] - index.indptr[start]
+            dists, _ = index_row(index, i)
+            counts = np.searchsorted(dists, deltas, side="left")
+            inside = counts > 0
+            scores[i, inside] = sums[offset + counts[inside] - 1] / counts[inside]
+        start = stop
+    return scores
+
+
+K0Curves = namedtuple(
+    "K0Curves", ["indptr", "breakpoints", "cumsum", "num_samples", "max_delta"]
+)
+
+
+def save_k0_curves(curves, fname):
+    """Store `K0Curves` in a single .npz file."""
+    np.savez(
+        fname,
+        indptr=curves.indptr,
+        breakpoints=curves.breakpoints,
+        cumsum=curves.cumsum,
+        num_samples=curves.num_samples,
+        max_delta=curves.max_delta,
+    )
+
+
+def load_k0_curves(fname):
+    """Load `K0Curves` stored with `save_k0_curves`."""
+    data = np.load(fname)
+    return K0Curves(
+        data["indptr"],
+        data["breakpoints"],
+        data["cumsum"],
+        int(data["num_samples"]),
+        float(data["max_delta"]),
+    )
+
+
+def curve_scores(curves, deltas):
+    """Evaluate piecewise-constant k0 curves exactly. The score of point i
+    at delta is the cumulative sum up to the last breakpoint < delta divided
+    by the number of points, i.e. `gpu_k0_dist.discontinuity_score_delta`.
+    :param curves: `K0Curves`
+    :param deltas: sequence of deltas, all <= curves.max_delta
+    :return: (n x len(deltas)) scores
+    """
+    deltas = np.asarray(deltas)
+    if np.any(deltas > curves.max_delta):
+        raise ValueError(
+            f"curves are truncated at delta={curves.max_delta}, "
+            f"cannot query delta={deltas.max()}"
+        )
+    num_samples = len(curves.indptr) - 1
+    scores = np.zeros((num_samples, len(deltas)))
+    for i in range(num_samples):
+        start, end = curves.indptr[i], curves.indptr[i + 1]
+        counts = np.searchsorted(curves.breakpoints[start:end], deltas, side="left")
+        inside = counts > 0
+        scores[i, inside] = curves.cumsum[start + counts[inside] - 1]
+    return scores / curves.num_samples
+
+
+def tile_rows(dim, num_deltas, memory_budget):
+    """Side length of the square tiles used by `streaming_k0_scores` so that
+    two (t x dim) activation blocks, ~5 (t x t) float64/int64 temporaries and
+    the (t x num_deltas) histograms fit in `memory_budget` bytes."""
+    # solve 40 t^2 + (16 dim + 32 num_deltas) t <= memory_budget
+    b = 16 * dim + 32 * (num_deltas + 1)
+    t = (-b + np.sqrt(b * b + 160 * memory_budget)) / 80
+    return int(max(1, t))
+
+
+def streaming_k0_scores(
+    x, loss, deltas, memory_budget=2**30, scale=None, mean_over_ball=True, out=None
+):
+    """k0 scores for a whole grid of deltas, reading x tile by tile so that
+    peak memory is bounded by `memory_budget` regardless of n. x can be a
+    memory-mapped array of any size.
+
+    Every pair (i, j) adds |loss_i - loss_j| / (1 + d_ij) and 1 to the
+    histogram bin of the smallest delta with d_ij < delta; a cumulative sum
+    over the bins then gives the sum and count of every delta ball.
+
+    :param x: (n x d) activations (not normalized)
+    :param loss: (n,) loss (or predicted probability) of each point
+    :param deltas: sequence of deltas
+    :param memory_budget: bytes available for the tiles
+    :param scale: distances are divided by this, defaults to the largest row
+        norm of x (the normalization of `k0_dist.py`)
+    :param mean_over_ball: average over the points in the delta ball
+        (`k0_dist.py`) instead of over all n points (`gpu_k0_dist.py`)
+    :param out: (n x len(deltas)) float64 array the scores are written to,
+        by default allocated in memory when it takes at most half of
+        `memory_budget` and memory-mapped on a temporary file otherwise
+    :return: (n x len(deltas)) scores
+    """
+    loss = np.asarray(loss, dtype=np.float64)
+    deltas = np.asarray(deltas, dtype=np.float64)
+    order = np.argsort(deltas)
+    sorted_deltas = deltas[order]
+    n, num_deltas = len(x), len(deltas)
+    if scale is None:
+        scale = max_row_norm(x)
+
+    scores = out
+    if scores is None and 2 * n * num_deltas * 8 <= memory_budget:
+        # the output takes its share of the budget, the tiles the rest
+        scores = np.zeros((n, num_deltas))
+        memory_budget -= scores.nbytes
+    elif scores is None:
+        # removed by the OS once the array is no longer referenced
+        scores = np.memmap(
+            tempfile.TemporaryFile(), np.float64, "w+", 0, (n, num_deltas)
+        )
+    t = tile_rows(x.shape[1], num_deltas, memory_budget)
+    for r0 in tqdm(range(0, n, t), desc="row tiles"):
+        rows = np.asarray(x[r0 : r0 + t], dtype=np.float64) / scale
+        sums = np.zeros((len(rows), num_deltas + 1))
+        counts = np.zeros((len(rows), num_deltas + 1))
+        for c0 in range(0, n, t):
+            cols = np.asarray(x[c0 : c0 + t], dtype=np.float64) / scale
+            tile_sums, tile_counts = tile_histograms(
+                rows, loss[r0 : r0 + t], cols, loss[c0 : c0 + t], sorted_deltas
+            )
+            sums += tile_sums
+            counts += tile_counts
+        scores[r0 : r0 + t, order] = histogram_scores(sums, counts, n, mean_over_ball)
+    return scores
+
+
+def tile_histograms(rows, rows_loss, cols, cols_loss, sorted_deltas):
+    """Every (row, col) pair adds |loss_r - loss_c| / (1 + d_rc) and 1 to
+    the row's histogram bin of the smallest delta with d_rc < delta.
+    :param rows: (r x d) scaled activations
+    :param cols: (c x d) scaled activations
+    :param sorted_deltas: ascending deltas
+    :return: (r x len(deltas) + 1) sums and counts
+    """
+    num_bins = len(sorted_deltas) + 1
+    dist = (rows**2).sum(1)[:, None] + (cols**2).sum(1)[None] - 2 * rows @ cols.T
+    np.sqrt(np.maximum(dist, 0, out=dist), out=dist)
+    # dist < sorted_deltas[k] exactly when k >= bucket
+    bucket = np.searchsorted(sorted_deltas, dist, side="right")
+    bucket += np.arange(len(rows))[:, None] * num_bins
+    point_score = np.abs(rows_loss[:, None] - cols_loss[None])
+    point_score /= 1 + dist
+    del dist
+    size = len(rows) * num_bins
+    sums = np.bincount(bucket.ravel(), point_score.ravel(), size)
+    counts = np.bincount(bucket.ravel(), minlength=size).astype(np.float64)
+    return sums.reshape(len(rows), -1), counts.reshape(len(rows), -1)
+
+
+def histogram_scores(sums, counts, num_samples, mean_over_ball=True):
+    """Turn per-bin histograms from `tile_histograms` into the score of
+    every delta (in ascending order)."""
+    sums = sums.cumsum(1)[:, :-1]
+    counts = counts.cumsum(1)[:, :-1]
+    if mean_over_ball:
+        return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    return sums / num_samples
+
+
+def streaming_max_distance(x, memory_budget=2**30):
+    """Largest pairwise euclidean distance between the rows of x, tile by
+    tile (the normalization of `gpu_k0_dist.py`)."""
+    t = tile_rows(x.shape[1], 0, memory_budget)
+    largest = 0.0
+    for r0 in range(0, len(x), t):
+        rows = np.asarray(x[r0 : r0 + t], dtype=np.float64)
+        rows_sq = (rows**2).sum(1)
+        for c0 in range(r0, len(x), t):
+            cols = np.asarray(x[c0 : c0 + t], dtype=np.float64)
+            dist = rows_sq[:, None] + (cols**2).sum(1)[None] - 2 * rows @ cols.T
+            largest = max(largest, dist.max())
+    return float(np.sqrt(max(largest, 0)))
@@ -0,0 +1,55 @@
+"""Numba kernel filling the whole points x deltas k0 score matrix in one call.
+
+Every point walks its sorted row of the neighbor index once, resuming at the
+previous delta's position (the deltas are visited in ascending order), and
+the points are split across threads with `prange`, so there is no per-task
+pickling or process pool.
+"""
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def k0_kernel(indptr, dists, neighbors, loss, sorted_deltas):
+    num_samples = len(indptr) - 1
+    scores = np.zeros((num_samples, len(sorted_deltas)))
+    for i in prange(num_samples):
+        count = 0
+        total = 0.0
+        pos = indptr[i]
+        end = indptr[i + 1]
+        for k in range(len(sorted_deltas)):
+            while pos < end and dists[pos] < sorted_deltas[k]:
+                total += abs(loss[i] - loss[neighbors[pos]]) / (1 + dists[pos])
+                count += 1
+                pos += 1
+            if count > 0:
+                scores[i, k] = total / count
+    return scores
+
+
+def numba_k0_scores(index, loss, deltas):
+    """Same as `k0_index.k0_scores` computed by `k0_kernel`.
+    :param index: `NeighborIndex` (in memory or memory-mapped)
+    :param loss: (n,) loss (or predicted probability) of each point
+    :param deltas: sequence of deltas
+    :return: (n x len(deltas)) scores
+    """
+    deltas = np.asarray(deltas, dtype=np.float64)
+    if index.max_delta is not None and np.any(deltas > index.max_delta):
+        raise ValueError(
+            f"index is truncated at delta={index.max_delta}, "
+            f"cannot query delta={deltas.max()}"
+        )
+    order = np.argsort(deltas)
+    scores = k0_kernel(
+        np.asarray(index.indptr),
+        np.asarray(index.dists),
+        np.asarray(index.neighbors),
+        np.asarray(loss, dtype=np.float64),
+        deltas[order],
+    )
+    out = np.empty_like(scores)
+    out[:, order] = scores
+    return out
@@ -0,0 +1,188 @@
+"""Monte Carlo estimates of dataset-level k0 statistics.
+
+Instead of scoring every point, random anchor points are drawn (without
+replacement) and scored exactly against the whole dataset, one row of the
+distance matrix each. The mean k0 score and the fraction of points whose score
+is at least eps (the exceedance counts of the notebooks divided by n) are
+means over anchors, so a CLT confidence interval (a Wilson interval for the
+fractions) with finite population correction comes for free. Anchors are drawn in batches until every interval
+is narrower than the requested tolerance.
+"""
+
+import pickle
+import argparse
+import numpy as np
+from pathlib import Path
+from statistics import NormalDist
+from activation_store import max_row_norm, open_layer, open_logits
+
+
+def anchor_scores(x, loss, anchors, deltas, scale=1.0, mean_over_ball=True):
+    """Exact k0 scores of the anchor points for every delta.
+    :param x: (n x d) activations, possibly memory-mapped
+    :param loss: (n,) loss (or predicted probability) of each point
+    :param anchors: indices of the points to score
+    :param deltas: sequence of deltas
+    :param scale: distances are divided by this
+    :param mean_over_ball: average over the points in the delta ball
+        (`k0_dist.py`) instead of over all n points (`gpu_k0_dist.py`)
+    :return: (len(anchors) x len(deltas)) scores
+    """
+    deltas = np.asarray(deltas, dtype=np.float64)
+    order = np.argsort(deltas)
+    num_deltas = len(deltas)
+    a = np.asarray(x[anchors], dtype=np.float64)
+    size = len(anchors) * (num_deltas + 1)
+    row_ids = np.arange(len(anchors))[:, None] * (num_deltas + 1)
+    sums, counts = np.zeros(size), np.zeros(size)
+    chunk_rows = 65536
+    for start in range(0, len(x), chunk_rows):
+        cols = np.asarray(x[start : start + chunk_rows], dtype=np.float64)
+        dist = (a**2).sum(1)[:, None] + (cols**2).sum(1)[None] - 2 * a @ cols.T
+        dist = np.sqrt(np.maximum(dist, 0)) / scale
+        point_score = np.abs(
+            loss[anchors, None] - loss[None, start : start + len(cols)]
+        )
+        point_score /= 1 + dist
+        # dist < deltas[order][k] exactly when k >= bucket
+        bucket = (np.searchsorted(deltas[order], dist, side="right") + row_ids).ravel()
+        sums += np.bincount(bucket, point_score.ravel(), size)
+        counts += np.bincount(bucket, minlength=size)
+    sums = sums.reshape(len(anchors), -1).cumsum(1)[:, :num_deltas]
+    counts = counts.reshape(len(anchors), -1).cumsum(1)[:, :num_deltas]
+    if mean_over_ball:
+        scores = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    else:
+        scores = sums / len(x)
+    out = np.empty_like(scores)
+    out[:, order] = scores
+    return out
+
+
+def confidence_interval(total, total_sq, m, population, confidence=0.95):
+    """Mean of m samples (drawn without replacement from a population of
+    `population`) and the half-width of its CLT interval, from the running
+    sum and sum of squares of the samples."""
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    fpc = np.sqrt((population - m) / max(population - 1, 1))
+    mean = total / m
+    if m < 2:
+        return mean, np.full(np.shape(total), np.inf)
+    var = np.maximum(total_sq - m * mean**2, 0) / (m - 1)
+    return mean, z * np.sqrt(var / m) * fpc
+
+
+def wilson_interval(successes, m, population, confidence=0.95):
+    """Fraction of successes among m samples drawn without replacement from
+    a population of `population`, and the half-width of its Wilson interval.
+    Unlike the CLT interval it does not collapse to zero width when no (or
+    every) sample is a success."""
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    fpc = np.sqrt((population - m) / max(population - 1, 1))
+    p = successes / m
+    half_width = z * np.sqrt(p * (1 - p) / m + z**2 / (4 * m**2)) / (1 + z**2 / m)
+    return p, half_width * fpc
+
+
+def estimate_k0(
+    x,
+    loss,
+    deltas,
+    eps=(),
+    rel_tol=0.01,
+    abs_tol=1e-3,
+    confidence=0.95,
+    batch_size=256,
+    max_anchors=None,
+    scale=None,
+    mean_over_ball=True,
+    seed=0,
+):
+    """Estimate the mean k0 score for every delta, and the fraction of
+    points with a score >= eps for every (delta, eps), to within the
+    requested tolerance.
+    :param x: (n x d) activations, possibly memory-mapped
+    :param loss: (n,) loss (or predicted probability) of each point
+    :param deltas: sequence of deltas
+    :param eps: sequence of eps thresholds for the exceedance fractions
+    :param rel_tol: stop once the half-width of every mean score is within
+        this fraction of the estimate...
+    :param abs_tol: ...or below this absolute value (also used for the
+        exceedance fractions)
+    :param confidence: confidence level of the intervals
+    :param batch_size: anchors drawn between two checks of the intervals
+    :param max_anchors: stop after this many anchors (default n, exact)
+    :param scale: distances are divided by this, defaults to the largest row
+        norm of x (the normalization of `k0_dist.py`)
+    :return: dict with the `mean` and `mean_ci` (len(deltas),), the
+        `exceedance` and `exceedance_ci` (len(deltas) x len(eps)), and the
+        number of anchors used
+    """
+    loss = np.asarray(loss, dtype=np.float64)
+    eps = np.asarray(eps, dtype=np.float64)
+    n = len(x)
+    scale = max_row_norm(x) if scale is None else scale
+    order = np.random.default_rng(seed).permutation(n)[: max_anchors or n]
+
+    # running sums over the anchors scored so far
+    m = 0
+    total = np.zeros(len(deltas))
+    total_sq = np.zeros(len(deltas))
+    exceeds = np.zeros((len(deltas), len(eps)))
+    for start in range(0, len(order), batch_size):
+        anchors = order[start : start + batch_size]
+        batch = anchor_scores(x, loss, anchors, deltas, scale, mean_over_ball)
+        m += len(batch)
+        total += batch.sum(0)
+        total_sq += (batch**2).sum(0)
+        exceeds += (batch[:, :, None] >= eps[None, None]).sum(0)
+        mean, mean_ci = confidence_interval(total, total_sq, m, n, confidence)
+        exceedance, exceedance_ci = wilson_interval(exceeds, m, n, confidence)
+        if np.all(mean_ci <= np.maximum(rel_tol * np.abs(mean), abs_tol)) and np.all(
+            exceedance_ci <= abs_tol
+        ):
+            break
+    return {
+        "deltas": np.asarray(deltas),
+        "eps": eps,
+        "mean": mean,
+        "mean_ci": mean_ci,
+        "exceedance": exceedance,
+        "exceedance_ci": exceedance_ci,
+        "num_anchors": m,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_dir", type=str, help="activation store directory")
+    parser.add_argument("labels", type=str, help="pickled labels")
+    parser.add_argument("layer_index", type=int, help="index of the hidden layer")
+    parser.add_argument("-num_deltas", type=int, default=25, help="number of deltas")
+    parser.add_argument("-num_eps", type=int, default=0, help="number of eps")
+    parser.add_argument("-rel_tol", type=float, default=0.01, help="relative tolerance")
+    parser.add_argument("-abs_tol", type=float, default=1e-3, help="absolute tolerance")
+    parser.add_argument("-confidence", type=float, default=0.95, help="CI level")
+    parser.add_argument("-out", type=str, default=None, help="pickle the estimate here")
+    options = parser.parse_args()
+
+    logits = np.array(open_logits(options.store_dir), dtype=np.float64)
+    labels = np.array([int(v) for v in pickle.load(open(options.labels, "rb"))])
+    probs = np.exp(logits - logits.max(1, keepdims=True))
+    probs /= probs.sum(1, keepdims=True)
+    estimate = estimate_k0(
+        open_layer(options.store_dir, options.layer_index),
+        probs[np.arange(len(probs)), labels],
+        np.linspace(0.001, 0.999, options.num_deltas),
+        np.linspace(0, 1, options.num_eps),
+        options.rel_tol,
+        options.abs_tol,
+        options.confidence,
+    )
+    print(f"anchors used: {estimate['num_anchors']}")
+    for delta, mean, ci in zip(
+        estimate["deltas"], estimate["mean"], estimate["mean_ci"]
+    ):
+        print(f"delta={delta:.3f}: {mean:.6f} +- {ci:.6f}")
+    if options.out is not None:
+        pickle.dump(estimate, open(Path(options.out), "wb+"))
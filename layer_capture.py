@@ -0,0 +1,269 @@
+"""Capture pooled hidden states with forward hooks.
+
+`output_hidden_states=True` keeps the (B x T x H) output of every layer alive
+until the forward returns. Instead, hooks on the transformer blocks pool the
+requested layers as soon as they are computed, so only (B x H) per captured
+layer is kept, and when the logits are not needed the forward is cut short
+after the deepest requested block.
+
+Layers are numbered like `hidden_states`: layer 0 is the input of the first
+block (the embeddings) and layer i the output of block i - 1. Models that
+apply a final layer norm to the last entry of `hidden_states` (GPT-2, T5,
+...) have the last layer captured at the output of that norm instead.
+"""
+
+import torch
+import torch.nn as nn
+
+# where the transformer blocks live in the HuggingFace architectures we use
+BLOCK_PATHS = {
+    "encoder": [
+        "bert.encoder.layer",
+        "roberta.encoder.layer",
+        "deberta.encoder.layer",
+        "electra.encoder.layer",
+        "distilbert.transformer.layer",
+        "encoder.layer",
+        "transformer.layer",
+        "encoder.block",
+        "transformer.encoder.block",
+        "model.encoder.layers",
+        "transformer.h",
+        "model.layers",
+        "gpt_neox.layers",
+    ],
+    "decoder": ["decoder.block", "model.decoder.layers", "transformer.decoder.block"],
+}
+
+# the final layer norm (and the dropout T5 applies after it) that is part of
+# the last entry of `hidden_states`, for the block paths that have one
+FINAL_NORM_PATHS = {
+    "transformer.h": [("transformer.ln_f", None)],
+    "encoder.block": [("encoder.final_layer_norm", "encoder.dropout")],
+    "transformer.encoder.block": [
+        ("transformer.encoder.final_layer_norm", "transformer.encoder.dropout")
+    ],
+    "decoder.block": [("decoder.final_layer_norm", "decoder.dropout")],
+    "transformer.decoder.block": [
+        ("transformer.decoder.final_layer_norm", "transformer.decoder.dropout")
+    ],
+    "model.layers": [("model.norm", None)],
+    "gpt_neox.layers": [("gpt_neox.final_layer_norm", None)],
+    "model.encoder.layers": [("model.encoder.layer_norm", None)],
+    "model.decoder.layers": [
+        ("model.decoder.final_layer_norm", None),
+        ("model.decoder.layer_norm", None),
+    ],
+}
+
+POOLINGS = ("mean", "cls", "last")
+
+
+class _StopForward(Exception):
+    """Raised by the deepest hook to skip the rest of the forward."""
+
+
+def _get_path(module, path):
+    for name in path.split("."):
+        module = getattr(module, name, None)
+        if module is None:
+            return None
+    return module
+
+
+def transformer_blocks(model, stack="encoder"):
+    """The list of transformer blocks of a HuggingFace model.
+    :param stack: `encoder` or `decoder`, the blocks of encoder-only and
+        decoder-only models are all found under `encoder`
+    """
+    if stack not in BLOCK_PATHS:
+        raise ValueError(
+            f"unknown stack {stack!r}, expected one of {list(BLOCK_PATHS)}"
+        )
+    return _find_blocks(model, stack)[1]
+
+
+def _find_blocks(model, stack):
+    for path in BLOCK_PATHS[stack]:
+        blocks = _get_path(model, path)
+        if isinstance(blocks, nn.ModuleList) and len(blocks) > 0:
+            return path, blocks
+    raise ValueError(f"cannot find the {stack} blocks of {type(model).__name__}")
+
+
+def final_norm(model, stack="encoder"):
+    """The final layer norm applied after the last block of a stack, and the
+    dropout applied after it, or (None, None) when `hidden_states[-1]` is the
+    raw output of the last block."""
+    path, _ = _find_blocks(model, stack)
+    for norm_path, dropout_path in FINAL_NORM_PATHS.get(path, []):
+        norm = _get_path(model, norm_path)
+        if isinstance(norm, nn.Module):
+            dropout = _get_path(model, dropout_path) if dropout_path else None
+            return norm, dropout
+    return None, None
+
+
+def num_layers(model, stack="encoder"):
+    """Number of layers that can be captured, `len(hidden_states)`."""
+    return len(transformer_blocks(model, stack)) + 1
+
+
+def pool(hidden_state, attention_mask=None, pooling="mean"):
+    """Pool a (B x T x H) hidden state into (B x H).
+    :param attention_mask: (B x T) mask of the non-padding tokens, without it
+        every token counts
+    :param pooling: `mean` over the tokens, the first (`cls`) token or the
+        `last` non-padding token
+    """
+    if hidden_state.dtype in (torch.float16, torch.bfloat16):
+        # pool reduced-precision (autocast) activations in fp32
+        hidden_state = hidden_state.float()
+    if pooling == "cls":
+        return hidden_state[:, 0]
+    if attention_mask is None:
+        if pooling == "mean":
+            return hidden_state.mean(1)
+        return hidden_state[:, -1]
+    mask = attention_mask.to(hidden_state.device)
+    if pooling == "mean":
+        mask = mask.unsqueeze(-1).to(hidden_state.dtype)
+        return (hidden_state * mask).sum(1) / mask.sum(1).clamp_min(1)
+    positions = torch.arange(mask.shape[1], device=mask.device)
+    last = (mask.long() * positions).argmax(1)
+    return hidden_state[torch.arange(len(hidden_state)), last]
+
+
+class LayerCapture:
+    """Forward hooks that pool the requested layers of a model.
+
+    Use as a context manager so the hooks are removed afterwards:
+
+        with LayerCapture(model, [4, 12], stop_early=True) as capture:
+            _, pooled = capture(input_ids=ids, attention_mask=mask)
+    """
+
+    def __init__(
+        self,
+        model,
+        layers=None,
+        pooling="mean",
+        stop_early=False,
+        stack="encoder",
+        masked=True,
+    ):
+        """
+        :param model: the HuggingFace model to run
+        :param layers: `hidden_states` indices to capture (default all)
+        :param pooling: `mean`, `cls` or `last`, see `pool`
+        :param stop_early: stop the forward after the deepest requested block,
+            the logits are not computed then
+        :param stack: `encoder` or `decoder` blocks to hook
+        :param masked: pool over the non-padding tokens only, False pools over
+            every position like `hidden_states[i].mean(1)`
+        """
+        if pooling not in POOLINGS:
+            raise ValueError(f"unknown pooling {pooling!r}, expected one of {POOLINGS}")
+        self.model = model
+        self.blocks = transformer_blocks(model, stack)
+        self.final_norm, self.final_dropout = final_norm(model, stack)
+        num = len(self.blocks) + 1
+        layers = range(num) if layers is None else layers
+        self.layers = sorted({l % num for l in layers})
+        self.pooling = pooling
+        self.stop_early = stop_early
+        self.masked = masked
+        self.mask_key = (
+            "decoder_attention_mask" if stack == "decoder" else "attention_mask"
+        )
+        self.handles = []
+        self.pooled = {}
+        self.mask = None
+        self.after_norm = False
+
+    def _store(self, layer, hidden_state):
+        self.pooled[layer] = pool(hidden_state, self.mask, self.pooling)
+        if self.stop_early and layer == self.layers[-1]:
+            raise _StopForward
+
+    def _pre_hook(self, layer):
+        def hook(module, args, kwargs):
+            self._store(layer, args[0] if args else kwargs["hidden_states"])
+
+        return hook
+
+    def _hook(self, layer):
+        def hook(module, args, output):
+            self._store(layer, output[0] if isinstance(output, tuple) else output)
+
+        return hook
+
+    def _final_norm_hooks(self, layer):
+        """Hooks that capture the output of the final dropout on its first
+        call after the final norm, the tensor `hidden_states[-1]` holds (the
+        same dropout module also runs on the embeddings)."""
+
+        def norm_hook(module, args, output):
+            self.after_norm = True
+
+        def dropout_hook(module, args, output):
+            if self.after_norm:
+                self.after_norm = False
+                self._store(layer, output)
+
+        return [
+            self.final_norm.register_forward_hook(norm_hook),
+            self.final_dropout.register_forward_hook(dropout_hook),
+        ]
+
+    def attach(self):
+        for layer in self.layers:
+            if layer == 0:
+                handle = self.blocks[0].register_forward_pre_hook(
+                    self._pre_hook(layer), with_kwargs=True
+                )
+            elif layer == len(self.blocks) and self.final_norm is not None:
+                # hidden_states[-1] is the output of the final layer norm, and
+                # of the dropout after it, whose mask must be the one the
+                # model uses when training
+                if self.final_dropout is not None:
+                    self.handles.extend(self._final_norm_hooks(layer))
+                    continue
+                handle = self.final_norm.register_forward_hook(self._hook(layer))
+            else:
+                handle = self.blocks[layer - 1].register_forward_hook(self._hook(layer))
+            self.handles.append(handle)
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def __call__(self, mask=None, **inputs):
+        """Run the model and collect the pooled layers.
+        :param mask: mask used for pooling, defaults to `attention_mask`
+            (`decoder_attention_mask` for the decoder blocks)
+        :param inputs: keyword arguments of the model
+        :return: the model output (None when stopped early) and the list of
+            (B x H) pooled layers, in the order of `self.layers`
+        """
+        if mask is None and self.masked:
+            mask = inputs.get(self.mask_key)
+        self.mask = mask
+        self.pooled = {}
+        self.after_norm = False
+        output = None
+        try:
+            output = self.model(**inputs)
+        except _StopForward:
+            pass
+        finally:
+            self.mask = None
+        return output, [self.pooled[l] for l in self.layers]
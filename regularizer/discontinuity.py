@@ -0,0 +1,359 @@
+import time
+import torch
+import argparse
+
+# entries of the (rows x B) pairwise blocks computed at a time
+BLOCK_ELEMENTS = 2**24
+
+
+def _ratio_blocks(losses, hs, other_losses, other_hs, p, requires_grad=False):
+    """Iterate over row blocks of the pairwise terms.
+    :param requires_grad: build the graph of the block distances to their
+        rows, for the backward
+    :return: iterator of (row slice, rows of hs, distances, |l_i - l_j|)"""
+    rows = max(1, BLOCK_ELEMENTS // max(len(other_hs), 1))
+    for start in range(0, len(hs), rows):
+        block = slice(start, start + rows)
+        h = hs[block].detach().requires_grad_(requires_grad)
+        with torch.set_grad_enabled(requires_grad):
+            dist = torch.cdist(h, other_hs.detach(), p=p)
+        loss_dist = torch.cdist(losses[block], other_losses, p=1)
+        yield block, h, dist, loss_dist
+
+
+class PairwiseLossRatio(torch.autograd.Function):
+    """sum_ij |l_i - l_j| / (d(h_i, h_j) + stabilizer) computed block by
+    block, with a backward that recomputes the blocks instead of keeping the
+    B x B distance, loss distance and quotient matrices in the graph. Only
+    the inputs are saved.
+
+    With `other_losses` / `other_hs` (constants, e.g. a memory bank) the sum
+    runs over the pairs (batch, other) instead of the pairs inside the batch.
+    """
+
+    @staticmethod
+    def forward(ctx, losses, hs, stabilizer, p, other_losses, other_hs):
+        symmetric = other_hs is None
+        if symmetric:
+            other_losses, other_hs = losses, hs
+        total = hs.new_zeros((), dtype=torch.float64)
+        for _, _, dist, loss_dist in _ratio_blocks(
+            losses, hs, other_losses, other_hs, p
+        ):
+            total += (loss_dist / (dist + stabilizer)).sum(dtype=torch.float64)
+        if symmetric:
+            ctx.save_for_backward(losses, hs)
+        else:
+            ctx.save_for_backward(losses, hs, other_losses, other_hs)
+        ctx.stabilizer, ctx.p, ctx.symmetric = stabilizer, p, symmetric
+        # the dtype the unfused formula would have
+        return total.to(torch.promote_types(losses.dtype, hs.dtype))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        losses, hs, *others = ctx.saved_tensors
+        other_losses, other_hs = others if others else (losses, hs)
+        stabilizer, p = ctx.stabilizer, ctx.p
+        # in the symmetric case every pair appears in both orders
+        scale = grad_output * (2 if ctx.symmetric else 1)
+        grad_losses = torch.zeros_like(losses)
+        grad_hs = torch.zeros_like(hs)
+        for block, h, dist, loss_dist in _ratio_blocks(
+            losses, hs, other_losses, other_hs, p, requires_grad=True
+        ):
+            denom = dist.detach() + stabilizer
+            sign = torch.sign(losses[block] - other_losses.T)
+            grad_losses[block] = (sign / denom).sum(1, keepdim=True)
+            # chain rule through the block distances, with the backward of
+            # torch.cdist itself so the gradient matches the unfused formula
+            coef = (-loss_dist / denom**2).to(dist.dtype)
+            (grad_hs[block],) = torch.autograd.grad(dist, h, coef)
+        return scale * grad_losses, scale * grad_hs, None, None, None, None
+
+
+def pairwise_loss_ratio(
+    losses, hs, stabilizer, p=2.0, other_losses=None, other_hs=None
+):
+    """Knowledge-discontinuity regularizer, the fused equivalent of
+
+        dist = torch.cdist(hs, hs, p=p) + stabilizer
+        loss_dist = torch.cdist(losses, losses, p=1)
+        torch.sum(loss_dist / dist)
+
+    :param losses: (B x 1) per-example losses
+    :param hs: (B x H) pooled hidden states
+    :param stabilizer: added to the distances
+    :param p: 2 or inf
+    :param other_losses: (M x 1) losses compared against instead of the batch
+    :param other_hs: (M x H) hidden states compared against, no gradient
+    """
+    if p not in (2, float("inf")):
+        raise ValueError(f"p={p} is not supported, use 2 or inf")
+    if other_hs is not None:
+        other_losses = other_losses.detach().to(losses.dtype)
+        other_hs = other_hs.detach().to(hs.dtype)
+    return PairwiseLossRatio.apply(
+        losses, hs, float(stabilizer), float(p), other_losses, other_hs
+    )
+
+
+PAIR_MODES = ("exact", "random", "nearest")
+
+
+def _pair_terms(losses, hs, rows, cols, stabilizer, p):
+    """|l_i - l_j| / (d(h_i, h_j) + stabilizer) of the pairs (rows, cols),
+    two (B x k) index tensors."""
+    dist = torch.linalg.vector_norm(hs[rows] - hs[cols], ord=p, dim=-1)
+    return (losses[rows, 0] - losses[cols, 0]).abs() / (dist + stabilizer)
+
+
+@torch.no_grad()
+def nearest_neighbors(hs, k, p=2.0):
+    """(B x k) indices of the k nearest other examples of every example,
+    computed block by block."""
+    rows = max(1, BLOCK_ELEMENTS // len(hs))
+    neighbors = []
+    for start in range(0, len(hs), rows):
+        dist = torch.cdist(hs[start : start + rows], hs, p=p)
+        self_index = torch.arange(start, start + len(dist), device=hs.device)
+        dist[torch.arange(len(dist)), self_index] = float("inf")
+        neighbors.append(dist.topk(k, largest=False).indices)
+    return torch.cat(neighbors)
+
+
+def _sample_others(excluded, num_samples, generator=None):
+    """Draw `num_samples` indices per row uniformly (with replacement) among
+    the B indices that are not excluded.
+    :param excluded: (B x e) distinct indices excluded from every row
+    """
+    n = len(excluded)
+    population = n - excluded.shape[1]
+    samples = torch.randint(
+        population,
+        (n, num_samples),
+        device=excluded.device,
+        generator=generator,
+    )
+    # the r-th index that is not excluded, skipping the excluded in order
+    for e in excluded.sort(1).values.T:
+        samples += samples >= e[:, None]
+    return samples
+
+
+def sampled_loss_ratio(
+    losses, hs, stabilizer, p=2.0, k=8, mode="random", generator=None
+):
+    """Unbiased estimate of `pairwise_loss_ratio(losses, hs, stabilizer, p)`
+    from k pairs per example instead of all B - 1.
+
+    `random` draws the k partners of every example uniformly among the
+    others and scales their terms by (B - 1) / k. `nearest` sums the terms of
+    the k // 2 nearest neighbors in hidden space (the largest terms, the
+    distance is in the denominator) exactly and estimates the rest from
+    k - k // 2 partners drawn among the remaining examples.
+
+    :return: the estimate, and the estimated variance of the estimate
+        (sample variance of the terms of every example, detached; None with
+        a single random partner per example)
+    """
+    n = len(hs)
+    if n - 1 <= k:
+        # as cheap to compute exactly
+        return pairwise_loss_ratio(losses, hs, stabilizer, p), hs.new_zeros(())
+    if mode not in PAIR_MODES[1:]:
+        raise ValueError(f"unknown mode {mode!r}, expected {PAIR_MODES[1:]}")
+    rows = torch.arange(n, device=hs.device)[:, None]
+    excluded = rows
+    estimate = hs.new_zeros(())
+    num_random = k
+    if mode == "nearest":
+        nearest = nearest_neighbors(hs.detach(), k // 2, p)
+        terms = _pair_terms(losses, hs, rows.expand_as(nearest), nearest, stabilizer, p)
+        # every row of the full sum is estimated on its own, the pair (j, i)
+        # is covered by the row of j
+        estimate = estimate + terms.sum()
+        excluded = torch.cat([rows, nearest], 1)
+        num_random = k - k // 2
+    population = n - excluded.shape[1]
+    others = _sample_others(excluded, num_random, generator)
+    terms = _pair_terms(losses, hs, rows.expand_as(others), others, stabilizer, p)
+    scale = population / num_random
+    estimate = estimate + scale * terms.sum()
+    variance = None
+    if num_random > 1:
+        # the examples are sampled independently, their variances add up
+        row_variance = terms.detach().var(1) * population**2 / num_random
+        variance = row_variance.sum()
+    return estimate, variance
+
+
+class MemoryBank:
+    """FIFO memory of the detached pooled hidden states and per-example
+    losses of recent training steps, one queue per regularized layer.
+
+    The knowledge-discontinuity regularizer only compares the pairs inside a
+    batch (28 with a batch of 8). Comparing the batch against the bank as
+    well gives B x M more pairs for the cost of one distance matrix, without
+    any extra forward pass. The bank entries are constants, the gradient only
+    flows through the current batch. The bank term is rescaled to the pair
+    count of the batch term, so it has the same magnitude and `lam` keeps
+    its meaning whatever the bank size.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: number of examples kept per layer
+        """
+        self.size = size
+        self.hidden = {}
+        self.losses = {}
+
+    def __len__(self):
+        return sum(len(v) for v in self.hidden.values())
+
+    def get(self, layer):
+        """(M x 1) losses and (M x H) hidden states stored for a layer, None
+        if there are none yet."""
+        if layer not in self.hidden:
+            return None, None
+        return self.losses[layer], self.hidden[layer]
+
+    def push(self, layer, class_losses, hs):
+        """Add a batch to the front of the queue of a layer and drop the
+        oldest entries beyond `size`."""
+        class_losses, hs = class_losses.detach(), hs.detach()
+        if layer in self.hidden:
+            class_losses = torch.cat([class_losses, self.losses[layer]])
+            hs = torch.cat([hs, self.hidden[layer]])
+        self.losses[layer] = class_losses[: self.size]
+        self.hidden[layer] = hs[: self.size]
+
+    def discontinuities(self, layer, class_losses, hs, stabilizer, p=2.0, update=True):
+        """Regularizer over the pairs (current example, bank entry), averaged
+        and rescaled to the B x (B - 1) ordered pairs of the batch term.
+        :param layer: key of the layer the hidden states come from, as
+            returned by `KnowledgeContinuousModel.sample_layer`
+        :param class_losses: (B x 1) per-example losses of the batch
+        :param hs: (B x H) pooled hidden states of the batch
+        :param stabilizer: added to the distances
+        :param p: norm of the hidden state distances
+        :param update: push the batch into the bank afterwards
+        """
+        bank_losses, bank_hs = self.get(layer)
+        kd_score = hs.new_zeros(())
+        if bank_hs is not None:
+            # the fused op sums each of the B x M (batch, bank) terms once,
+            # their mean times the B x (B - 1) ordered in-batch pairs
+            scale = (len(hs) - 1) / len(bank_hs)
+            kd_score = scale * pairwise_loss_ratio(
+                class_losses, hs, stabilizer, p, bank_losses, bank_hs
+            )
+        if update:
+            self.push(layer, class_losses, hs)
+        return kd_score
+
+
+def reference_loss_ratio(losses, hs, stabilizer, p=2.0):
+    """The unfused formula of `calc_knowledge_discontinuities`."""
+    dist = torch.cdist(hs, hs, p=p) + stabilizer
+    loss_dist = torch.cdist(losses, losses, p=1)
+    return torch.sum(loss_dist / dist)
+
+
+def saved_bytes(fn, *args):
+    """Run fn and count the bytes of the tensors autograd saves for the
+    backward (the activation memory of the regularizer)."""
+    total = 0
+
+    def pack(t):
+        nonlocal total
+        total += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn(*args)
+    return out, total
+
+
+def benchmark(batch_size, dim, p, stabilizer, device, repeats=5):
+    """Compare the fused and the unfused regularizer on random data.
+    :return: dict with the max relative deviation of the value and the
+        gradients, and per implementation the forward + backward time, the
+        bytes saved for the backward and (on CUDA) the peak memory
+    """
+    hs = torch.randn(batch_size, dim, device=device, requires_grad=True)
+    losses = torch.rand(batch_size, 1, device=device, requires_grad=True)
+    result = {"batch_size": batch_size, "p": p}
+    outputs = {}
+    for name, fn in (
+        ("unfused", reference_loss_ratio),
+        ("fused", pairwise_loss_ratio),
+    ):
+        fn(losses, hs, stabilizer, p).backward()  # warm up
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            hs.grad = losses.grad = None
+            value, saved = saved_bytes(fn, losses, hs, stabilizer, p)
+            value.backward()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+            result[f"{name}_peak_bytes"] = torch.cuda.max_memory_allocated()
+        result[f"{name}_seconds"] = (time.perf_counter() - start) / repeats
+        result[f"{name}_saved_bytes"] = saved
+        outputs[name] = value.detach(), hs.grad.clone(), losses.grad.clone()
+
+    def relative(a, b):
+        return ((a - b).abs().max() / b.abs().max().clamp_min(1e-30)).item()
+
+    ref, fused = outputs["unfused"], outputs["fused"]
+    result["value_deviation"] = relative(fused[0], ref[0])
+    result["hs_grad_deviation"] = relative(fused[1], ref[1])
+    result["loss_grad_deviation"] = relative(fused[2], ref[2])
+    return result
+
+
+if __name__ == "__main__":
+    # python discontinuity.py -sizes 8 64 512 4096 -p inf
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-sizes", type=int, nargs="+", default=[8, 32, 128, 512, 1024, 4096]
+    )
+    parser.add_argument("-dim", type=int, default=768, help="hidden size")
+    parser.add_argument("-p", type=float, nargs="+", default=[2.0, float("inf")])
+    parser.add_argument("-stabilizer", type=float, default=1e-2)
+    parser.add_argument(
+        "-device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("-repeats", type=int, default=3)
+    options = parser.parse_args()
+
+    print(
+        "p     batch   unfused s  fused s    unfused saved  fused saved  "
+        "value dev  grad dev"
+    )
+    for p in options.p:
+        for size in options.sizes:
+            r = benchmark(
+                size,
+                options.dim,
+                p,
+                options.stabilizer,
+                options.device,
+                options.repeats,
+            )
+            grad_dev = max(r["hs_grad_deviation"], r["loss_grad_deviation"])
+            line = (
+                f"{p:<5} {size:>5}   {r['unfused_seconds']:.2e}   "
+                f"{r['fused_seconds']:.2e}   {r['unfused_saved_bytes'] / 2**20:>10.1f}MB"
+                f"  {r['fused_saved_bytes'] / 2**20:>8.1f}MB  "
+                f"{r['value_deviation']:.1e}    {grad_dev:.1e}"
+            )
+            if "fused_peak_bytes" in r:
+                line += (
+                    f"  peak {r['unfused_peak_bytes'] / 2**20:.0f}MB"
+                    f" vs {r['fused_peak_bytes'] / 2**20:.0f}MB"
+                )
+            print(line)
@@ -1,8 +1,13 @@
+import sys
 import torch
 import numpy as np
 import torch.nn as nn
+from pathlib import Path
 from transformers import PreTrainedModel
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from layer_capture import LayerCapture, num_layers
+
 
 class KnowledgeContinuousModel(nn.Module):
     """Wrapper for any HuggingFace neural network with the proposed
@@ -30,6 +35,27 @@ class KnowledgeContinuousModel(nn.Module):
     def toggle_inference(self):
         self.inference = not self.inference
 
+    def sample_layer(self):
+        """Draw the regularized layer from the beta distribution, before the
+        forward pass so only that layer has to be captured.
+        :return: the stack (`encoder` or `decoder`) and the `hidden_states`
+            index of the layer in that stack, the top index is taken after
+            the final norm (and dropout) like `hidden_states[-1]`
+        """
+        num_encoder_hs = num_layers(self.model, "encoder")
+        if not self.is_encoder_decoder:
+            return "encoder", int(
+                num_encoder_hs * np.random.beta(self.alpha, self.beta)
+            )
+        # extract all both the encoder and decoder layers
+        num_decoder_hs = num_layers(self.model, "decoder")
+        layer = int(
+            (num_encoder_hs + num_decoder_hs) * np.random.beta(self.alpha, self.beta)
+        )
+        if layer >= num_encoder_hs:
+            return "decoder", layer - num_encoder_hs
+        return "encoder", layer
+
     def forward(
         self,
         input_ids,
@@ -37,44 +63,42 @@ class KnowledgeContinuousModel(nn.Module):
         inputs_embeds=None,
         attention_mask=None,
         determinisitc_idx=None,
+        layer=None,
+        capture=True,
     ):
-        x = self.model(
-            input_ids=None
-            if inputs_embeds is not None and not self.is_encoder_decoder
-            else input_ids,
-            labels=labels,
-            inputs_embeds=inputs_embeds if not self.is_encoder_decoder else None,
-            # decoder_inputs_embeds=inputs_embeds if self.is_encoder_decoder else None,
-            attention_mask=attention_mask,
-            output_hidden_states=(not self.inference),
-        )
+        """
+        :param layer: (stack, index) of the regularized layer, drawn with
+            `sample_layer` when not given
+        :param capture: False for a plain forward, on the steps that are not
+            regularized
+        """
+        inputs = {
+            "input_ids": (
+                None
+                if inputs_embeds is not None and not self.is_encoder_decoder
+                else input_ids
+            ),
+            "labels": labels,
+            "inputs_embeds": inputs_embeds if not self.is_encoder_decoder else None,
+            # "decoder_inputs_embeds": inputs_embeds if self.is_encoder_decoder else None,
+            "attention_mask": attention_mask,
+        }
         if self.inference:
-            return x
-        # choose a random layer using the beta distribution and get
-        # the hidden activations from that hidden layer
+            return self.model(**inputs)
         if determinisitc_idx is not None:
+            # the unpooled embeddings are needed
+            x = self.model(**inputs, output_hidden_states=True)
             if self.is_encoder_decoder:
                 return x.decoder_hidden_states[0], x.logits
             return x.hidden_states[0], x.logits
-        elif self.determinisitic:
-            return None, x.logits
-
-        if not self.is_encoder_decoder:
-            layer = int(len(x.hidden_states) * np.random.beta(self.alpha, self.beta))
-            return torch.mean(x.hidden_states[layer], axis=1), x.logits
+        elif self.determinisitic or not capture:
+            return None, self.model(**inputs).logits
 
-        # extract all both the encoder and decoder layers
-        num_encoder_hs, num_decoder_hs = (
-            len(x.encoder_hidden_states),
-            len(x.decoder_hidden_states),
-        )
-        layer = int(
-            (num_encoder_hs + num_decoder_hs) * np.random.beta(self.alpha, self.beta)
-        )
-        if layer >= num_encoder_hs:
-            return (
-                torch.mean(x.decoder_hidden_states[layer - num_encoder_hs], axis=1),
-                x.logits,
-            )
-        else:
-            return torch.mean(x.encoder_hidden_states[layer], axis=1), x.logits
+        # choose a random layer using the beta distribution and only keep the
+        # mean of that layer, instead of every layer's hidden states
+        stack, index = self.sample_layer() if layer is None else layer
+        with LayerCapture(
+            self.model, [index], stack=stack, masked=False
+        ) as capturer:
+            x, (hs,) = capturer(**inputs)
+        return hs, x.logits
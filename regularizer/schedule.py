@@ -0,0 +1,152 @@
+import time
+import torch
+import random
+
+
+class RegularizationSchedule:
+    """Decides on which training batches the regularizer (the knowledge
+    discontinuity term, or the adversarial term of ALUM) is computed. The
+    other batches take the cheap path: a plain forward without hidden states
+    and only the task loss.
+
+    The regularizer is applied every `every` batches, or with probability
+    `probability`, and weighted by the inverse of that rate so the expected
+    objective stays the same. With `adaptive`, `every` follows a running
+    average of the regularizer measured on the regularized batches: it is
+    applied more often when the regularizer rises above its average, and
+    less often when it falls below it. The observed values stay on the
+    device, they are copied to the host without blocking and only read when
+    `every` is decided.
+    """
+
+    def __init__(
+        self,
+        every=1,
+        probability=None,
+        adaptive=False,
+        max_every=64,
+        momentum=0.9,
+        seed=0,
+    ):
+        """
+        :param every: apply the regularizer every `every` batches
+        :param probability: apply it with this probability instead
+        :param adaptive: adapt `every` to the running regularizer value
+        :param max_every: upper bound of the adapted `every`
+        :param momentum: of the running average of the regularizer
+        """
+        self.every = float(every)
+        self.probability = probability
+        self.adaptive = adaptive
+        self.max_every = max_every
+        self.momentum = momentum
+        self.rng = random.Random(seed)
+        self.since = 0
+        self.average = None
+        self.weight = 1.0
+        self.pending = []
+
+    def step(self):
+        """Whether the regularizer is applied on the next training batch, its
+        weight is then `self.weight`."""
+        if self.probability is not None:
+            self.drain()
+            self.weight = 1 / self.probability
+            return self.rng.random() < self.probability
+        self.since += 1
+        if self.since < max(1, round(self.every)):
+            return False
+        self.drain()
+        every = max(1, round(self.every))
+        self.since = 0
+        self.weight = float(every)
+        return True
+
+    def observe(self, value):
+        """Queue the (unweighted) regularizer of a regularized batch,
+        normalized so batches are comparable (e.g. per pair), for the running
+        average. A CUDA tensor is copied to the host asynchronously, without
+        waiting for the step to finish."""
+        if not torch.is_tensor(value):
+            self.update(float(value))
+            return
+        value = value.detach()
+        done = None
+        if value.is_cuda:
+            host = torch.empty_like(value, device="cpu", pin_memory=True)
+            value = host.copy_(value, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record()
+        self.pending.append((value, done))
+
+    def drain(self):
+        """Fold the observed values whose copy has completed, in order."""
+        while self.pending and (
+            self.pending[0][1] is None or self.pending[0][1].query()
+        ):
+            value, _ = self.pending.pop(0)
+            self.update(value.item())
+
+    def update(self, value):
+        """Update the running average with an observed value and adapt
+        `every`."""
+        if self.average is None:
+            self.average = value
+            return
+        if self.adaptive and self.probability is None and value > 0:
+            # at most halve or double per update, the estimate is noisy
+            ratio = min(max(self.average / value, 0.5), 2.0)
+            self.every = min(max(self.every * ratio, 1.0), self.max_every)
+        self.average = self.momentum * self.average + (1 - self.momentum) * value
+
+
+def _seconds(step_times):
+    """Durations of (start, end) pairs of CUDA events or of times."""
+    if step_times and isinstance(step_times[-1][1], torch.cuda.Event):
+        step_times[-1][1].synchronize()
+        return [start.elapsed_time(end) / 1000 for start, end in step_times]
+    return [end - start for start, end in step_times]
+
+
+class ScheduledTrainerMixin:
+    """Times the training steps of a HuggingFace `Trainer` whose
+    `compute_loss` sets `self.regularized`, and adds the mean step time of
+    the regularized and the skipped batches to the logs."""
+
+    def training_step(self, *args, **kwargs):
+        # on CUDA, events time the steps on the device without synchronizing,
+        # they are only read when the times are logged
+        cuda = torch.cuda.is_available()
+        if cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            start.record()
+        else:
+            start = time.perf_counter()
+        loss = super().training_step(*args, **kwargs)
+        if cuda:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+        else:
+            end = time.perf_counter()
+        if not hasattr(self, "step_times"):
+            self.step_times = {True: [], False: []}
+        regularized = getattr(self, "regularized", True)
+        self.step_times[regularized].append((start, end))
+        return loss
+
+    def log(self, logs, *args, **kwargs):
+        step_times = getattr(self, "step_times", None)
+        if step_times and (step_times[True] or step_times[False]):
+            regularized, skipped = map(_seconds, (step_times[True], step_times[False]))
+            total = len(regularized) + len(skipped)
+            logs["regularized_fraction"] = len(regularized) / total
+            logs["step_seconds"] = (sum(regularized) + sum(skipped)) / total
+            if regularized:
+                logs["step_seconds_regularized"] = sum(regularized) / len(regularized)
+            if skipped:
+                logs["step_seconds_skipped"] = sum(skipped) / len(skipped)
+            schedule = getattr(self, "schedule", None)
+            if schedule is not None and schedule.probability is None:
+                logs["regularize_every"] = schedule.every
+            self.step_times = {True: [], False: []}
+        super().log(logs, *args, **kwargs)
@@ -0,0 +1,29 @@
+import torch
+from discontinuity import MemoryBank, reference_loss_ratio
+
+
+def bank_term(losses, hs, copies, stabilizer=1e-2):
+    """Bank term of a batch against a bank holding `copies` copies of it."""
+    bank = MemoryBank(copies * len(hs))
+    for _ in range(copies):
+        bank.push(0, losses, hs)
+    return bank.discontinuities(0, losses, hs, stabilizer, update=False)
+
+
+def test_bank_term_matches_in_batch_scale():
+    torch.manual_seed(0)
+    losses, hs = torch.rand(8, 1, dtype=torch.float64), torch.randn(8, 16).double()
+    # the B x (B - 1) ordered pairs of the in-batch regularizer
+    in_batch = reference_loss_ratio(losses, hs, 1e-2)
+    for copies in (1, 128):
+        # the bank pairs include the B zero self-pairs, a mean of (B - 1) / B
+        # of the in-batch pairs whatever the bank size
+        expected = in_batch * (len(hs) - 1) / len(hs)
+        assert torch.allclose(bank_term(losses, hs, copies), expected)
+
+
+def test_empty_bank_adds_nothing():
+    losses, hs = torch.rand(4, 1), torch.randn(4, 8)
+    bank = MemoryBank(16)
+    assert bank.discontinuities(0, losses, hs, 1e-2).item() == 0
+    assert len(bank) == 4
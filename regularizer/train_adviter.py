@@ -7,6 +7,7 @@ import numpy as np
 import argparse
 from datasets import load_dataset
 from model import KnowledgeContinuousModel
+from discontinuity import pairwise_loss_ratio
 from huggingface_hub import ModelCard, create_repo
 from transformers import (
     AutoTokenizer,
@@ -92,9 +93,7 @@ class KnowledgeRegularizedTrainer(Trainer):
             return (prediction_loss, logits, labels)
 
     def calc_knowledge_discontinuities(self, class_losses, hs):
-        dist = torch.cdist(hs, hs) + self.stabilizer
-        loss_dist = torch.cdist(class_losses, class_losses, p=1)
-        return torch.sum(loss_dist / dist)
+        return pairwise_loss_ratio(class_losses, hs, self.stabilizer)
 
     def compute_loss(self, model, inputs, return_outputs=False):
         labels = inputs.get("labels")
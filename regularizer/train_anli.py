@@ -7,6 +7,13 @@ import numpy as np
 import argparse
 from datasets import load_dataset
 from model import KnowledgeContinuousModel
+from discontinuity import (
+    PAIR_MODES,
+    MemoryBank,
+    pairwise_loss_ratio,
+    sampled_loss_ratio,
+)
+from schedule import RegularizationSchedule, ScheduledTrainerMixin
 from huggingface_hub import ModelCard, create_repo
 from transformers import (
     AutoTokenizer,
@@ -109,7 +116,7 @@ class VanillaTrainer(Trainer):
 
     def compute_loss(self, model, inputs, return_outputs=False):
         labels = inputs.get("labels")
-        outputs = model(**inputs)
+        outputs = model(**inputs, capture=False)
         _, logits = outputs
         logits = logits.softmax(dim=1)
         class_loss = F.cross_entropy(logits, labels)  # N x 1
@@ -118,7 +125,7 @@ class VanillaTrainer(Trainer):
         return class_loss
     
 
-class ALUMTrainer(Trainer):
+class ALUMTrainer(ScheduledTrainerMixin, Trainer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -157,6 +164,14 @@ class ALUMTrainer(Trainer):
 
     def compute_loss(self, model, inputs, return_outputs=False, evaluation_c=False):
         labels = inputs.get("labels")
+        self.regularized = evaluation_c or self.schedule.step()
+        if not self.regularized:
+            # skipped by the schedule, a single forward and the task loss
+            _, logits = model(**inputs, capture=False)
+            class_loss = F.cross_entropy(logits.softmax(dim=1), labels)
+            if return_outputs:
+                return class_loss, logits
+            return class_loss
         outputs = model(
             **inputs, determinisitc_idx=0
         )  # get the first embeddings and output
@@ -197,13 +212,16 @@ class ALUMTrainer(Trainer):
         adv_loss_f = ALUMTrainer.KL(adv_logits, logits.detach())
         adv_loss_b = ALUMTrainer.KL(logits, adv_logits.detach())
         adv_loss = 1e-3 * (adv_loss_f + adv_loss_b)
+        self.schedule.observe(adv_loss.detach())
+        # rescaled by the inverse of the rate it is applied at
+        adv_loss = self.schedule.weight * adv_loss
 
         if return_outputs:
             return class_loss + adv_loss, logits
         return class_loss + adv_loss
 
 
-class KnowledgeRegularizedTrainer(Trainer):
+class KnowledgeRegularizedTrainer(ScheduledTrainerMixin, Trainer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -219,18 +237,56 @@ class KnowledgeRegularizedTrainer(Trainer):
             return (prediction_loss, logits, labels)
 
     def calc_knowledge_discontinuities(self, class_losses, hs):
-        dist = torch.cdist(hs, hs, p=torch.inf) + self.stabilizer
-        loss_dist = torch.cdist(class_losses, class_losses, p=1)
-        return torch.sum(loss_dist / dist)
+        if self.pairs == "exact" or not self.model.training:
+            return pairwise_loss_ratio(class_losses, hs, self.stabilizer, p=torch.inf)
+        # pairs_k pairs per example, rescaled to estimate the sum over all pairs
+        kd_score, variance = sampled_loss_ratio(
+            class_losses, hs, self.stabilizer, torch.inf, self.pairs_k, self.pairs
+        )
+        if variance is not None:
+            relative_std = variance.sqrt() / kd_score.detach().clamp_min(1e-12)
+            self.kd_relative_std.append(relative_std)
+        return kd_score
+
+    def log(self, logs, *args, **kwargs):
+        if getattr(self, "kd_relative_std", None):
+            # relative standard deviation of the sampled regularizer since the last log
+            logs["kd_relative_std"] = torch.stack(self.kd_relative_std).mean().item()
+            self.kd_relative_std = []
+        super().log(logs, *args, **kwargs)
 
     def compute_loss(self, model, inputs, return_outputs=False):
         labels = inputs.get("labels")
-        outputs = model(**inputs)
+        # on the steps skipped by the schedule only the task loss is computed,
+        # without capturing a hidden layer
+        self.regularized = not model.training or self.schedule.step()
+        if not self.regularized:
+            outputs = model(**inputs, capture=False)
+            _, logits = outputs
+            class_loss = F.cross_entropy(logits.softmax(dim=1), labels, reduction="sum")
+            if return_outputs:
+                return class_loss, outputs
+            return class_loss
+        # compare the batch against recent batches regularized at the same layer
+        use_bank = self.memory_bank is not None and model.training
+        layer = self.model.sample_layer() if use_bank else None
+        outputs = model(**inputs, layer=layer)
         hs, logits = outputs
         logits = logits.softmax(dim=1)
         class_loss = F.cross_entropy(logits, labels, reduction="none")  # N x 1
         class_loss = class_loss.reshape(-1, 1)
         kd_score = self.calc_knowledge_discontinuities(class_loss, hs)
+        if model.training:
+            # per pair, so that batches of any size are comparable
+            num_pairs = max(len(class_loss) * (len(class_loss) - 1) // 2, 1)
+            self.schedule.observe(kd_score.detach() / num_pairs)
+        if use_bank:
+            kd_score = kd_score + self.memory_bank.discontinuities(
+                layer, class_loss, hs, self.stabilizer, p=torch.inf
+            )
+        if model.training:
+            # rescaled by the inverse of the rate it is applied at
+            kd_score = self.schedule.weight * kd_score
         if return_outputs:
             return torch.sum(class_loss) + self.lam * kd_score, outputs
         return torch.sum(class_loss) + self.lam * kd_score
@@ -251,6 +307,13 @@ def prepare_trainer(
     learning_rate,
     weight_decay,
     epochs=20,
+    memory_bank=0,
+    pairs="exact",
+    pairs_k=8,
+    reg_every=1,
+    reg_probability=None,
+    reg_adaptive=False,
+    reg_max_every=64,
 ):
     training_args = TrainingArguments(
         output_dir=f"anliR{round_number}-{model_name}-{trainer_name}",
@@ -283,6 +346,13 @@ def prepare_trainer(
     )
     trainer.lam = lam
     trainer.stabilizer = stabilizer
+    trainer.memory_bank = MemoryBank(memory_bank) if memory_bank > 0 else None
+    trainer.pairs = pairs
+    trainer.pairs_k = pairs_k
+    trainer.kd_relative_std = []
+    trainer.schedule = RegularizationSchedule(
+        reg_every, reg_probability, reg_adaptive, reg_max_every
+    )
     return trainer
 
 
@@ -308,6 +378,49 @@ parser.add_argument("-epochs", type=int, help="the number of training epochs")
 parser.add_argument(
     "-is_ed", type=bool, help="if the model is an encoder-decoder", default=False
 )
+parser.add_argument(
+    "-memory_bank",
+    type=int,
+    default=0,
+    help="also compare every batch against the pooled hidden states and losses "
+    "of this many examples from recent steps, that term is averaged over the "
+    "bank to the scale of the in-batch term (0 disables the memory bank)",
+)
+parser.add_argument(
+    "-pairs",
+    type=str,
+    default="exact",
+    choices=PAIR_MODES,
+    help="regularize over all pairs of the batch, or pairs_k pairs per example "
+    "(random partners, or half nearest neighbors and half random) rescaled to "
+    "an unbiased estimate of the full sum",
+)
+parser.add_argument(
+    "-pairs_k", type=int, default=8, help="pairs per example with -pairs random/nearest"
+)
+parser.add_argument(
+    "-reg_every",
+    type=int,
+    default=1,
+    help="compute the regularizer every this many training batches, rescaled by "
+    "it, and only the task loss on the others",
+)
+parser.add_argument(
+    "-reg_probability",
+    type=float,
+    default=None,
+    help="compute the regularizer on each batch with this probability instead, "
+    "rescaled by its inverse",
+)
+parser.add_argument(
+    "-reg_adaptive",
+    action="store_true",
+    help="adapt -reg_every to the running value of the regularizer: more often "
+    "when it rises, less often when it falls",
+)
+parser.add_argument(
+    "-reg_max_every", type=int, default=64, help="upper bound of the adapted -reg_every"
+)
 
 options = parser.parse_args()
 
@@ -354,6 +467,13 @@ trainer = prepare_trainer(
     options.learning_rate,
     options.weight_decay,
     epochs=options.epochs,
+    memory_bank=options.memory_bank,
+    pairs=options.pairs,
+    pairs_k=options.pairs_k,
+    reg_every=options.reg_every,
+    reg_probability=options.reg_probability,
+    reg_adaptive=options.reg_adaptive,
+    reg_max_every=options.reg_max_every,
 )
 # trainer.evaluate()
 trainer.train()
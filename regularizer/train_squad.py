@@ -5,6 +5,7 @@ from huggingface_hub import notebook_login
 from datasets import load_dataset
 from transformers import AutoTokenizer, AutoModelForCausalLM, TrainingArguments, Trainer
 import math
+from discontinuity import pairwise_loss_ratio
 
 dataset = load_dataset("squad")
 dataset
@@ -92,9 +93,7 @@ class KnowledgeRegularizedTrainer(Trainer):
             return (prediction_loss, logits, labels)
 
     def calc_knowledge_discontinuities(self, class_losses, hs):
-        dist = torch.cdist(hs, hs) + self.stabilizer
-        loss_dist = torch.cdist(class_losses, class_losses, p=1)
-        return torch.sum(loss_dist / dist)
+        return pairwise_loss_ratio(class_losses, hs, self.stabilizer)
 
     def compute_loss(self, model, inputs, return_outputs=False):
         labels = inputs.get("labels")
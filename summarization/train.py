@@ -1,5 +1,7 @@
 import os
+import sys
 import argparse
+from pathlib import Path
 
 import torch
 import evaluate
@@ -14,6 +16,9 @@ from peft import get_peft_model
 
 from data_utils import preprocess_dataset
 
+sys.path.append(str(Path(__file__).resolve().parents[1] / "regularizer"))
+from discontinuity import pairwise_loss_ratio
+
 # Create a logger that logs all of the hyperparameters, the validation loss/accuracy
 # at each epoch, and the final test loss/accuracy. It also takes in a dictionary 
 # and logs these. 
@@ -95,9 +100,7 @@ class SummarizationTrainer(Seq2SeqTrainer):
 
     def calc_knowledge_discontinuities(self, logit_loss, hs):
         # p, q = np.random.randint(len(logit_loss)), np.random.randint(len(logit_loss))
-        dist = torch.cdist(hs, hs) + 1e-2
-        loss_dist = torch.cdist(logit_loss, logit_loss, p=1)
-        return torch.sum(loss_dist / dist)
+        return pairwise_loss_ratio(logit_loss, hs, 1e-2)
         # return torch.sum((logit_loss[p] - logit_loss[q]) ** 2 / torch.abs(hs[p] - hs[q]))
 
     def shift_output_logits(self, logits, inputs):
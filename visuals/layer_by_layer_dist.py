@@ -1,4 +1,3 @@
-import os
 import sys
 import tqdm
 import torch
@@ -8,21 +7,61 @@ import seaborn as sns
 from pathlib import Path
 import matplotlib.pyplot as plt
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from gpu_k0_dist import load_layer_scores, stored_layers
+from artifact_cache import (
+    ArtifactCache,
+    cached_array,
+    file_fingerprint,
+    score_fingerprint,
+)
 
 DATA_DIR = sys.argv[1]
 MODEL_NAME = sys.argv[2]
-TOTAL_LAYERS = len(os.listdir(Path(DATA_DIR) / MODEL_NAME))
+TOTAL_LAYERS = len(stored_layers(Path(DATA_DIR) / MODEL_NAME))
 
 N_COLS = 4
 N_ROWS = TOTAL_LAYERS // N_COLS + (TOTAL_LAYERS % N_COLS > 0)
 subplot_height = 3
 GRID_SIZE = 100
+# shared with gpu_k0_dist.py, DATA_DIR is its <data_dir>/discontinuities
+CACHE = ArtifactCache(Path(DATA_DIR).parent / "artifact-cache")
 
 
 # load the data file
 eps = delt = np.linspace(0, 1, GRID_SIZE)
+grid_columns = [i * (1000 // GRID_SIZE) for i in range(GRID_SIZE)]
 ticks = [round(v, 1) for v in np.linspace(0, 1, 10)]
 
+
+def layer_grid(l):
+    """(eps x delta) grid of the log number of points of layer l with a
+    score >= eps."""
+    layer_dir = Path(DATA_DIR) / MODEL_NAME
+    # scores for every delta on the grid, exact if the layer stores k0 curves,
+    # otherwise every (1000 // GRID_SIZE)-th column of the dense grid
+    disconts = load_layer_scores(layer_dir, l, delt, grid_columns)
+    grid = np.zeros((GRID_SIZE, GRID_SIZE))
+    for i in tqdm.tqdm(range(GRID_SIZE), desc=f"Generating layer {l+1}"):
+        # i = indexing delta
+        # j = indexing eps
+        if disconts[i] is None:  # beyond the truncation of the k0 curves
+            grid[:, i] = np.nan
+            continue
+        for j in range(GRID_SIZE):
+            grid[j][i] = np.log((disconts[i] >= eps[j]).sum() + 1)
+    return grid
+
+
+def layer_fields(l):
+    """Key of the grid of a layer in the artifact cache."""
+    return {
+        "artifact": "exceedance-grid",
+        "scores": score_fingerprint(Path(DATA_DIR) / MODEL_NAME, l),
+        "grid_size": GRID_SIZE,
+    }
+
+
 # note that the first dimension corresponds to a specific delta-value then
 # the second dimension correspodns to a specific epsilon-value.
 fig, axs = plt.subplots(
@@ -36,19 +75,11 @@ fig, axs = plt.subplots(
 plt.tight_layout()
 
 for l in range(TOTAL_LAYERS):
-    fname = Path(DATA_DIR) / MODEL_NAME / f"L{l}.pth"
-    if not fname.exists():
-        print(fname, "does not exist continuing with next layer.")
+    layer_dir = Path(DATA_DIR) / MODEL_NAME
+    if not any((layer_dir / f"L{l}{ext}").exists() for ext in (".pth", ".npz")):
+        print(layer_dir / f"L{l}", "does not exist continuing with next layer.")
         continue
-    disconts = torch.load(fname)
-    disconts = [v.cpu() for v in disconts]
-    grid = np.zeros((GRID_SIZE, GRID_SIZE))
-    for i in tqdm.tqdm(range(GRID_SIZE), desc=f"Generating layer {l+1}"):
-        # i = indexing delta
-        # j = indexing eps
-        i_scaled = i * (len(disconts) // GRID_SIZE)
-        for j in range(GRID_SIZE):
-            grid[j][i] = np.log((disconts[i_scaled] >= eps[j]).sum() + 1)
+    grid = cached_array(CACHE, layer_fields(l), lambda: layer_grid(l))
     grid = np.flip(grid, axis=0)
     ax = sns.heatmap(
         grid,
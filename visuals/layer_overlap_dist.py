@@ -1,4 +1,3 @@
-import os
 import sys
 import tqdm
 import torch
@@ -8,13 +7,17 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 from concurrent.futures import ProcessPoolExecutor
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from gpu_k0_dist import load_layer_scores, stored_layers
+
 
 DATA_DIR = sys.argv[1]
 MODEL_NAME = sys.argv[2]
-TOTAL_LAYERS = len(os.listdir(Path(DATA_DIR) / MODEL_NAME))
+TOTAL_LAYERS = len(stored_layers(Path(DATA_DIR) / MODEL_NAME))
 
 GRID_SIZE = 100
 eps = delt = np.linspace(0, 1, GRID_SIZE)
+grid_columns = [i * (1000 // GRID_SIZE) for i in range(GRID_SIZE)]
 ticks = [round(v, 1) for v in np.linspace(0, 1, 10)]
 
 # note that the first dimension corresponds to a specific delta-value then
@@ -25,8 +28,10 @@ def compute_overlap_disconts(layer_1, layer_2):
     global GRID_SIZE
     grid = np.zeros((GRID_SIZE, GRID_SIZE))
     for i in tqdm.tqdm(range(GRID_SIZE)):
-        i_scaled = i * (len(layer_1) // GRID_SIZE)
-        l1i, l2i = layer_1[i_scaled].cpu(), layer_2[i_scaled].cpu()
+        if layer_1[i] is None or layer_2[i] is None:
+            grid[:, i] = np.nan  # beyond the truncation of the k0 curves
+            continue
+        l1i, l2i = layer_1[i], layer_2[i]
         for j in range(GRID_SIZE):
             l1_disconts = np.nonzero(np.where(l1i >= eps[j], 1, 0))[0]
             l2_disconts = np.nonzero(np.where(l2i >= eps[j], 1, 0))[0]
@@ -58,8 +63,9 @@ def plot_grid(grid, l1_index, l2_index):
 
 def compute_plot_discont_overlap(l1_index, l2_index):
     global DATA_DIR, MODEL_NAME
-    l1_disconts = torch.load(Path(DATA_DIR) / MODEL_NAME / f"L{l1_index}.pth")
-    l2_disconts = torch.load(Path(DATA_DIR) / MODEL_NAME / f"L{l2_index}.pth")
+    layer_dir = Path(DATA_DIR) / MODEL_NAME
+    l1_disconts = load_layer_scores(layer_dir, l1_index, delt, grid_columns)
+    l2_disconts = load_layer_scores(layer_dir, l2_index, delt, grid_columns)
     grid = compute_overlap_disconts(l1_disconts, l2_disconts)
     plot_grid(grid, l1_index, l2_index)
 